@@ -0,0 +1,139 @@
+import asyncio
+import os
+
+from profiling import run_in_threadpool
+
+# Recommendation generations allowed to run at once in one worker
+MAX_CONCURRENT = int(os.environ.get("GENERATION_CONCURRENCY", "4"))
+# Requests allowed to wait for a free slot; further ones are shed straight away
+MAX_QUEUE = int(os.environ.get("GENERATION_QUEUE", "16"))
+# Time a request may spend waiting for and running a generation before it is given a fallback
+BUDGET_SECONDS = float(os.environ.get("GENERATION_BUDGET_MS", "2000")) / 1000
+
+
+class Overloaded(Exception):
+    """A request was shed; reason is queue_full, queue_timeout or budget"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Flight:
+    """One queued or running piece of work, shared by every request that asked for its key"""
+
+    __slots__ = ("task", "started", "waiters", "background")
+
+    def __init__(self, background=False):
+        self.task = None
+        self.started = False
+        # Requests still waiting for the result
+        self.waiters = 0
+        # Submitted with nobody waiting, so it is not cancelled when its waiters give up
+        self.background = background
+
+
+class AdmissionController:
+    """Caps concurrent work in one worker behind a short queue and a per-request latency budget
+
+    A request that finds every slot busy and the queue full is shed at once.
+    One whose budget runs out while its work is still queued or running is
+    shed as well. Work still queued when its last waiting request gives up is
+    cancelled and leaves the queue. Work that has started is never cancelled:
+    it finishes on its thread and frees its slot, so a generation that ran
+    past the budget still stores its result for the next request.
+
+    Work submitted with a key is single-flight: while it is queued or running,
+    further requests for the same key wait for the same result instead of
+    starting their own, and do not take a queue place.
+
+    Background work (submit) shares the same slots and flights at low
+    priority: it is only admitted while a slot is free and no request is
+    waiting, so it never holds a queue place a request could have used.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_queue=MAX_QUEUE, budget_seconds=BUDGET_SECONDS):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.budget_seconds = budget_seconds
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._flights = {}
+        self.active = 0
+        self.waiting = 0
+        self.background = 0
+
+    async def _execute(self, flight, fn, args):
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        flight.started = True
+        self.active += 1
+        try:
+            return await run_in_threadpool(fn, *args)
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+    def _finished(self, key, flight):
+        def callback(task):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if flight.background:
+                self.background -= 1
+            # Retrieved so a failure after every caller gave up is not reported as unhandled
+            if not task.cancelled():
+                task.exception()
+        return callback
+
+    def _submit(self, key, fn, args, background=False):
+        # Counted from submissions rather than the semaphore, which tasks have not reached yet
+        if self.active + self.waiting >= self.max_concurrent + self.max_queue:
+            raise Overloaded("queue_full")
+        flight = _Flight(background)
+        if background:
+            self.background += 1
+        self.waiting += 1
+        flight.task = asyncio.ensure_future(self._execute(flight, fn, args))
+        flight.task.add_done_callback(self._finished(key, flight))
+        if key is not None:
+            self._flights[key] = flight
+        return flight
+
+    def in_flight(self, key):
+        """Whether work for key is queued or running in this worker"""
+        return key in self._flights
+
+    def submit(self, fn, *args, key=None):
+        """Start fn(*args) as background work nobody waits for; False if it was not admitted
+
+        Not admitted while work for key is already in flight, or while no
+        slot is free or a request is waiting for one. Must be called from the
+        event loop.
+        """
+        if key is not None and key in self._flights:
+            return False
+        if self.waiting or self.active >= self.max_concurrent:
+            return False
+        self._submit(key, fn, args, background=True)
+        return True
+
+    async def run(self, fn, *args, key=None):
+        """Run fn(*args) on the thread pool once a slot is free; raises Overloaded when shed
+
+        With a key, joins the work already in flight for it if there is one.
+        """
+        flight = self._flights.get(key) if key is not None else None
+        if flight is None:
+            flight = self._submit(key, fn, args)
+        flight.waiters += 1
+        try:
+            # Shielded, so running out of budget stops this request's wait but not the work
+            return await asyncio.wait_for(asyncio.shield(flight.task), self.budget_seconds)
+        except asyncio.TimeoutError:
+            raise Overloaded("budget" if flight.started else "queue_timeout") from None
+        finally:
+            flight.waiters -= 1
+            # Nobody is left for the result of queued work, so it gives its queue place back
+            if not flight.waiters and not flight.started and not flight.background:
+                flight.task.cancel()
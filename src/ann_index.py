@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 1
+# Same tokenization as TfidfVectorizer's defaults, so queries land in the trained vocabulary
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+
+
+def product_text(product):
+    """Text a product is indexed by; the category is repeated as it dominates content scores"""
+    return " ".join(filter(None, [
+        product["category"], product["category"], product["tags"],
+        product["product_name"], product.get("description"),
+    ]))
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class TextEncoder:
+    """TF-IDF encoder, randomly projected to at most `dim` dimensions for large vocabularies"""
+
+    def __init__(self, vocabulary, idf, projection=None):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.projection = projection
+
+    @property
+    def dim(self):
+        return len(self.idf) if self.projection is None else self.projection.shape[1]
+
+    @classmethod
+    def fit(cls, texts, dim=256, seed=42):
+        """Fit on product texts and return (encoder, unit-length float32 vectors)"""
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        vectorizer = TfidfVectorizer(dtype=np.float32)
+        matrix = vectorizer.fit_transform(texts)
+        vocabulary = {term: int(column) for term, column in vectorizer.vocabulary_.items()}
+        idf = vectorizer.idf_.astype(np.float32)
+
+        projection = None
+        if len(vocabulary) > dim:
+            # Gaussian random projection keeps inner products approximately (Johnson-Lindenstrauss)
+            rng = np.random.default_rng(seed)
+            projection = (rng.standard_normal((len(vocabulary), dim)) / np.sqrt(dim)).astype(np.float32)
+            vectors = np.asarray(matrix @ projection, dtype=np.float32)
+        else:
+            vectors = matrix.toarray()
+        return cls(vocabulary, idf, projection), _normalize(vectors).astype(np.float32)
+
+    def encode(self, texts):
+        """Unit-length vectors for texts; terms outside the trained vocabulary are ignored"""
+        from scipy.sparse import csr_matrix
+
+        row_indices, columns = [], []
+        for i, text in enumerate(texts):
+            for term in TOKEN_PATTERN.findall(text.lower()):
+                column = self.vocabulary.get(term)
+                if column is not None:
+                    row_indices.append(i)
+                    columns.append(column)
+        counts = csr_matrix(
+            (np.ones(len(columns), dtype=np.float32), (row_indices, columns)),
+            shape=(len(texts), len(self.idf)),
+        )
+        weighted = counts.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1))).ravel()
+        norms[norms == 0] = 1.0
+        weighted = csr_matrix(weighted.multiply(1 / norms[:, None]))
+        rows = weighted @ self.projection if self.projection is not None else weighted.toarray()
+        return _normalize(np.asarray(rows)).astype(np.float32)
+
+    def preference_vector(self, category_weights):
+        """Query vector for a customer's weighted preferred categories"""
+        if not category_weights:
+            return np.zeros(self.dim, dtype=np.float32)
+        categories = list(category_weights)
+        weights = np.array([category_weights[c] for c in categories], dtype=np.float32)
+        return _normalize(weights @ self.encode(categories)).astype(np.float32)
+
+
+def _nearest_centroids(vectors, centroids, batch_size=8192):
+    """Index of the most similar centroid for every vector, computed in batches"""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start:start + batch_size])
+        assignments[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def _train_centroids(vectors, nlist, iterations=10, sample_size=None, seed=42):
+    """Spherical k-means on a sample of the vectors"""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or max(nlist * 256, 10000))
+    sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = _nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # Re-seed empty lists with random sample points
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = _normalize(sums).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest-neighbour index over unit-length product vectors
+
+    Vectors are clustered around `nlist` centroids and stored grouped by cluster,
+    so a query only scores the clusters whose centroids are closest to it. The
+    `nprobe` clusters searched per query trade recall for latency: nprobe=nlist
+    is exact search.
+
+    Products added after the index was built are kept in a pending buffer that
+    every query also checks; save() folds them into the on-disk lists.
+    """
+
+    def __init__(self, encoder, centroids, vectors, ids, offsets, nprobe=None):
+        self.encoder = encoder
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.nprobe = nprobe or max(1, self.nlist // 8)
+        self._pending_vectors = np.empty((0, encoder.dim), dtype=np.float32)
+        self._pending_ids = np.empty(0, dtype=np.int64)
+        self._pending_lists = np.empty(0, dtype=np.int32)
+        # Product IDs whose stored (not pending) rows are hidden from results
+        self._deleted = set()
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return int((~self._deleted_mask(self.ids)).sum()) + len(self._pending_ids)
+
+    def _deleted_mask(self, ids):
+        if not self._deleted:
+            return np.zeros(len(ids), dtype=bool)
+        return np.isin(ids, np.fromiter(self._deleted, dtype=np.int64))
+
+    @classmethod
+    def build(cls, products, nlist=None, dim=256, iterations=10, nprobe=None, seed=42):
+        """Train the encoder and clusters on a product list and index every product"""
+        encoder, vectors = TextEncoder.fit([product_text(p) for p in products], dim=dim, seed=seed)
+        ids = np.array([p["product_id"] for p in products], dtype=np.int64)
+        nlist = min(len(products), nlist or max(1, int(round(np.sqrt(len(products))))))
+        centroids = _train_centroids(vectors, nlist, iterations=iterations, seed=seed)
+
+        assignments = _nearest_centroids(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignments, minlength=nlist))
+        return cls(encoder, centroids, vectors[order], ids[order], offsets, nprobe=nprobe)
+
+    def add(self, products):
+        """Insert or replace products without retraining; new terms are outside the vocabulary"""
+        if not products:
+            return
+        ids = np.array([p["product_id"] for p in products], dtype=np.int64)
+        self.remove(ids)
+        vectors = self.encoder.encode([product_text(p) for p in products])
+        self._pending_vectors = np.vstack([self._pending_vectors, vectors])
+        self._pending_ids = np.concatenate([self._pending_ids, ids])
+        self._pending_lists = np.concatenate([self._pending_lists, _nearest_centroids(vectors, self.centroids)])
+
+    def remove(self, product_ids):
+        """Drop products from results; their rows are discarded on the next save()"""
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        keep = ~np.isin(self._pending_ids, product_ids)
+        if not keep.all():
+            self._pending_vectors = self._pending_vectors[keep]
+            self._pending_ids = self._pending_ids[keep]
+            self._pending_lists = self._pending_lists[keep]
+        self._deleted.update(product_ids.tolist())
+
+    def search(self, query, k=10, nprobe=None):
+        """IDs and inner-product scores of the approximate top k products, best first"""
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(self.nlist, nprobe or self.nprobe)
+        if not np.any(query):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        similarities = self.centroids @ query
+        if nprobe < self.nlist:
+            probe = np.argpartition(-similarities, nprobe - 1)[:nprobe]
+        else:
+            probe = np.arange(self.nlist)
+
+        id_parts, score_parts = [], []
+        for cluster in probe:
+            start, end = self.offsets[cluster], self.offsets[cluster + 1]
+            if end > start:
+                id_parts.append(self.ids[start:end])
+                score_parts.append(self.vectors[start:end] @ query)
+        if self._deleted and id_parts:
+            ids, scores = np.concatenate(id_parts), np.concatenate(score_parts)
+            live = ~self._deleted_mask(ids)
+            id_parts, score_parts = [ids[live]], [scores[live]]
+        if len(self._pending_ids):
+            pending = np.isin(self._pending_lists, probe)
+            id_parts.append(self._pending_ids[pending])
+            score_parts.append(self._pending_vectors[pending] @ query)
+        if not id_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        ids = np.concatenate(id_parts)
+        scores = np.concatenate(score_parts)
+        if len(ids) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return ids[order], scores[order]
+
+    def _compacted(self):
+        """Stored arrays with pending rows merged in and deleted rows dropped"""
+        keep = ~self._deleted_mask(self.ids)
+        lists = np.repeat(np.arange(self.nlist, dtype=np.int32), np.diff(self.offsets))
+        vectors = np.vstack([np.asarray(self.vectors)[keep], self._pending_vectors])
+        ids = np.concatenate([np.asarray(self.ids)[keep], self._pending_ids])
+        lists = np.concatenate([lists[keep], self._pending_lists])
+        order = np.argsort(lists, kind="stable")
+        offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(lists, minlength=self.nlist))
+        return vectors[order], ids[order], offsets
+
+    def save(self, path):
+        """Write the index as a directory of .npy arrays plus meta.json, replacing any existing one"""
+        vectors, ids, offsets = self._compacted()
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "vectors.npy"), vectors)
+        np.save(os.path.join(tmp_path, "ids.npy"), ids)
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp_path, "centroids.npy"), self.centroids)
+        np.save(os.path.join(tmp_path, "idf.npy"), self.encoder.idf)
+        if self.encoder.projection is not None:
+            np.save(os.path.join(tmp_path, "projection.npy"), self.encoder.projection)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({
+                "format_version": FORMAT_VERSION,
+                "count": int(len(ids)),
+                "dim": self.encoder.dim,
+                "nlist": self.nlist,
+                "nprobe": self.nprobe,
+                "vocabulary": self.encoder.vocabulary,
+            }, f)
+
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+        self.vectors, self.ids, self.offsets = vectors, ids, offsets
+        self._pending_vectors = self._pending_vectors[:0]
+        self._pending_ids = self._pending_ids[:0]
+        self._pending_lists = self._pending_lists[:0]
+        self._deleted.clear()
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open a saved index; with mmap the vectors are paged in lazily instead of read up front"""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format {meta['format_version']} in {path}")
+
+        mmap_mode = "r" if mmap else None
+        projection_path = os.path.join(path, "projection.npy")
+        encoder = TextEncoder(
+            meta["vocabulary"],
+            np.load(os.path.join(path, "idf.npy")),
+            np.load(projection_path) if os.path.exists(projection_path) else None,
+        )
+        return cls(
+            encoder,
+            np.load(os.path.join(path, "centroids.npy")),
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, "ids.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, "offsets.npy")),
+            nprobe=meta["nprobe"],
+        )
+
+
+def load_catalog(db_path):
+    """Every catalog product in the dict shape used by RecommendationSystem"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT product_id, product_name, product_category, price, description, tags FROM product_catalog")
+    products = [{
+        "product_id": row[0],
+        "product_name": row[1],
+        "category": row[2],
+        "price": row[3],
+        "description": row[4],
+        "tags": row[5],
+    } for row in cursor.fetchall()]
+    conn.close()
+    return products
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the approximate nearest-neighbour product index")
+    parser.add_argument("--db", default="customers.db", help="Database with the product catalog")
+    parser.add_argument("--out", default="product_index", help="Index directory to write")
+    parser.add_argument("--nlist", type=int, help="Number of clusters (default sqrt of catalog size)")
+    parser.add_argument("--nprobe", type=int, help="Clusters searched per query by default")
+    parser.add_argument("--dim", type=int, default=256, help="Maximum vector dimensionality")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    products = load_catalog(args.db)
+    if not products:
+        parser.error(f"No products in {args.db}")
+    index = IVFIndex.build(products, nlist=args.nlist, dim=args.dim, nprobe=args.nprobe)
+    index.save(args.out)
+    print(f"Indexed {len(index)} products into {index.nlist} clusters "
+          f"(dim {index.encoder.dim}, nprobe {index.nprobe}) at {args.out} "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# Layout: <root>/<name>/<version>/{manifest.json, ...files} and <root>/<name>/CURRENT
+MANIFEST = "manifest.json"
+CURRENT = "CURRENT"
+KEEP_VERSIONS = 5
+POLL_SECONDS = float(os.environ.get("ARTIFACT_POLL_SECONDS", "5"))
+
+
+def _load_catalog(path):
+    from catalog_snapshot import CatalogSnapshot
+    return CatalogSnapshot.load(path)
+
+
+def _load_ann_index(path):
+    from ann_index import IVFIndex
+    return IVFIndex.load(path)
+
+
+def _load_mf_model(path):
+    from matrix_factorization import FactorModel
+    return FactorModel.load(path)
+
+
+def _load_popularity(path):
+    with open(os.path.join(path, "popularity.json")) as f:
+        return json.load(f)
+
+
+# How each artifact kind is opened for serving
+LOADERS = {
+    "catalog": _load_catalog,
+    "ann_index": _load_ann_index,
+    "mf_model": _load_mf_model,
+    "popularity": _load_popularity,
+}
+
+
+def new_version():
+    """Sortable version name: UTC timestamp to the microsecond plus a random suffix"""
+    now = time.time()
+    return (time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + f"{int(now * 1e6) % 1000000:06d}Z-"
+            + uuid.uuid4().hex[:6])
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, text):
+    # A temporary name per writer, so concurrent writers replace the file in turn
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ArtifactStore:
+    """Versioned artifact directories on disk
+
+    A version is immutable once published: files are staged in a temporary
+    directory, described by a manifest (sizes and SHA-256 of every file) and
+    renamed into place. The active version of each artifact is named in its
+    CURRENT file, which is replaced atomically to activate or roll back.
+    """
+
+    def __init__(self, root="artifacts"):
+        self.root = root
+
+    def _dir(self, name):
+        return os.path.join(self.root, name)
+
+    def versions(self, name):
+        """Published versions of an artifact, oldest first"""
+        path = self._dir(name)
+        if not os.path.isdir(path):
+            return []
+        # Staging directories (.<version>.tmp) get a manifest before they are renamed into place
+        return sorted(
+            entry for entry in os.listdir(path)
+            if not entry.startswith(".") and os.path.exists(os.path.join(path, entry, MANIFEST))
+        )
+
+    def current(self, name):
+        """Active version of an artifact, or None"""
+        try:
+            with open(os.path.join(self._dir(name), CURRENT)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def path(self, name, version):
+        return os.path.join(self._dir(name), version)
+
+    def manifest(self, name, version):
+        with open(os.path.join(self.path(name, version), MANIFEST)) as f:
+            return json.load(f)
+
+    def publish(self, name, source, metadata=None, activate=True, move=False):
+        """Copy (or move) a built artifact directory in as a new version; returns the version"""
+        if name not in LOADERS:
+            raise ValueError(f"Unknown artifact {name}")
+        version = new_version()
+        staging = os.path.join(self._dir(name), f".{version}.tmp")
+        if move:
+            os.makedirs(self._dir(name), exist_ok=True)
+            os.rename(source, staging)
+        else:
+            shutil.copytree(source, staging)
+
+        files = {}
+        for directory, _, filenames in os.walk(staging):
+            for filename in filenames:
+                full_path = os.path.join(directory, filename)
+                relative = os.path.relpath(full_path, staging)
+                files[relative] = {"size": os.path.getsize(full_path), "sha256": _file_digest(full_path)}
+        manifest = {
+            "name": name,
+            "version": version,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "files": files,
+            "metadata": metadata or {},
+        }
+        with open(os.path.join(staging, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(staging, self.path(name, version))
+
+        if activate:
+            self.activate(name, version)
+        self.prune(name)
+        return version
+
+    def publish_built(self, name, build, metadata=None):
+        """Run build(directory) in a staging directory under the root and publish the result
+
+        Every build gets its own staging directory, so builds running at the
+        same time in several processes cannot overwrite each other's files.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f".{name}-build-", dir=self.root)
+        try:
+            build(staging)
+            return self.publish(name, staging, metadata, move=True)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def activate(self, name, version):
+        if version not in self.versions(name):
+            raise ValueError(f"No version {version} of {name}")
+        _write_atomic(os.path.join(self._dir(name), CURRENT), version + "\n")
+
+    def rollback(self, name):
+        """Activate the version published before the current one; returns it"""
+        versions = self.versions(name)
+        current = self.current(name)
+        older = [version for version in versions if current is None or version < current]
+        if not older:
+            raise ValueError(f"No version of {name} older than {current}")
+        self.activate(name, older[-1])
+        return older[-1]
+
+    def prune(self, name, keep=KEEP_VERSIONS):
+        """Delete old versions beyond the newest `keep`, never the active one
+
+        Workers that still map files of a removed version keep reading them;
+        the data is only released once the last mapping closes.
+        """
+        current = self.current(name)
+        for version in self.versions(name)[:-keep]:
+            if version != current:
+                shutil.rmtree(self.path(name, version), ignore_errors=True)
+
+    def verify(self, name, version, checksums=False):
+        """Raise ValueError if any file listed in the manifest is missing or differs"""
+        path = self.path(name, version)
+        for relative, expected in self.manifest(name, version)["files"].items():
+            full_path = os.path.join(path, relative)
+            if not os.path.exists(full_path) or os.path.getsize(full_path) != expected["size"]:
+                raise ValueError(f"{name}/{version}: {relative} is missing or truncated")
+            if checksums and _file_digest(full_path) != expected["sha256"]:
+                raise ValueError(f"{name}/{version}: {relative} checksum mismatch")
+
+
+class ArtifactRegistry:
+    """Loaded serving artifacts, hot-swapped when a new version is activated
+
+    All loaded objects live in one dict that is replaced, never mutated, so a
+    swap is a single reference assignment. A request that fetched an object
+    keeps using it until it finishes, even if a newer version is swapped in
+    meanwhile. Loading happens on the watcher thread, off the request path; a
+    version that fails to load is reported and the previous one stays active.
+    """
+
+    def __init__(self, store, names=None, poll_seconds=POLL_SECONDS):
+        self.store = store
+        self.names = list(names or LOADERS)
+        self.poll_seconds = poll_seconds
+        self._loaded = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, name):
+        """Object of the active version, or None when nothing is loaded"""
+        entry = self._loaded.get(name)
+        return entry["object"] if entry else None
+
+    def version(self, name):
+        entry = self._loaded.get(name)
+        return entry["version"] if entry else None
+
+    def refresh(self, name):
+        """Load the version named in CURRENT if it is not the one being served
+
+        Returns True when a new version was swapped in.
+        """
+        with self._lock:
+            version = self.store.current(name)
+            if version is None or version == self.version(name):
+                return False
+            if self._errors.get(name, {}).get("version") == version:
+                # Already failed; wait for a new publish or rollback
+                return False
+            start = time.perf_counter()
+            try:
+                self.store.verify(name, version)
+                loaded = LOADERS[name](self.store.path(name, version))
+            except Exception as e:
+                print(f"Failed to load artifact {name}/{version}: {e}")
+                self._errors[name] = {"version": version, "error": str(e)}
+                return False
+
+            self._errors.pop(name, None)
+            previous = self.version(name)
+            self._loaded = dict(self._loaded, **{name: {
+                "version": version,
+                "object": loaded,
+                "loaded_at": time.time(),
+                "load_seconds": time.perf_counter() - start,
+                "previous_version": previous,
+            }})
+            print(f"Loaded artifact {name}/{version} (was {previous})")
+            return True
+
+    def refresh_all(self):
+        for name in self.names:
+            self.refresh(name)
+
+    def rollback(self, name):
+        """Re-activate the previous version on disk and swap it in now"""
+        version = self.store.rollback(name)
+        self.refresh(name)
+        return version
+
+    def _watch(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_all()
+            except Exception as e:
+                print(f"Artifact watcher error: {e}")
+            self._stop.wait(self.poll_seconds)
+
+    def start(self):
+        """Start the background watcher; the first load also happens there"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="artifact-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def status(self):
+        """Loaded, active and available versions per artifact"""
+        loaded = self._loaded
+        status = {}
+        for name in self.names:
+            entry = loaded.get(name)
+            status[name] = {
+                "loaded_version": entry["version"] if entry else None,
+                "loaded_at": entry["loaded_at"] if entry else None,
+                "load_seconds": entry["load_seconds"] if entry else None,
+                "previous_version": entry["previous_version"] if entry else None,
+                "active_version": self.store.current(name),
+                "available_versions": self.store.versions(name),
+                "error": self._errors.get(name),
+            }
+        return {"root": self.store.root, "watching": self._thread is not None, "artifacts": status}
+
+
+def popularity_table(db_path, top_n=20):
+    """The most purchased categories of each customer segment, most purchased first"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'purchase_rollup'")
+    # Purchases the compaction job rolled up still count
+    rolled_up = '''
+            UNION ALL
+            SELECT customer_id, product_category, orders FROM purchase_rollup
+    ''' if cursor.fetchone() else ""
+    cursor.execute(f'''
+        SELECT cs.customer_segment, ph.product_category, SUM(ph.purchases) AS purchases
+        FROM (
+            SELECT customer_id, product_category, 1 AS purchases FROM purchase_history{rolled_up}
+        ) ph
+        JOIN customer_segments cs ON ph.customer_id = cs.customer_id
+        GROUP BY cs.customer_segment, ph.product_category
+        ORDER BY cs.customer_segment, purchases DESC, ph.product_category
+    ''')
+    table = {}
+    for segment, category, _ in cursor.fetchall():
+        categories = table.setdefault(segment, [])
+        if len(categories) < top_n:
+            categories.append(category)
+    conn.close()
+    return table
+
+
+def build_popularity(db_path, out, top_n=20):
+    """Write the most purchased categories of each customer segment to out/popularity.json"""
+    table = popularity_table(db_path, top_n)
+    os.makedirs(out, exist_ok=True)
+    with open(os.path.join(out, "popularity.json"), "w") as f:
+        json.dump(table, f)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish, list and roll back versioned serving artifacts")
+    parser.add_argument("--root", default=os.environ.get("ARTIFACT_DIR", "artifacts"), help="Artifact directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    publish = subparsers.add_parser("publish", help="Publish a built directory as a new version")
+    publish.add_argument("name", choices=sorted(LOADERS))
+    publish.add_argument("source", help="Directory written by ann_index.py / matrix_factorization.py")
+    publish.add_argument("--no-activate", action="store_true", help="Publish without making it active")
+
+    catalog = subparsers.add_parser("catalog", help="Build and publish a memory-mapped catalog snapshot")
+    catalog.add_argument("--db", default="customers.db", help="Customer database")
+
+    popularity = subparsers.add_parser("popularity", help="Build and publish the segment popularity table")
+    popularity.add_argument("--db", default="customers.db", help="Customer database")
+
+    status = subparsers.add_parser("list", help="Show active and available versions")
+    status.add_argument("name", nargs="?", choices=sorted(LOADERS))
+
+    rollback = subparsers.add_parser("rollback", help="Activate the previous version")
+    rollback.add_argument("name", choices=sorted(LOADERS))
+
+    activate = subparsers.add_parser("activate", help="Activate a specific version")
+    activate.add_argument("name", choices=sorted(LOADERS))
+    activate.add_argument("version")
+
+    verify = subparsers.add_parser("verify", help="Check the active version against its manifest checksums")
+    verify.add_argument("name", choices=sorted(LOADERS))
+
+    args = parser.parse_args()
+    store = ArtifactStore(args.root)
+    if args.command == "publish":
+        version = store.publish(args.name, args.source, activate=not args.no_activate)
+        print(f"Published {args.name}/{version}")
+    elif args.command == "catalog":
+        from catalog_snapshot import build_snapshot
+        version = store.publish_built("catalog", lambda path: build_snapshot(args.db, path), {"db": args.db})
+        print(f"Published catalog/{version}")
+    elif args.command == "popularity":
+        version = store.publish_built("popularity", lambda path: build_popularity(args.db, path), {"db": args.db})
+        print(f"Published popularity/{version}")
+    elif args.command == "list":
+        for name in [args.name] if args.name else sorted(LOADERS):
+            current = store.current(name)
+            for version in store.versions(name):
+                print(f"{name:<12} {version} {'*' if version == current else ''}")
+    elif args.command == "rollback":
+        print(f"Activated {args.name}/{store.rollback(args.name)}")
+    elif args.command == "activate":
+        store.activate(args.name, args.version)
+        print(f"Activated {args.name}/{args.version}")
+    elif args.command == "verify":
+        version = store.current(args.name)
+        store.verify(args.name, version, checksums=True)
+        print(f"{args.name}/{version} matches its manifest")
+
+
+if __name__ == "__main__":
+    main()
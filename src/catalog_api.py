@@ -0,0 +1,89 @@
+import tempfile
+from typing import Optional
+
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+import catalog_loader
+import http_caching
+import product_search
+from catalog_pages import MAX_PAGE_SIZE, CatalogPages
+from recommendation_api import artifacts, recommendation_system
+
+# Uploads are spooled to disk beyond this size, so large catalogs never sit in memory
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+
+catalog_router = APIRouter(prefix="/products", tags=["products"], default_response_class=http_caching.FastJSONResponse)
+
+# Listing pages cached per catalog version
+catalog_pages = CatalogPages(recommendation_system.db_path)
+
+@catalog_router.get("")
+async def list_products(request: Request, category: Optional[str] = None, min_price: Optional[float] = None,
+                        max_price: Optional[float] = None, after: int = 0, limit: int = 20):
+    """Browse the catalog in product_id order, optionally by category and price range
+
+    Pages are keyset-paginated: pass the previous page's next_after as `after`.
+    Responses carry an ETag derived from the catalog version, and a matching
+    If-None-Match is answered with 304 before any page is fetched.
+    """
+    if not 1 <= limit <= MAX_PAGE_SIZE or after < 0:
+        raise HTTPException(status_code=400, detail=f"limit must be 1-{MAX_PAGE_SIZE} and after non-negative")
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise HTTPException(status_code=400, detail="min_price is greater than max_price")
+
+    filters = (category, min_price, max_price, after, limit)
+    etag = await run_in_threadpool(catalog_pages.etag, *filters)
+    if http_caching.etag_matches(request.headers.get("if-none-match"), etag):
+        return http_caching.not_modified(etag, "no-cache")
+
+    page, etag = await run_in_threadpool(catalog_pages.page, *filters)
+    return http_caching.json_response(page, etag, "no-cache")
+
+@catalog_router.post("/bulk")
+async def bulk_upsert(request: Request, background_tasks: BackgroundTasks, format: Optional[str] = None,
+                      prune: bool = False, rebuild: bool = True):
+    """Upsert products from a CSV, NDJSON or Parquet request body
+
+    The format comes from the `format` parameter or the Content-Type. The body is
+    streamed to a spooled temporary file and loaded on a worker thread. Catalog
+    snapshot and ANN index rebuilds run once, in the background, after the load.
+    """
+    fmt = format or catalog_loader.detect_format(content_type=request.headers.get("content-type"))
+    if fmt not in catalog_loader.FORMATS:
+        raise HTTPException(status_code=415, detail=f"Unsupported catalog format {fmt}; use one of "
+                                                    f"{', '.join(catalog_loader.FORMATS)}")
+
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES) as body:
+        async for chunk in request.stream():
+            body.write(chunk)
+        body.seek(0)
+        try:
+            stats = await run_in_threadpool(
+                catalog_loader.load_file, recommendation_system.db_path, body, fmt, prune=prune
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    if stats["changed"]:
+        catalog_pages.invalidate()
+    if stats["changed"] and rebuild:
+        background_tasks.add_task(catalog_loader.rebuild_derived, recommendation_system.db_path, artifacts.store)
+        stats["rebuild"] = "scheduled"
+    return stats
+
+@catalog_router.get("/search")
+async def search_products(q: str, limit: int = 20, offset: int = 0, prefix: bool = True):
+    """Full-text product search over name, category, description and tags, ranked by BM25
+
+    The last word matches as a prefix unless prefix=false. Pages are selected
+    with limit and offset, and has_more tells whether another page follows.
+    """
+    if not 1 <= limit <= 100 or offset < 0:
+        raise HTTPException(status_code=400, detail="limit must be 1-100 and offset non-negative")
+    return await run_in_threadpool(product_search.search, recommendation_system.db_path, q, limit, offset, prefix)
+
+@catalog_router.get("/version")
+async def get_catalog_version():
+    """Current catalog version; changes whenever a load inserts, updates or deletes products"""
+    return {"version": catalog_loader.catalog_version(recommendation_system.db_path)}
@@ -0,0 +1,424 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import db
+import product_links
+
+# Rows diffed and written per transaction
+BATCH_SIZE = 20000
+# IDs per "WHERE product_id IN (...)" lookup, below SQLite's bound-parameter limit
+LOOKUP_CHUNK = 500
+# Rejected records reported back in full; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+# Catalog versions whose changed product IDs are kept for incremental index updates
+CHANGE_LOG_VERSIONS = 1000
+# Past this share of the indexed products changed, the ANN index is retrained rather than patched
+ANN_RETRAIN_FRACTION = 0.2
+
+FORMATS = ("csv", "ndjson", "parquet")
+CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+}
+EXTENSIONS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson", ".parquet": "parquet"}
+
+COLUMNS = ("product_id", "product_name", "product_category", "price", "description", "tags")
+
+
+def init_db(cursor):
+    """Single-row table holding the catalog version, bumped by every load that changes products
+
+    catalog_changes records which products each version inserted, updated or
+    deleted, so derived indexes can be patched instead of rebuilt.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO catalog_state (id, version) VALUES (1, 0)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_changes (
+            version INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            PRIMARY KEY (version, product_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def catalog_version(db_path):
+    conn = db.connect(db_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT version FROM catalog_state WHERE id = 1")
+        row = cursor.fetchone()
+    except sqlite3.OperationalError:
+        # Schema step not run yet
+        row = None
+    conn.close()
+    return row[0] if row else 0
+
+
+def detect_format(filename=None, content_type=None):
+    """Input format from a content type or file extension, or None if neither is recognised"""
+    if content_type:
+        fmt = CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+        if fmt:
+            return fmt
+    if filename:
+        return EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+    return None
+
+
+def read_records(source, fmt):
+    """Stream records as dicts from a binary file object in the given format"""
+    if fmt == "csv":
+        yield from csv.DictReader(io.TextIOWrapper(source, encoding="utf-8-sig", newline=""))
+    elif fmt == "ndjson":
+        for line in io.TextIOWrapper(source, encoding="utf-8"):
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Passed on as-is so normalize() rejects it and the load goes on
+                    yield line
+    elif fmt == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("Parquet input needs pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=BATCH_SIZE):
+            yield from batch.to_pylist()
+    else:
+        raise ValueError(f"Unsupported format {fmt}; expected one of {', '.join(FORMATS)}")
+
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def normalize(record):
+    """(product_id, product_name, product_category, price, description, tags) from an input record
+
+    Accepts `category` for `product_category` and `name` for `product_name`; tags
+    may be a list or a space-separated string. Raises ValueError on bad input.
+    """
+    if not isinstance(record, dict):
+        raise ValueError(f"not a product object: {str(record)[:80]!r}")
+    try:
+        product_id = int(record["product_id"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"product_id missing or not an integer: {record.get('product_id')!r}")
+    if product_id <= 0:
+        raise ValueError(f"product_id must be positive: {product_id}")
+
+    price = record.get("price")
+    if price in (None, ""):
+        price = None
+    else:
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            raise ValueError(f"price is not a number: {price!r}")
+        if price < 0:
+            raise ValueError(f"price is negative: {price}")
+
+    tags = record.get("tags")
+    if isinstance(tags, (list, tuple)):
+        tags = " ".join(str(tag) for tag in tags)
+
+    name = _text(record.get("product_name", record.get("name")))
+    if name is None:
+        raise ValueError("product_name is missing")
+    category = _text(record.get("product_category", record.get("category")))
+    return (product_id, name, category, price, _text(record.get("description")), _text(tags))
+
+
+def _existing_rows(cursor, product_ids):
+    existing = {}
+    for start in range(0, len(product_ids), LOOKUP_CHUNK):
+        chunk = product_ids[start:start + LOOKUP_CHUNK]
+        cursor.execute(f'''
+            SELECT {", ".join(COLUMNS)} FROM product_catalog
+            WHERE product_id IN ({",".join("?" * len(chunk))})
+        ''', chunk)
+        existing.update((row[0], tuple(row)) for row in cursor.fetchall())
+    return existing
+
+
+def _bump_version(cursor, product_ids):
+    """Move the catalog to a new version that changed product_ids; returns the version"""
+    cursor.execute("UPDATE catalog_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1")
+    cursor.execute("SELECT version FROM catalog_state WHERE id = 1")
+    version = cursor.fetchone()[0]
+    cursor.executemany(
+        "INSERT OR IGNORE INTO catalog_changes (version, product_id) VALUES (?, ?)",
+        ((version, product_id) for product_id in product_ids)
+    )
+    return version
+
+
+def changed_since(cursor, since, current):
+    """IDs of products changed after catalog version since, up to current
+
+    None when the change log does not cover every version in between (it is
+    trimmed to the last CHANGE_LOG_VERSIONS, and the sample seed is not logged).
+    """
+    cursor.execute(
+        "SELECT COUNT(DISTINCT version) FROM catalog_changes WHERE version > ? AND version <= ?", (since, current)
+    )
+    if cursor.fetchone()[0] != current - since:
+        return None
+    cursor.execute(
+        "SELECT DISTINCT product_id FROM catalog_changes WHERE version > ? AND version <= ?", (since, current)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _write_batch(cursor, batch, stats):
+    """Insert new products and update changed ones; identical rows are not touched
+
+    A batch that changes anything also bumps the catalog version, in the same
+    transaction as its rows.
+    """
+    existing = _existing_rows(cursor, list(batch))
+    inserts, updates = [], []
+    for product_id, row in batch.items():
+        current = existing.get(product_id)
+        if current is None:
+            inserts.append(row)
+        elif current != row:
+            updates.append(row[1:] + (product_id,))
+    cursor.executemany(
+        f"INSERT INTO product_catalog ({', '.join(COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)", inserts
+    )
+    cursor.executemany('''
+        UPDATE product_catalog
+        SET product_name = ?, product_category = ?, price = ?, description = ?, tags = ?
+        WHERE product_id = ?
+    ''', updates)
+    if inserts or updates:
+        _bump_version(cursor, [row[0] for row in inserts] + [row[-1] for row in updates])
+    stats["inserted"] += len(inserts)
+    stats["updated"] += len(updates)
+    stats["unchanged"] += len(batch) - len(inserts) - len(updates)
+
+
+def upsert_products(db_path, records, batch_size=BATCH_SIZE, prune=False):
+    """Upsert a stream of product records into product_catalog
+
+    Records are diffed against the stored rows in batches, and each batch is
+    written with executemany in one transaction. Within a load, the last record
+    for a product ID wins. With prune, products absent from the feed are deleted
+    once the whole feed has been read. Every transaction that changes products
+    bumps the catalog version along with them, so a load that fails partway
+    still leaves the version matching what was committed and caches keyed on
+    it (catalog pages, recommendation ETags, rendered bodies) move on. Once
+    products were inserted or updated, purchases not linked to a catalog ID
+    yet are linked by name. Returns counts, the new version and the first
+    rejected records.
+    """
+    start = time.perf_counter()
+    stats = {"received": 0, "inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0, "rejected": 0, "errors": []}
+    conn = db.connect(db_path)
+    cursor = conn.cursor()
+    init_db(cursor)
+    conn.commit()
+
+    seen = set() if prune else None
+    batch = {}
+    for number, record in enumerate(records, 1):
+        stats["received"] += 1
+        try:
+            row = normalize(record)
+        except ValueError as e:
+            stats["rejected"] += 1
+            if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+                stats["errors"].append({"record": number, "error": str(e)})
+            if seen is not None and isinstance(record, dict):
+                # Never prune a product just because its new row was malformed
+                try:
+                    seen.add(int(record.get("product_id")))
+                except (TypeError, ValueError):
+                    pass
+            continue
+        if seen is not None:
+            seen.add(row[0])
+        batch[row[0]] = row
+        if len(batch) >= batch_size:
+            _write_batch(cursor, batch, stats)
+            conn.commit()
+            batch = {}
+    if batch:
+        _write_batch(cursor, batch, stats)
+
+    if prune:
+        if not seen:
+            conn.rollback()
+            conn.close()
+            raise ValueError("Refusing to prune the whole catalog from a feed with no products")
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS feed_product_ids (product_id INTEGER PRIMARY KEY)")
+        cursor.execute("DELETE FROM feed_product_ids")
+        cursor.executemany("INSERT INTO feed_product_ids (product_id) VALUES (?)", ((pid,) for pid in seen))
+        cursor.execute('''
+            SELECT product_id FROM product_catalog
+            WHERE product_id NOT IN (SELECT product_id FROM feed_product_ids)
+        ''')
+        deleted = [row[0] for row in cursor.fetchall()]
+        if deleted:
+            _bump_version(cursor, deleted)
+            cursor.execute('''
+                DELETE FROM product_catalog
+                WHERE product_id NOT IN (SELECT product_id FROM feed_product_ids)
+            ''')
+        stats["deleted"] = len(deleted)
+
+    stats["changed"] = stats["inserted"] + stats["updated"] + stats["deleted"]
+    # Purchases made before their product was loaded, or under a name it now has
+    stats["linked_purchases"] = product_links.backfill(cursor) if stats["inserted"] or stats["updated"] else 0
+    cursor.execute("SELECT version FROM catalog_state WHERE id = 1")
+    stats["version"] = cursor.fetchone()[0]
+    cursor.execute("DELETE FROM catalog_changes WHERE version <= ?", (stats["version"] - CHANGE_LOG_VERSIONS,))
+    conn.commit()
+    conn.close()
+    stats["seconds"] = round(time.perf_counter() - start, 3)
+    return stats
+
+
+def load_file(db_path, source, fmt, batch_size=BATCH_SIZE, prune=False):
+    """Upsert every product in a binary file object of the given format"""
+    return upsert_products(db_path, read_records(source, fmt), batch_size=batch_size, prune=prune)
+
+
+def _products(cursor, product_ids):
+    """Catalog products with the given IDs, in the dict shape ranking and indexing use"""
+    return [{
+        "product_id": row[0],
+        "product_name": row[1],
+        "category": row[2],
+        "price": row[3],
+        "description": row[4],
+        "tags": row[5],
+    } for row in _existing_rows(cursor, product_ids).values()]
+
+
+def _publish_ann_index(db_path, store, version, metadata):
+    """Patch the active ANN index with the products changed since it was built, or retrain it
+
+    Added and edited products are encoded with the index's existing vocabulary
+    and clusters, and deleted ones dropped (IVFIndex.add / remove). The index
+    is retrained on the whole catalog when the change log does not cover every
+    version since it was built, or when more than ANN_RETRAIN_FRACTION of it
+    changed. Returns the published version, or None if nothing was published.
+    """
+    from ann_index import IVFIndex, load_catalog
+
+    active = store.current("ann_index")
+    built = store.manifest("ann_index", active)["metadata"].get("catalog_version")
+    conn = db.connect(db_path)
+    cursor = conn.cursor()
+    try:
+        changed = changed_since(cursor, built, version) if built is not None and built <= version else None
+        if changed is not None:
+            if not changed:
+                return None
+            index = IVFIndex.load(store.path("ann_index", active), mmap=False)
+            if len(changed) <= ANN_RETRAIN_FRACTION * len(index):
+                products = _products(cursor, sorted(changed))
+                index.add(products)
+                index.remove(sorted(changed - {product["product_id"] for product in products}))
+                return store.publish_built("ann_index", index.save, dict(metadata, patched_products=len(changed)))
+    finally:
+        conn.close()
+
+    products = load_catalog(db_path)
+    if not products:
+        return None
+    return store.publish_built("ann_index", lambda path: IVFIndex.build(products).save(path), metadata)
+
+
+_rebuild_lock = threading.Lock()
+_built_versions = {}
+
+
+def rebuild_derived(db_path, store):
+    """Rebuild and publish the published structures derived from the catalog, once per catalog version
+
+    Only artifacts that are already active are rebuilt: the catalog snapshot and
+    the ANN index, which is patched incrementally when it can be (see
+    _publish_ann_index). Overlapping calls are serialised, and a call that finds the
+    current catalog version already built returns without doing anything, so a
+    burst of loads costs one rebuild. Returns {artifact: published version}.
+    """
+    with _rebuild_lock:
+        version = catalog_version(db_path)
+        key = (os.path.abspath(db_path), os.path.abspath(store.root))
+        if _built_versions.get(key) == version:
+            return {}
+
+        published = {}
+        metadata = {"db": db_path, "catalog_version": version}
+        if store.current("catalog"):
+            from catalog_snapshot import build_snapshot
+            published["catalog"] = store.publish_built(
+                "catalog", lambda path: build_snapshot(db_path, path), metadata
+            )
+        if store.current("ann_index"):
+            ann_version = _publish_ann_index(db_path, store, version, metadata)
+            if ann_version:
+                published["ann_index"] = ann_version
+        _built_versions[key] = version
+        if published:
+            print(f"Rebuilt {', '.join(published)} for catalog version {version}")
+        return published
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk upsert products into the catalog from CSV, NDJSON or Parquet")
+    parser.add_argument("path", help="Input file, or - for standard input")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    parser.add_argument("--format", choices=FORMATS, help="Input format (default from the file extension)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows per transaction")
+    parser.add_argument("--prune", action="store_true", help="Delete products missing from the input")
+    parser.add_argument("--artifacts", default=os.environ.get("ARTIFACT_DIR", "artifacts"),
+                        help="Artifact directory whose catalog-derived artifacts are rebuilt")
+    parser.add_argument("--no-rebuild", action="store_true", help="Skip rebuilding derived artifacts")
+    args = parser.parse_args()
+
+    fmt = args.format or detect_format(args.path)
+    if fmt is None:
+        parser.error("Cannot tell the input format; pass --format")
+    if args.path == "-":
+        stats = load_file(args.db, sys.stdin.buffer, fmt, args.batch_size, args.prune)
+    else:
+        with open(args.path, "rb") as f:
+            stats = load_file(args.db, f, fmt, args.batch_size, args.prune)
+
+    errors = stats.pop("errors")
+    print(json.dumps(stats))
+    for error in errors:
+        print(f"  record {error['record']}: {error['error']}")
+    if stats["changed"] and not args.no_rebuild:
+        from artifacts import ArtifactStore
+        rebuild_derived(args.db, ArtifactStore(args.artifacts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import catalog_loader
+import db
+
+MAX_PAGE_SIZE = 100
+# Pages kept in memory, across all filter combinations, for the current catalog version
+MAX_CACHED_PAGES = int(os.environ.get("CATALOG_PAGE_CACHE", "2000"))
+# How long a catalog version read from the database is trusted before it is read again
+VERSION_TTL_SECONDS = float(os.environ.get("CATALOG_VERSION_TTL", "1.0"))
+
+
+def init_db(cursor):
+    """Index for category listings
+
+    Index entries carry the rowid (product_id), so products of one category are
+    read in product_id order straight from the index, with no sort.
+    """
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_product_catalog_category
+        ON product_catalog (product_category COLLATE NOCASE)
+    ''')
+
+
+def fetch_page(db_path, category=None, min_price=None, max_price=None, after=0, limit=20):
+    """Products with product_id > after that pass the filters, in product_id order
+
+    Keyset pagination: the page starts with an index seek past `after` rather
+    than skipping rows with OFFSET, so page 1000 costs the same as page 1.
+    Returns the products and the cursor for the next page, or None on the last.
+    """
+    clauses, params = ["product_id > ?"], [after]
+    if category:
+        clauses.append("product_category = ? COLLATE NOCASE")
+        params.append(category)
+    if min_price is not None:
+        clauses.append("price >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        clauses.append("price <= ?")
+        params.append(max_price)
+
+    conn = db.connect(db_path)
+    cursor = conn.cursor()
+    # One row past the page tells whether another page exists
+    cursor.execute(f'''
+        SELECT product_id, product_name, product_category, price, description, tags
+        FROM product_catalog
+        WHERE {" AND ".join(clauses)}
+        ORDER BY product_id
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = cursor.fetchall()
+    conn.close()
+
+    products = [{
+        "product_id": row[0],
+        "product_name": row[1],
+        "category": row[2],
+        "price": row[3],
+        "description": row[4],
+        "tags": row[5],
+    } for row in rows[:limit]]
+    return {
+        "products": products,
+        "next_after": products[-1]["product_id"] if len(rows) > limit else None,
+    }
+
+
+class CatalogPages:
+    """Catalog listing pages cached in memory per catalog version
+
+    Pages are keyed by their filters and cursor. The catalog version is read at
+    most once per version_ttl seconds; when it changes, every cached page is
+    dropped. Within that window a repeated page does no database work at all.
+    Loads in this process call invalidate() so their changes show immediately;
+    other workers see them within version_ttl.
+    """
+
+    def __init__(self, db_path="customers.db", max_pages=MAX_CACHED_PAGES, version_ttl=VERSION_TTL_SECONDS):
+        self.db_path = db_path
+        self.max_pages = max_pages
+        self.version_ttl = version_ttl
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_read_at = 0.0
+
+    def version(self):
+        """Current catalog version, re-read from the database once version_ttl has passed"""
+        now = time.monotonic()
+        if self._version is None or now - self._version_read_at >= self.version_ttl:
+            version = catalog_loader.catalog_version(self.db_path)
+            with self._lock:
+                if version != self._version:
+                    self._pages.clear()
+                    self._version = version
+                self._version_read_at = now
+        return self._version
+
+    def invalidate(self):
+        """Drop every cached page and re-read the version on the next request"""
+        with self._lock:
+            self._pages.clear()
+            self._version = None
+
+    @staticmethod
+    def _key(category, min_price, max_price, after, limit):
+        return ((category or "").lower(), min_price, max_price, after, limit)
+
+    @staticmethod
+    def _etag(version, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        return f'"catalog-{version}-{digest}"'
+
+    def etag(self, category=None, min_price=None, max_price=None, after=0, limit=20):
+        """Strong ETag of a page: the catalog version plus a digest of its filters and cursor
+
+        Needs no page data, so a conditional request can be answered before any
+        page is fetched.
+        """
+        return self._etag(self.version(), self._key(category, min_price, max_price, after, limit))
+
+    def page(self, category=None, min_price=None, max_price=None, after=0, limit=20):
+        """(page, etag) for one listing page, from the cache when it holds the current version"""
+        version = self.version()
+        key = self._key(category, min_price, max_price, after, limit)
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+        if page is None:
+            page = fetch_page(self.db_path, category, min_price, max_price, after, limit)
+            page["version"] = version
+            with self._lock:
+                # Pages fetched while the version moved on are served but not kept
+                if self._version == version:
+                    self._pages[key] = page
+                    while len(self._pages) > self.max_pages:
+                        self._pages.popitem(last=False)
+        return page, self._etag(version, key)
@@ -0,0 +1,279 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+# Catalog fields stored as UTF-8 buffers, plus lowercased copies used for ranking
+STRING_COLUMNS = ("product_name", "category", "description", "tags")
+RANKING_COLUMNS = ("category_lower", "tags_lower")
+
+
+def _name_key(name):
+    """Signed 64-bit hash of a lowercased product name"""
+    digest = hashlib.blake2b((name or "").lower().encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def _mapped(path):
+    """Read-only mapping of a .npy file as a plain ndarray
+
+    The view skips np.memmap's per-item indexing overhead; the pages are still
+    the shared file mapping.
+    """
+    return np.load(path, mmap_mode="r").view(np.ndarray)
+
+
+class StringColumn:
+    """Read-only sequence of strings kept as one UTF-8 buffer plus offsets
+
+    The buffer is a read-only file mapping, so every process that opens the
+    same file shares its pages instead of holding its own string objects.
+    """
+
+    def __init__(self, buffer, offsets, nulls=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.nulls = nulls
+
+    @classmethod
+    def open(cls, path, name):
+        offsets = _mapped(os.path.join(path, f"{name}.offsets.npy"))
+        nulls_path = os.path.join(path, f"{name}.null.npy")
+        nulls = _mapped(nulls_path) if os.path.exists(nulls_path) else None
+        with open(os.path.join(path, f"{name}.bin"), "rb") as f:
+            # Zero-length files cannot be mapped
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b""
+        return cls(buffer, offsets, nulls)
+
+    @staticmethod
+    def write(path, name, values, with_nulls=False):
+        encoded = [(value or "").encode() for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        with open(os.path.join(path, f"{name}.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+        if with_nulls:
+            np.save(os.path.join(path, f"{name}.null.npy"), np.array([value is None for value in values], dtype=bool))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.buffer[int(self.offsets[i]):int(self.offsets[i + 1])].decode()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def positions_containing(self, needle):
+        """Positions whose string contains needle, in order, via a scan of the shared buffer"""
+        if not needle:
+            return np.arange(len(self), dtype=np.int64)
+        pattern = needle.encode()
+        starts = []
+        start = self.buffer.find(pattern)
+        while start != -1:
+            starts.append(start)
+            start = self.buffer.find(pattern, start + 1)
+        starts = np.array(starts, dtype=np.int64)
+        positions = np.searchsorted(self.offsets, starts, side="right") - 1
+        # Drop matches that run past the end of their product into the next one
+        inside = starts + len(pattern) <= self.offsets[positions + 1]
+        return np.unique(positions[inside])
+
+
+class _Rows:
+    """Lazy sequence of snapshot products at given positions"""
+
+    def __init__(self, snapshot, positions):
+        self.snapshot = snapshot
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        return self.snapshot[int(self.positions[i])]
+
+    def __iter__(self):
+        return (self.snapshot[int(i)] for i in self.positions)
+
+
+class CatalogSnapshot:
+    """Columnar, memory-mapped copy of product_catalog shared by all workers
+
+    Behaves as a read-only sequence of product dicts, built on access, so the
+    ranking code can use it in place of the list loaded from SQLite. Lookups by
+    category, product ID and name use arrays precomputed by the builder, so a
+    worker that attaches a snapshot allocates nothing proportional to the
+    catalog.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported catalog snapshot format {meta['format_version']} in {path}")
+        self.path = path
+        self.signature = meta["signature"]
+        # Distinct lowercased categories; small enough to hold per worker
+        self.categories = meta["categories"]
+        self._category_codes = {category: code for code, category in enumerate(self.categories)}
+
+        def array(name):
+            return _mapped(os.path.join(path, f"{name}.npy"))
+
+        self.product_ids = array("product_id")
+        self.prices = array("price")
+        self.price_nulls = array("price.null")
+        self.columns = {name: StringColumn.open(path, name) for name in STRING_COLUMNS + RANKING_COLUMNS}
+        self._category_positions = array("category_positions")
+        self._category_offsets = array("category_offsets")
+        self._sorted_ids = array("sorted_ids")
+        self._id_positions = array("id_positions")
+        self._name_keys = array("name_keys")
+        self._name_positions = array("name_positions")
+
+    @classmethod
+    def load(cls, path):
+        return cls(path)
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def __getitem__(self, i):
+        return {
+            "product_id": int(self.product_ids[i]),
+            "product_name": self.columns["product_name"][i],
+            "category": self.columns["category"][i],
+            "price": None if self.price_nulls[i] else float(self.prices[i]),
+            "description": self.columns["description"][i],
+            "tags": self.columns["tags"][i],
+        }
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def category_positions(self, category):
+        """Positions of products whose lowercased category equals category, in catalog order"""
+        code = self._category_codes.get(category)
+        if code is None:
+            return self._category_positions[:0]
+        return self._category_positions[self._category_offsets[code]:self._category_offsets[code + 1]]
+
+    def products_in_category(self, category):
+        return _Rows(self, self.category_positions(category.lower()))
+
+    def positions_of(self, product_ids):
+        """Catalog positions of product IDs, skipping IDs not in the snapshot"""
+        ids = np.asarray(list(product_ids), dtype=np.int64)
+        if not len(ids) or not len(self._sorted_ids):
+            return []
+        found = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self._sorted_ids) - 1)
+        hit = self._sorted_ids[found] == ids
+        return [int(position) for position in self._id_positions[found[hit]]]
+
+    def position_named(self, name):
+        """Position of the first product with the given name, case-insensitively, or None"""
+        key = _name_key(name)
+        name = (name or "").lower()
+        start = int(np.searchsorted(self._name_keys, key))
+        while start < len(self._name_keys) and self._name_keys[start] == key:
+            position = int(self._name_positions[start])
+            if (self.columns["product_name"][position] or "").lower() == name:
+                return position
+            start += 1
+        return None
+
+
+def build_snapshot(db_path, out):
+    """Write product_catalog as a snapshot directory, replacing any existing one; returns the product count"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    # Same query and order as RecommendationSystem._load_products
+    cursor.execute("SELECT * FROM product_catalog")
+    rows = cursor.fetchall()
+    conn.close()
+
+    tmp_path = f"{out}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    product_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    prices = [row[3] for row in rows]
+    np.save(os.path.join(tmp_path, "product_id.npy"), product_ids)
+    np.save(os.path.join(tmp_path, "price.npy"), np.array([price or 0 for price in prices], dtype=np.float64))
+    np.save(os.path.join(tmp_path, "price.null.npy"), np.array([price is None for price in prices], dtype=bool))
+
+    # Column positions in product_catalog: name, category, description, tags
+    columns = {name: [row[column] for row in rows] for name, column in zip(STRING_COLUMNS, (1, 2, 4, 5))}
+    for name in STRING_COLUMNS:
+        StringColumn.write(tmp_path, name, columns[name], with_nulls=True)
+    category_lower = [(category or "").lower() for category in columns["category"]]
+    StringColumn.write(tmp_path, "category_lower", category_lower)
+    StringColumn.write(tmp_path, "tags_lower", [(tags or "").lower() for tags in columns["tags"]])
+
+    # Positions grouped by category (stable, so catalog order within each group)
+    categories = sorted(set(category_lower))
+    code_of = {category: code for code, category in enumerate(categories)}
+    codes = np.fromiter((code_of[c] for c in category_lower), dtype=np.int64, count=len(category_lower))
+    np.save(os.path.join(tmp_path, "category_positions.npy"), np.argsort(codes, kind="stable"))
+    np.save(os.path.join(tmp_path, "category_offsets.npy"),
+            np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(categories)))]).astype(np.int64))
+
+    id_order = np.argsort(product_ids, kind="stable")
+    np.save(os.path.join(tmp_path, "sorted_ids.npy"), product_ids[id_order])
+    np.save(os.path.join(tmp_path, "id_positions.npy"), id_order.astype(np.int64))
+
+    # First position of each lowercased name, sorted by name hash for binary search
+    first_named = {}
+    for position, name in enumerate(columns["product_name"]):
+        first_named.setdefault((name or "").lower(), position)
+    name_keys = np.array([_name_key(name) for name in first_named], dtype=np.int64)
+    name_positions = np.array(list(first_named.values()), dtype=np.int64)
+    name_order = np.lexsort((name_positions, name_keys))
+    np.save(os.path.join(tmp_path, "name_keys.npy"), name_keys[name_order])
+    np.save(os.path.join(tmp_path, "name_positions.npy"), name_positions[name_order])
+
+    digest = hashlib.sha256()
+    for filename in sorted(os.listdir(tmp_path)):
+        digest.update(filename.encode())
+        with open(os.path.join(tmp_path, filename), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "format_version": FORMAT_VERSION,
+            "products": len(rows),
+            "categories": categories,
+            "signature": digest.hexdigest(),
+        }, f)
+
+    old_path = f"{out}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(out):
+        os.rename(out, old_path)
+    os.rename(tmp_path, out)
+    shutil.rmtree(old_path, ignore_errors=True)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a memory-mapped snapshot of the product catalog")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    parser.add_argument("--out", default="catalog_snapshot", help="Snapshot directory to write")
+    args = parser.parse_args()
+    print(f"Wrote {build_snapshot(args.db, args.out)} products to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import argparse
+import json
+import time
+from datetime import datetime
+
+import db
+import history_compaction
+
+# Browsing and purchase entries kept per customer, newest first
+RECENT_ITEMS = 10
+PROFILE_FIELDS = ("customer_id", "full_name", "email", "username", "phone_number", "age", "gender", "location")
+
+
+def init_db(cursor):
+    """Denormalized read model behind the profile endpoint, one row per customer
+
+    Rows are maintained by the write endpoints in the same transaction as the
+    rows they summarise, so a profile read is a single primary-key lookup.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customer_summary (
+            customer_id TEXT PRIMARY KEY,
+            profile TEXT NOT NULL,  -- JSON object of the customer_profiles row
+            addresses TEXT NOT NULL DEFAULT '[]',
+            recent_browsing TEXT NOT NULL DEFAULT '[]',  -- newest first, at most RECENT_ITEMS
+            recent_purchases TEXT NOT NULL DEFAULT '[]',  -- newest order_date first, at most RECENT_ITEMS
+            total_orders INTEGER NOT NULL DEFAULT 0,
+            total_spent FLOAT NOT NULL DEFAULT 0,
+            last_purchase_date TEXT,
+            segment TEXT,  -- JSON of the customer_segments row, NULL until the customer has one
+            version INTEGER NOT NULL DEFAULT 1,  -- bumped by every change, for ETags
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(customer_summary)")
+    if "version" not in {row[1] for row in cursor.fetchall()}:
+        # Tables created before summaries were versioned
+        cursor.execute("ALTER TABLE customer_summary ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+
+def _timestamp(value):
+    """A datetime as the text sqlite3 stores for it, so summary and history rows compare equal"""
+    return value.isoformat(" ") if isinstance(value, datetime) else value
+
+
+def _exists(cursor, customer_id):
+    cursor.execute("SELECT 1 FROM customer_summary WHERE customer_id = ?", (customer_id,))
+    return cursor.fetchone() is not None
+
+
+def rebuild(cursor, customer_id):
+    """Recompute a customer's summary from the source tables; False if the customer does not exist
+
+    Used to backfill customers created before the summary existed and to
+    recover from writes that bypassed it. Every other write patches the row.
+    """
+    cursor.execute(f"SELECT {', '.join(PROFILE_FIELDS)} FROM customer_profiles WHERE customer_id = ?",
+                   (customer_id,))
+    profile = cursor.fetchone()
+    if profile is None:
+        return False
+
+    cursor.execute('''
+        SELECT address_id, address_type, address FROM customer_addresses
+        WHERE customer_id = ?
+        ORDER BY address_id
+    ''', (customer_id,))
+    addresses = [{"address_id": row[0], "address_type": row[1], "address": row[2]} for row in cursor.fetchall()]
+
+    cursor.execute('''
+        SELECT category, timestamp FROM browsing_history
+        WHERE customer_id = ?
+        ORDER BY timestamp DESC
+        LIMIT ?
+    ''', (customer_id, RECENT_ITEMS))
+    browsing = [{"category": row[0], "timestamp": row[1]} for row in cursor.fetchall()]
+
+    cursor.execute('''
+        SELECT product_name, product_category, price, order_date FROM purchase_history
+        WHERE customer_id = ?
+        ORDER BY order_date DESC
+        LIMIT ?
+    ''', (customer_id, RECENT_ITEMS))
+    purchases = [{"product_name": row[0], "product_category": row[1], "price": float(row[2]), "order_date": row[3]}
+                 for row in cursor.fetchall()]
+
+    # Totals include purchases the compaction job has rolled up
+    total_orders, total_spent, last_purchase_date = history_compaction.purchase_totals(cursor, customer_id)
+
+    cursor.execute('''
+        INSERT OR REPLACE INTO customer_summary (
+            customer_id, profile, addresses, recent_browsing, recent_purchases,
+            total_orders, total_spent, last_purchase_date, segment, version, updated_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,
+                  COALESCE((SELECT version FROM customer_summary WHERE customer_id = ?), 0) + 1, datetime('now'))
+    ''', (
+        customer_id, json.dumps(dict(zip(PROFILE_FIELDS, profile))), json.dumps(addresses),
+        json.dumps(browsing), json.dumps(purchases), total_orders, total_spent, last_purchase_date,
+        _segment_json(cursor, customer_id), customer_id
+    ))
+    return True
+
+
+def set_profile(cursor, profile):
+    """Store a created or replaced profile; a customer without a summary row is rebuilt"""
+    if not _exists(cursor, profile["customer_id"]):
+        rebuild(cursor, profile["customer_id"])
+        return
+    cursor.execute('''
+        UPDATE customer_summary SET profile = ?, version = version + 1, updated_at = datetime('now')
+        WHERE customer_id = ?
+    ''', (json.dumps({field: profile[field] for field in PROFILE_FIELDS}), profile["customer_id"]))
+
+
+def add_address(cursor, customer_id, address_id, address_type, address):
+    """Append an address just inserted into customer_addresses"""
+    if not _exists(cursor, customer_id):
+        rebuild(cursor, customer_id)
+        return
+    cursor.execute('''
+        UPDATE customer_summary
+        SET addresses = json_insert(addresses, '$[#]', json(?)), version = version + 1, updated_at = datetime('now')
+        WHERE customer_id = ?
+    ''', (json.dumps({"address_id": address_id, "address_type": address_type, "address": address}), customer_id))
+
+
+def record_browsing(cursor, customer_id, category, timestamp):
+    """Push a browsing event onto the recent-browsing ring buffer"""
+    cursor.execute("SELECT recent_browsing FROM customer_summary WHERE customer_id = ?", (customer_id,))
+    row = cursor.fetchone()
+    if row is None:
+        rebuild(cursor, customer_id)
+        return
+    browsing = [{"category": category, "timestamp": _timestamp(timestamp)}] + json.loads(row[0])
+    cursor.execute('''
+        UPDATE customer_summary SET recent_browsing = ?, version = version + 1, updated_at = datetime('now')
+        WHERE customer_id = ?
+    ''', (json.dumps(browsing[:RECENT_ITEMS]), customer_id))
+
+
+def record_purchases(cursor, customer_id, purchases):
+    """Merge purchases into the recent-purchase ring buffer and the running totals
+
+    purchases are dicts with product_name, product_category, price and
+    order_date. They may be back-dated, so the buffer is re-sorted by
+    order_date rather than simply prepended to.
+    """
+    cursor.execute('''
+        SELECT recent_purchases, total_orders, total_spent, last_purchase_date FROM customer_summary
+        WHERE customer_id = ?
+    ''', (customer_id,))
+    row = cursor.fetchone()
+    if row is None:
+        rebuild(cursor, customer_id)
+        return
+    recent, total_orders, total_spent, last_purchase_date = [], row[1], row[2], row[3]
+    for purchase in purchases:
+        order_date = _timestamp(purchase["order_date"])
+        recent.insert(0, {
+            "product_name": purchase["product_name"],
+            "product_category": purchase["product_category"],
+            "price": float(purchase["price"]),
+            "order_date": order_date,
+        })
+        total_orders += 1
+        total_spent += purchase["price"]
+        if last_purchase_date is None or order_date > last_purchase_date:
+            last_purchase_date = order_date
+    # New purchases go in front and the sort is stable, so among equal dates the latest write comes first
+    recent += json.loads(row[0])
+    recent.sort(key=lambda purchase: purchase["order_date"], reverse=True)
+    cursor.execute('''
+        UPDATE customer_summary
+        SET recent_purchases = ?, total_orders = ?, total_spent = ?, last_purchase_date = ?,
+            version = version + 1, updated_at = datetime('now')
+        WHERE customer_id = ?
+    ''', (json.dumps(recent[:RECENT_ITEMS]), total_orders, total_spent, last_purchase_date, customer_id))
+
+
+def _segment_json(cursor, customer_id):
+    cursor.execute('''
+        SELECT customer_segment, avg_order_value, last_active_season FROM customer_segments
+        WHERE customer_id = ?
+    ''', (customer_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return json.dumps({"segment": row[0], "avg_order_value": row[1], "last_active_season": row[2]})
+
+
+def refresh_segment(cursor, customer_id):
+    """Copy the customer's customer_segments row into the summary after it was recomputed
+
+    The version is only bumped when the segment differs from the one stored;
+    returns whether it did.
+    """
+    cursor.execute('''
+        UPDATE customer_summary SET segment = :segment, version = version + 1, updated_at = datetime('now')
+        WHERE customer_id = :customer_id AND segment IS NOT :segment
+    ''', {"segment": _segment_json(cursor, customer_id), "customer_id": customer_id})
+    return cursor.rowcount == 1
+
+
+def version(cursor, customer_id):
+    """Version of a customer's summary, bumped by every write to it, or None if there is no row"""
+    cursor.execute("SELECT version FROM customer_summary WHERE customer_id = ?", (customer_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def etag(summary_version):
+    return f'"profile-{summary_version}"'
+
+
+def get(cursor, customer_id, versioned=False):
+    """The profile endpoint's response body for a customer, or None if there is no summary row
+
+    With versioned=True, returns (body, version) read from the same row.
+    """
+    cursor.execute('''
+        SELECT profile, addresses, recent_browsing, recent_purchases,
+               total_orders, total_spent, last_purchase_date, segment, version
+        FROM customer_summary
+        WHERE customer_id = ?
+    ''', (customer_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return (None, None) if versioned else None
+
+    segment = None
+    if row[7] is not None:
+        stored = json.loads(row[7])
+        segment = {
+            "segment": stored["segment"],
+            "avg_order_value": float(stored["avg_order_value"]),
+            "last_active_season": stored["last_active_season"],
+            "total_orders": row[4],
+            "total_spent": float(row[5]),
+            "last_purchase_date": row[6],
+        }
+    body = {
+        "profile": json.loads(row[0]),
+        "segment": segment,
+        "addresses": json.loads(row[1]),
+        "browsing_history": json.loads(row[2]),
+        "purchase_history": json.loads(row[3]),
+    }
+    return (body, row[8]) if versioned else body
+
+
+def rebuild_all(db_path, missing_only=True, batch_size=1000):
+    """Rebuild summaries for every customer (or only those without one); returns the number rebuilt"""
+    conn = db.connect(db_path)
+    cursor = conn.cursor()
+    init_db(cursor)
+    if missing_only:
+        cursor.execute('''
+            SELECT customer_id FROM customer_profiles
+            WHERE customer_id NOT IN (SELECT customer_id FROM customer_summary)
+        ''')
+    else:
+        cursor.execute("SELECT customer_id FROM customer_profiles")
+    customer_ids = [row[0] for row in cursor.fetchall()]
+    for start in range(0, len(customer_ids), batch_size):
+        for customer_id in customer_ids[start:start + batch_size]:
+            rebuild(cursor, customer_id)
+        conn.commit()
+    conn.close()
+    return len(customer_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill or rebuild the customer summary read model")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    parser.add_argument("--all", action="store_true", help="Rebuild every customer, not only those without a summary")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    count = rebuild_all(args.db, missing_only=not args.all)
+    print(f"Rebuilt {count} customer summaries in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from metrics import SQLITE_QUERIES, SQLITE_QUERY_DURATION
+from profiling import current_profile
+
+# Fraction of statements whose call site, duration and row count go into the aggregated
+# report; 0 disables it, 1.0 traces everything (benchmarks)
+SAMPLE_RATE = float(os.environ.get("SQL_TRACE_SAMPLE_RATE", "0"))
+# Statements slower than this (execute plus fetch) are logged with their query plan
+SLOW_QUERY_MS = float(os.environ.get("SQL_SLOW_QUERY_MS", "100"))
+# Query plans kept for slow-query log entries, least recently used dropped first
+MAX_CACHED_PLANS = 256
+
+_operation_children = {}
+_WHITESPACE = re.compile(r"\s+")
+
+
+def configure(sample_rate=None, slow_query_ms=None):
+    """Change tracing settings at runtime"""
+    global SAMPLE_RATE, SLOW_QUERY_MS
+    if sample_rate is not None:
+        SAMPLE_RATE = sample_rate
+    if slow_query_ms is not None:
+        SLOW_QUERY_MS = slow_query_ms
+
+
+def _children_for(sql):
+    """Counter and histogram children for a statement's leading keyword"""
+    operation = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "EMPTY"
+    children = _operation_children.get(operation)
+    if children is None:
+        children = _operation_children.setdefault(
+            operation, (SQLITE_QUERIES.labels(operation), SQLITE_QUERY_DURATION.labels(operation))
+        )
+    return children
+
+
+def _record(counter, histogram, elapsed):
+    histogram.observe(elapsed)
+    counter.inc()
+    profile = current_profile.get()
+    if profile is not None:
+        profile.record_query(elapsed)
+
+
+def _call_site():
+    """'file.py:line function' of the first caller outside this module"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+class QueryStats:
+    """Per (call site, statement) totals for sampled statements, plus recent slow queries"""
+
+    def __init__(self, slow_log_size=100, max_plans=MAX_CACHED_PLANS):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()
+        self.max_plans = max_plans
+        self.slow_queries = deque(maxlen=slow_log_size)
+
+    def add(self, call_site, sql, seconds, rows, executions=1):
+        key = (call_site, _WHITESPACE.sub(" ", sql).strip())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "rows": 0}
+            entry["count"] += executions
+            entry["total_seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["rows"] += rows
+
+    def plan_for(self, connection, sql, parameters):
+        """EXPLAIN QUERY PLAN of a statement, cached by its text"""
+        with self._lock:
+            plan = self._plans.get(sql)
+            if plan is not None:
+                self._plans.move_to_end(sql)
+                return plan
+        try:
+            # A plain cursor so the EXPLAIN itself is not traced
+            cursor = sqlite3.Cursor(connection)
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+            cursor.close()
+        except sqlite3.Error as e:
+            plan = [f"unavailable: {e}"]
+        with self._lock:
+            self._plans[sql] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def top(self, limit=20, order_by="total_seconds"):
+        """Statements ranked by total time (or count, max_seconds, rows)"""
+        with self._lock:
+            items = [
+                {"call_site": call_site, "sql": sql, **entry,
+                 "avg_ms": 1000 * entry["total_seconds"] / entry["count"] if entry["count"] else 0.0}
+                for (call_site, sql), entry in self._entries.items()
+            ]
+        items.sort(key=lambda item: item[order_by], reverse=True)
+        return items[:limit]
+
+    def report(self, limit=20):
+        """Top statements by total time as a fixed-width text table"""
+        lines = [f"{'total ms':>10} {'count':>7} {'avg ms':>8} {'max ms':>8} {'rows':>8}  call site / statement"]
+        for item in self.top(limit):
+            lines.append(
+                f"{item['total_seconds'] * 1000:>10.2f} {item['count']:>7} {item['avg_ms']:>8.3f} "
+                f"{item['max_seconds'] * 1000:>8.3f} {item['rows']:>8}  {item['call_site']}"
+            )
+            lines.append(f"{'':>46}{item['sql'][:160]}")
+        return "\n".join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+        self.slow_queries.clear()
+
+
+STATS = QueryStats()
+
+
+class _Statement:
+    """Tracing state for the statement a cursor last executed"""
+
+    __slots__ = ("sql", "parameters", "seconds", "call_site", "slow_logged")
+
+    def __init__(self, sql, parameters, seconds, call_site):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = seconds
+        self.call_site = call_site
+        self.slow_logged = False
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that counts and times every statement it executes
+
+    Sampled statements are also attributed to their call site with execute plus
+    fetch time and row counts; any statement exceeding the slow threshold is
+    logged together with its query plan.
+    """
+
+    _statement = None
+    # An unsampled statement gets a _Statement only once it turns out slow; until
+    # then its text, parameters and time so far are kept on the cursor
+    _sql = None
+    _parameters = None
+    _seconds = 0.0
+
+    def execute(self, sql, parameters=()):
+        counter, histogram = _children_for(sql)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            _record(counter, histogram, elapsed)
+            self._trace(sql, parameters, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        counter, histogram = _children_for(sql)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            _record(counter, histogram, elapsed)
+            self._trace(sql, None, elapsed)
+
+    def _trace(self, sql, parameters, elapsed):
+        if SAMPLE_RATE > 0 and (SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE):
+            statement = self._statement = _Statement(sql, parameters, elapsed, _call_site())
+            self._sql = None
+            # rowcount covers DML; SELECT rows are added as they are fetched
+            STATS.add(statement.call_site, sql, elapsed, max(self.rowcount, 0))
+            self._check_slow(statement)
+            return
+        self._statement = None
+        self._sql, self._parameters, self._seconds = sql, parameters, elapsed
+        self._check_unsampled()
+
+    def _check_unsampled(self):
+        if self._seconds * 1000 >= SLOW_QUERY_MS:
+            statement = self._statement = _Statement(self._sql, self._parameters, self._seconds, None)
+            self._sql = None
+            self._check_slow(statement)
+
+    def _after_fetch(self, elapsed, rows):
+        statement = self._statement
+        if statement is None:
+            if self._sql is not None:
+                self._seconds += elapsed
+                self._check_unsampled()
+            return
+        statement.seconds += elapsed
+        if statement.call_site is not None:
+            STATS.add(statement.call_site, statement.sql, elapsed, rows, executions=0)
+        self._check_slow(statement)
+
+    def _check_slow(self, statement):
+        if statement.slow_logged or statement.seconds * 1000 < SLOW_QUERY_MS:
+            return
+        statement.slow_logged = True
+        call_site = statement.call_site or _call_site()
+        plan = STATS.plan_for(self.connection, statement.sql, statement.parameters) \
+            if statement.parameters is not None else []
+        sql = _WHITESPACE.sub(" ", statement.sql).strip()
+        STATS.slow_queries.append({
+            "call_site": call_site,
+            "sql": sql,
+            "ms": round(statement.seconds * 1000, 3),
+            "plan": plan,
+            "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+        print(f"Slow query ({statement.seconds * 1000:.1f} ms) at {call_site}: {sql} | plan: {' / '.join(plan)}")
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._after_fetch(time.perf_counter() - start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._after_fetch(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._after_fetch(time.perf_counter() - start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._after_fetch(time.perf_counter() - start, 0)
+            raise
+        self._after_fetch(time.perf_counter() - start, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection handing out InstrumentedCursor objects
+
+    Connection.execute normally bypasses cursor(), so it is routed through it here.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect(db_path):
+    """Open an instrumented SQLite connection"""
+    return sqlite3.connect(db_path, factory=InstrumentedConnection)
+
+
+@contextmanager
+def sql_tracing(sample_rate=1.0, slow_query_ms=None, reset=True):
+    """Trace statements at the given rate for the duration of a block, e.g. in a benchmark
+
+        with db.sql_tracing():
+            run_workload()
+        print(db.STATS.report())
+    """
+    previous = (SAMPLE_RATE, SLOW_QUERY_MS)
+    if reset:
+        STATS.reset()
+    configure(sample_rate, slow_query_ms)
+    try:
+        yield STATS
+    finally:
+        configure(*previous)
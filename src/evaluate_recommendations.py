@@ -4,9 +4,10 @@ import json
 from datetime import datetime
 import random
 import time
+import os
 
-# Base URL for API
-BASE_URL = "http://127.0.0.1:8000"
+# Base URL for API (overridable so evaluations can target a server on another port)
+BASE_URL = os.environ.get("RECOMMENDATION_API_URL", "http://127.0.0.1:8000")
 
 def create_test_customers():
     """Create multiple test customers with different profiles"""
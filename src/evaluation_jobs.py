@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from evaluation_store import EvaluationStore, cached_offline_evaluation, parse_http_metrics
+from run_evaluation import run_server
+
+# Seconds between SSE keep-alive comments while a job is quiet
+KEEPALIVE_SECONDS = 15
+# Scoring processes one offline job may fork; jobs run on server threads, so this stays small
+MAX_WORKERS = int(os.environ.get("EVALUATION_MAX_WORKERS", "2"))
+
+
+def _free_port():
+    """Ask the OS for an unused local port"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class EvaluationJob:
+    """A single evaluation run and the ordered list of events it has produced"""
+
+    def __init__(self, kind, options):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.options = options
+        self.status = "queued"
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.events = []
+        self.result = None
+        self.error = None
+        self.closed = False
+
+    @property
+    def finished(self):
+        return self.status in ("completed", "failed")
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "options": self.options,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "events": len(self.events),
+            "error": self.error,
+        }
+
+
+class EvaluationJobManager:
+    """Runs evaluation jobs on a bounded thread pool and fans their events out to async subscribers
+
+    Jobs beyond max_concurrent wait in the pool's queue. Event producers run on worker
+    threads; subscribers wait on the event loop, so nothing here blocks the loop.
+    """
+
+    def __init__(self, db_path="customers.db", store=None, max_concurrent=2, max_jobs=50, max_workers=MAX_WORKERS):
+        self.db_path = db_path
+        self.store = store or EvaluationStore()
+        self.max_jobs = max_jobs
+        self.max_workers = max_workers
+        self.jobs = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="evaluation")
+        self._loop = None
+        self._changed = None
+        self._runners = {
+            "offline": self._run_offline,
+            "http": self._run_http,
+        }
+
+    def _checked_options(self, kind, options):
+        """Client-supplied options with the database fixed and the process count clamped to max_workers"""
+        options = dict(options or {})
+        if "db_path" in options:
+            raise ValueError("db_path cannot be set per job; jobs always evaluate the evaluator's database")
+        if kind != "offline":
+            return options
+        try:
+            workers = int(options.get("workers", self.max_workers))
+        except (TypeError, ValueError):
+            raise ValueError("workers must be an integer") from None
+        options["workers"] = max(1, min(workers, self.max_workers))
+        return options
+
+    def submit(self, kind="offline", options=None):
+        """Queue a new job; must be called from the event loop"""
+        if kind not in self._runners:
+            raise ValueError(f"Unknown evaluation kind: {kind}")
+        options = self._checked_options(kind, options)
+
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._changed = asyncio.Event()
+
+        job = EvaluationJob(kind, options)
+        self.jobs[job.job_id] = job
+        while len(self.jobs) > self.max_jobs:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if not oldest.finished:
+                break
+            del self.jobs[oldest_id]
+
+        self._emit(job, "status", {"status": job.status})
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _emit(self, job, event_type, data, final=False):
+        """Append an event to a job and wake subscribers; safe to call from any thread"""
+        job.events.append({"event": event_type, "data": data})
+        if final:
+            job.closed = True
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        # Swap in a fresh Event so waiters that already woke do not spin on a set flag
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _run(self, job):
+        job.status = "running"
+        job.started_at = datetime.now().isoformat()
+        self._emit(job, "status", {"status": job.status})
+        try:
+            job.result = self._runners[job.kind](job)
+            status = "completed"
+        except Exception as e:
+            job.error = str(e)
+            status = "failed"
+        job.finished_at = datetime.now().isoformat()
+        if status == "completed":
+            self._emit(job, "result", job.result)
+        # The status flips only now so subscribers never see a finished job without its result
+        job.status = status
+        self._emit(job, "status", {"status": job.status, "error": job.error}, final=True)
+
+    def _run_offline(self, job):
+        options = dict(job.options)
+        result = cached_offline_evaluation(
+            self.db_path,
+            store=self.store,
+            force=options.pop("force", False),
+            progress=lambda event: self._emit(job, event.pop("type"), event),
+            **options
+        )
+        if result["cached"]:
+            self._emit(job, "log", {"line": f"Dataset and config unchanged; reusing run {result['run_id']}"})
+        return result
+
+    def _run_http(self, job):
+        db_path = self.db_path
+        fingerprint = self.store.dataset_fingerprint(db_path)
+        started = time.perf_counter()
+        port = _free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        self._emit(job, "log", {"line": f"Starting recommendation server on {base_url}..."})
+        server = run_server(port)
+        self._emit(job, "log", {"line": "Server is ready"})
+
+        lines = []
+        try:
+            process = subprocess.Popen(
+                [sys.executable, "src/evaluate_recommendations.py"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                env=dict(os.environ, RECOMMENDATION_API_URL=base_url, PYTHONUNBUFFERED="1")
+            )
+            for line in process.stdout:
+                line = line.rstrip("\n")
+                lines.append(line)
+                self._emit(job, "log", {"line": line})
+            process.wait()
+        finally:
+            server.terminate()
+            server.wait()
+
+        output = "\n".join(lines)
+        if process.returncode != 0:
+            raise RuntimeError(f"Evaluation script exited with code {process.returncode}")
+
+        # End-to-end runs write test customers into the dataset, so they are recorded but never cached
+        result = {
+            "output": output,
+            "metrics": parse_http_metrics(output),
+            "timings": {"total_seconds": round(time.perf_counter() - started, 3)},
+        }
+        result["run_id"] = self.store.record_run("http", result, db_path, fingerprint, {})
+        return result
+
+    async def wait(self, job):
+        """Wait without blocking the event loop until a job has finished"""
+        async for _ in self.stream(job):
+            pass
+        return job
+
+    async def stream(self, job, start=0):
+        """Yield (index, event) pairs for a job, starting at start, until it finishes
+
+        Yields (None, None) as a keep-alive when no event arrives for a while.
+        """
+        index = start
+        while True:
+            while index < len(job.events):
+                yield index, job.events[index]
+                index += 1
+            if job.closed:
+                return
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield None, None
+
+
+def format_sse(index, event):
+    """Render one event in Server-Sent Events wire format"""
+    if event is None:
+        return ": keep-alive\n\n"
+    return f"id: {index}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
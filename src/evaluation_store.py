@@ -0,0 +1,357 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import uuid
+
+# Tables whose contents determine evaluation results
+FINGERPRINT_TABLES = [
+    "customer_profiles",
+    "customer_segments",
+    "browsing_history",
+    "purchase_history",
+    "product_catalog",
+    "browsing_rollup",
+    "purchase_rollup",
+    "purchase_product_rollup",
+]
+
+# Config keys that only change how an evaluation runs, not what it computes
+EXECUTION_ONLY_KEYS = {"workers", "chunk_size"}
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _stable_hash(value):
+    """SHA-256 of a JSON-serializable value with sorted keys"""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def code_version():
+    """Git commit of the source tree, marked '-dirty' with uncommitted changes, or 'unknown'"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SOURCE_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--", "."], cwd=SOURCE_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def code_hash():
+    """Hash of every Python source file next to this module
+
+    Used in cache keys instead of the git commit so uncommitted edits also
+    invalidate cached results.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(SOURCE_DIR, "*.py"))):
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _file_state(db_path):
+    """Size and mtime of the database file and its WAL, which change on every write"""
+    state = []
+    for path in (db_path, f"{db_path}-wal"):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            state.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return json.dumps(state)
+
+
+def _hash_tables(db_path):
+    """Stream every fingerprinted table in rowid order into one content hash"""
+    digest = hashlib.sha256()
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cursor.fetchall()}
+
+    for table in FINGERPRINT_TABLES:
+        digest.update(f"\0{table}\0".encode())
+        if table not in existing:
+            continue
+        cursor.execute(f"SELECT * FROM {table} ORDER BY rowid")
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for row in rows:
+                digest.update(repr(row).encode())
+
+    conn.close()
+    return digest.hexdigest()
+
+
+def _index_digest(path):
+    """Hash of a saved ANN index's meta.json plus the size and mtime of its arrays, or None if absent"""
+    if not path or not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        file_path = os.path.join(path, name)
+        if name == "meta.json":
+            with open(file_path, "rb") as f:
+                digest.update(f.read())
+        else:
+            stat = os.stat(file_path)
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def runtime_settings(db_path):
+    """Settings RecommendationSystem reads from the environment that change what it recommends"""
+    from recommendation_system import RecommendationSystem
+
+    system = RecommendationSystem(db_path, init_schema=False)
+    rules = system.filter_rules
+    return {
+        "filter_rules": {
+            "min_price": rules.min_price,
+            "max_price": rules.max_price,
+            "blocked_categories": sorted(rules.blocked_categories),
+            "exclude_purchased": rules.exclude_purchased,
+        },
+        "fts_candidates": system.fts_candidates,
+        "ann_index": _index_digest(system.ann_index_path),
+    }
+
+
+class EvaluationStore:
+    """Structured history of evaluation runs, doubling as a result cache"""
+
+    def __init__(self, db_path="evaluations.db"):
+        self.db_path = db_path
+        self.init_db()
+
+    def get_connection(self):
+        return sqlite3.connect(self.db_path)
+
+    def init_db(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        # One row per evaluation run
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS evaluation_runs (
+                run_id TEXT PRIMARY KEY,
+                kind TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                code_version TEXT,
+                code_hash TEXT,
+                dataset_path TEXT,
+                dataset_fingerprint TEXT,
+                config TEXT,
+                cache_key TEXT,
+                metrics TEXT,
+                timings TEXT,
+                result TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_evaluation_runs_cache_key
+            ON evaluation_runs (cache_key, created_at)
+        ''')
+
+        # Last computed fingerprint per database file, reused while the file is untouched
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dataset_fingerprints (
+                dataset_path TEXT PRIMARY KEY,
+                file_state TEXT,
+                fingerprint TEXT
+            )
+        ''')
+
+        conn.commit()
+        conn.close()
+
+    def dataset_fingerprint(self, db_path):
+        """Content fingerprint of a dataset, recomputed only when the file has changed"""
+        dataset_path = os.path.abspath(db_path)
+        file_state = _file_state(db_path)
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT fingerprint FROM dataset_fingerprints
+            WHERE dataset_path = ? AND file_state = ?
+        ''', (dataset_path, file_state))
+        row = cursor.fetchone()
+        if row:
+            conn.close()
+            return row[0]
+
+        fingerprint = _hash_tables(db_path)
+        cursor.execute('''
+            INSERT OR REPLACE INTO dataset_fingerprints (dataset_path, file_state, fingerprint)
+            VALUES (?, ?, ?)
+        ''', (dataset_path, file_state, fingerprint))
+        conn.commit()
+        conn.close()
+        return fingerprint
+
+    @staticmethod
+    def cache_key(kind, fingerprint, config, source_hash):
+        """Key identifying runs that must produce identical results"""
+        result_config = {k: v for k, v in config.items() if k not in EXECUTION_ONLY_KEYS}
+        return _stable_hash([kind, fingerprint, result_config, source_hash])
+
+    def record_run(self, kind, result, dataset_path, fingerprint, config, cache_key=None):
+        """Store a finished run and return its ID"""
+        run_id = uuid.uuid4().hex[:12]
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO evaluation_runs
+            (run_id, kind, created_at, code_version, code_hash, dataset_path, dataset_fingerprint,
+             config, cache_key, metrics, timings, result)
+            VALUES (?, ?, datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            run_id, kind, code_version(), code_hash(), os.path.abspath(dataset_path), fingerprint,
+            json.dumps(config), cache_key, json.dumps(result.get("metrics", {})),
+            json.dumps(result.get("timings", {})), json.dumps(result)
+        ))
+        conn.commit()
+        conn.close()
+        return run_id
+
+    def find_cached(self, cache_key):
+        """Most recent run with the given cache key, or None"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT run_id FROM evaluation_runs
+            WHERE cache_key = ?
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', (cache_key,))
+        row = cursor.fetchone()
+        conn.close()
+        return self.get_run(row[0]) if row else None
+
+    def get_run(self, run_id):
+        """Full record of a run, or None"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT run_id, kind, created_at, code_version, code_hash, dataset_path,
+                   dataset_fingerprint, config, metrics, timings, result
+            FROM evaluation_runs WHERE run_id = ?
+        ''', (run_id,))
+        row = cursor.fetchone()
+        conn.close()
+        if not row:
+            return None
+        return {
+            "run_id": row[0],
+            "kind": row[1],
+            "created_at": row[2],
+            "code_version": row[3],
+            "code_hash": row[4],
+            "dataset_path": row[5],
+            "dataset_fingerprint": row[6],
+            "config": json.loads(row[7]),
+            "metrics": json.loads(row[8]),
+            "timings": json.loads(row[9]),
+            "result": json.loads(row[10]),
+        }
+
+    def list_runs(self, limit=50):
+        """Summaries of the most recent runs, newest first"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT run_id, kind, created_at, code_version, dataset_fingerprint, metrics, timings
+            FROM evaluation_runs
+            ORDER BY created_at DESC
+            LIMIT ?
+        ''', (limit,))
+        rows = cursor.fetchall()
+        conn.close()
+        return [{
+            "run_id": row[0],
+            "kind": row[1],
+            "created_at": row[2],
+            "code_version": row[3],
+            "dataset_fingerprint": row[4][:12] if row[4] else None,
+            "metrics": json.loads(row[5]),
+            "timings": json.loads(row[6]),
+        } for row in rows]
+
+    def diff_runs(self, base_run_id, other_run_id):
+        """Compare quality metrics and timings of two runs; None if either is missing"""
+        base = self.get_run(base_run_id)
+        other = self.get_run(other_run_id)
+        if not base or not other:
+            return None
+
+        def compare(base_values, other_values):
+            diff = {}
+            for name in sorted(set(base_values) | set(other_values)):
+                a, b = base_values.get(name), other_values.get(name)
+                entry = {"base": a, "other": b, "delta": None, "relative": None}
+                if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+                    entry["delta"] = b - a
+                    entry["relative"] = (b - a) / a if a else None
+                diff[name] = entry
+            return diff
+
+        return {
+            "base": {key: base[key] for key in ("run_id", "kind", "created_at", "code_version", "dataset_fingerprint")},
+            "other": {key: other[key] for key in ("run_id", "kind", "created_at", "code_version", "dataset_fingerprint")},
+            "same_dataset": base["dataset_fingerprint"] == other["dataset_fingerprint"],
+            "same_code": base["code_hash"] == other["code_hash"],
+            "config_changes": {
+                key: {"base": base["config"].get(key), "other": other["config"].get(key)}
+                for key in sorted(set(base["config"]) | set(other["config"]))
+                if base["config"].get(key) != other["config"].get(key)
+            },
+            "metrics": compare(base["metrics"], other["metrics"]),
+            "timings": compare(base["timings"], other["timings"]),
+        }
+
+
+def cached_offline_evaluation(db_path="customers.db", store=None, force=False, progress=None, **overrides):
+    """Run an offline evaluation, or return the stored result of an identical earlier run
+
+    Runs are identical when the dataset fingerprint, the result-affecting config
+    (including the environment's filter rules, candidate settings and ANN index)
+    and the source code all match. Every fresh run is recorded in the store.
+    """
+    from offline_evaluation import evaluate, resolve_config
+
+    store = store or EvaluationStore()
+    config = resolve_config(**overrides)
+    fingerprint = store.dataset_fingerprint(db_path)
+    key = store.cache_key("offline", fingerprint, dict(config, **runtime_settings(db_path)), code_hash())
+
+    if not force:
+        cached = store.find_cached(key)
+        if cached:
+            return dict(cached["result"], run_id=cached["run_id"], cached=True)
+
+    result = evaluate(db_path, progress=progress, **overrides)
+    run_id = store.record_run("offline", result, db_path, fingerprint, config, cache_key=key)
+    return dict(result, run_id=run_id, cached=False)
+
+
+def parse_http_metrics(output):
+    """Pull the relevance scores out of evaluate_recommendations.py output"""
+    metrics = {}
+    for customer_id, score in re.findall(r"\((\w+)\):\n(?:.*\n){2}\s+Relevance score: ([\d.]+)%", output):
+        metrics[f"relevance:{customer_id}"] = float(score) / 100
+    average = re.search(r"Average relevance score: ([\d.]+)%", output)
+    if average:
+        metrics["average_relevance"] = float(average.group(1)) / 100
+    return metrics
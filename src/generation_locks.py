@@ -0,0 +1,47 @@
+import os
+import time
+import uuid
+
+# A lock left behind by a worker that died is taken over after this many seconds
+LOCK_TTL_SECONDS = float(os.environ.get("GENERATION_LOCK_TTL", "30"))
+# How often a worker waiting on another worker's generation checks for its result
+POLL_SECONDS = 0.05
+
+
+def init_db(cursor):
+    """Leases that let one worker at a time generate recommendations for a customer"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_locks (
+            lock_key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL  -- Unix time the lease lapses if it is not released
+        )
+    ''')
+
+
+def new_owner():
+    return f"{os.getpid()}-{uuid.uuid4().hex}"
+
+
+def acquire(conn, key, owner, ttl=LOCK_TTL_SECONDS):
+    """Take the lease on key unless another owner holds an unexpired one; True if taken"""
+    now = time.time()
+    cursor = conn.execute('''
+        INSERT INTO generation_locks (lock_key, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT (lock_key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE generation_locks.expires_at < ?
+    ''', (key, owner, now + ttl, now))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def release(conn, key, owner):
+    """Give up a lease; a lease that lapsed and was taken over is left to its new owner"""
+    conn.execute("DELETE FROM generation_locks WHERE lock_key = ? AND owner = ?", (key, owner))
+    conn.commit()
+
+
+def is_held(conn, key):
+    cursor = conn.execute("SELECT 1 FROM generation_locks WHERE lock_key = ? AND expires_at >= ?",
+                          (key, time.time()))
+    return cursor.fetchone() is not None
@@ -0,0 +1,278 @@
+import argparse
+import os
+import sqlite3
+import time
+
+import db
+
+# Raw events younger than these are kept; they match the windows _get_customer_data reads
+BROWSING_RETENTION_DAYS = int(os.environ.get("BROWSING_RETENTION_DAYS", "30"))
+PURCHASE_RETENTION_DAYS = int(os.environ.get("PURCHASE_RETENTION_DAYS", "180"))
+# Raw rows rolled up and removed per write transaction
+BATCH_SIZE = 5000
+# Pause between transactions so request writes are not starved while the job runs
+BATCH_PAUSE_SECONDS = 0.01
+# Free pages returned to the filesystem per incremental_vacuum step
+VACUUM_STEP_PAGES = 2000
+
+# Start of the rollup bucket an event timestamp falls into (weeks start on Monday)
+PERIODS = {
+    "day": "date({column})",
+    "week": "date({column}, 'weekday 0', '-6 days')",
+}
+
+# Raw table -> (key column, time column, rollups); each rollup is
+# (rollup table, grouping columns, rollup aggregates, condition on the raw rows or None)
+HISTORY_TABLES = {
+    "browsing_history": ("history_id", "timestamp", [
+        ("browsing_rollup", ("category",), {"views": "COUNT(*)"}, None),
+    ]),
+    "purchase_history": ("order_id", "order_date", [
+        ("purchase_rollup", ("product_category",),
+         {"orders": "COUNT(*)", "spent": "SUM(price)", "last_order_date": "MAX(order_date)"}, None),
+        # Which products were bought, for the similar-shopper and factor model rebuilds; purchases
+        # never linked to the catalog only count in purchase_rollup
+        ("purchase_product_rollup", ("product_id",), {"orders": "COUNT(*)"}, "product_id IS NOT NULL"),
+    ]),
+}
+# How an existing rollup row absorbs a new batch of the same customer, period and category
+MERGE = {
+    "views": "views + excluded.views",
+    "orders": "orders + excluded.orders",
+    "spent": "spent + excluded.spent",
+    "last_order_date": "MAX(last_order_date, excluded.last_order_date)",
+}
+
+
+def init_db(cursor):
+    """Per-customer category and product counts for history older than the serving windows
+
+    Rows are keyed by customer, period start date and category (or product).
+    The period is a day or a week, depending on how the compaction job was
+    run; totals simply add up across both.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS browsing_rollup (
+            customer_id TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            category TEXT NOT NULL,
+            views INTEGER NOT NULL,
+            PRIMARY KEY (customer_id, period_start, category)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purchase_rollup (
+            customer_id TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            product_category TEXT NOT NULL,
+            orders INTEGER NOT NULL,
+            spent FLOAT NOT NULL,
+            last_order_date DATETIME NOT NULL,
+            PRIMARY KEY (customer_id, period_start, product_category)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purchase_product_rollup (
+            customer_id TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            product_id INTEGER NOT NULL,
+            orders INTEGER NOT NULL,
+            PRIMARY KEY (customer_id, period_start, product_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+def existing_rollups(cursor):
+    """Names of the rollup tables in the database; ones created before a rollup was added lack it"""
+    rollups = [rollup[0] for _, _, table_rollups in HISTORY_TABLES.values() for rollup in table_rollups]
+    cursor.execute(f"SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({','.join('?' * len(rollups))})",
+                   rollups)
+    return {row[0] for row in cursor.fetchall()}
+
+
+def purchase_totals(cursor, customer_id):
+    """(orders, total spent, last order date) over raw and rolled-up purchases"""
+    cursor.execute('''
+        SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(spent), 0), MAX(last_order_date) FROM (
+            SELECT COUNT(*) AS orders, SUM(price) AS spent, MAX(order_date) AS last_order_date
+            FROM purchase_history WHERE customer_id = ?
+            UNION ALL
+            SELECT SUM(orders), SUM(spent), MAX(last_order_date)
+            FROM purchase_rollup WHERE customer_id = ?
+        )
+    ''', (customer_id, customer_id))
+    return cursor.fetchone()
+
+
+def compact_table(conn, table, retention_days, period="week", archive=False,
+                  batch_size=BATCH_SIZE, pause=BATCH_PAUSE_SECONDS, stop=None):
+    """Roll raw events older than retention_days into the table's rollups and delete them
+
+    Works through the table in key order, one short IMMEDIATE transaction per
+    batch, so other writers wait at most one batch. Each batch is bounded by
+    a key range: the rows rolled up, archived and deleted are exactly the ones
+    selected. Stops between batches once stop (a threading.Event) is set.
+    Returns the number of rows compacted.
+    """
+    key, time_column, rollups = HISTORY_TABLES[table]
+    period_expression = PERIODS[period].format(column=time_column)
+    cutoff = f"-{retention_days} days"
+    in_batch = f"{key} > ? AND {key} <= ? AND {time_column} < datetime('now', ?) AND customer_id IS NOT NULL"
+    rollup_statements = []
+    for rollup, group_columns, aggregates, condition in rollups:
+        group_by = ", ".join(str(position) for position in range(1, len(group_columns) + 3))
+        rollup_columns = ", ".join(["customer_id", "period_start", *group_columns, *aggregates])
+        # NULL categories are kept in the rollup as empty strings, since they are part of its key
+        selected = ", ".join(["customer_id", period_expression,
+                              *(f"COALESCE({column}, '')" for column in group_columns),
+                              *aggregates.values()])
+        updates = ", ".join(f"{column} = {MERGE[column]}" for column in aggregates)
+        rolled_up = f"{in_batch} AND {condition}" if condition else in_batch
+        # WHERE ... true: keeps SQLite from reading ON CONFLICT as a join constraint
+        rollup_statements.append(f'''
+            INSERT INTO {rollup} ({rollup_columns})
+            SELECT {selected} FROM {table}
+            WHERE {rolled_up} AND true
+            GROUP BY {group_by}
+            ON CONFLICT DO UPDATE SET {updates}
+        ''')
+
+    cursor = conn.cursor()
+    if archive:
+        # Same columns as the raw table, no constraints: rows are only ever appended
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0")
+    compacted, last_key = 0, 0
+    while stop is None or not stop.is_set():
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(f'''
+                SELECT COUNT(*), MAX({key}) FROM (
+                    SELECT {key} FROM {table}
+                    WHERE {key} > ? AND {time_column} < datetime('now', ?) AND customer_id IS NOT NULL
+                    ORDER BY {key}
+                    LIMIT ?
+                )
+            ''', (last_key, cutoff, batch_size))
+            count, batch_end = cursor.fetchone()
+            if not count:
+                cursor.execute("COMMIT")
+                break
+            params = (last_key, batch_end, cutoff)
+            for statement in rollup_statements:
+                cursor.execute(statement, params)
+            if archive:
+                cursor.execute(f"INSERT INTO archive.{table} SELECT * FROM {table} WHERE {in_batch}", params)
+            cursor.execute(f"DELETE FROM {table} WHERE {in_batch}", params)
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        compacted += count
+        last_key = batch_end
+        if pause:
+            time.sleep(pause)
+    return compacted
+
+
+def incremental_vacuum(conn, step_pages=VACUUM_STEP_PAGES, pause=BATCH_PAUSE_SECONDS):
+    """Return free pages to the filesystem a step at a time; the number of pages freed
+
+    Only works on databases with auto_vacuum=INCREMENTAL (see enable_incremental_vacuum);
+    elsewhere deleted pages stay on the free list and are reused by later inserts.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] != 2:
+        return 0
+    cursor.execute("PRAGMA freelist_count")
+    free_pages, freed = cursor.fetchone()[0], 0
+    while free_pages:
+        # executescript steps the pragma to completion; execute() would free a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({min(free_pages, step_pages)})")
+        cursor.execute("PRAGMA freelist_count")
+        remaining = cursor.fetchone()[0]
+        if remaining >= free_pages:
+            # Nothing released, e.g. another connection holds a lock; the next run retries
+            break
+        freed += free_pages - remaining
+        free_pages = remaining
+        if pause:
+            time.sleep(pause)
+    return freed
+
+
+def enable_incremental_vacuum(conn):
+    """Switch an existing database to auto_vacuum=INCREMENTAL
+
+    Takes effect through a full VACUUM, which rewrites the file under an
+    exclusive lock: run it once, off-peak. New databases get the mode from
+    the schema step.
+    """
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def compact(db_path, browsing_days=BROWSING_RETENTION_DAYS, purchase_days=PURCHASE_RETENTION_DAYS,
+            period="week", archive_path=None, batch_size=BATCH_SIZE, vacuum=True, stop=None):
+    """Roll up and remove old browsing and purchase history, then release the freed pages
+
+    With archive_path, removed rows are copied to the same tables in that
+    database first. Setting stop (a threading.Event) ends the run after the
+    current batch. Returns counts of compacted rows and vacuumed pages.
+    """
+    conn = db.connect(db_path)
+    # Transactions are managed explicitly, one per batch
+    conn.isolation_level = None
+    init_db(conn.cursor())
+    if archive_path:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    try:
+        stats = {
+            "browsing_history": compact_table(conn, "browsing_history", browsing_days, period,
+                                              bool(archive_path), batch_size, stop=stop),
+            "purchase_history": compact_table(conn, "purchase_history", purchase_days, period,
+                                              bool(archive_path), batch_size, stop=stop),
+        }
+        stopped = stop is not None and stop.is_set()
+        stats["vacuumed_pages"] = incremental_vacuum(conn) if vacuum and not stopped else 0
+    finally:
+        conn.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Roll up browsing and purchase history older than the serving windows")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    parser.add_argument("--browsing-days", type=int, default=BROWSING_RETENTION_DAYS,
+                        help="Raw browsing events younger than this are kept")
+    parser.add_argument("--purchase-days", type=int, default=PURCHASE_RETENTION_DAYS,
+                        help="Raw purchases younger than this are kept")
+    parser.add_argument("--period", choices=sorted(PERIODS), default="week", help="Rollup bucket size")
+    parser.add_argument("--archive", help="Copy removed rows into this database instead of discarding them")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows per write transaction")
+    parser.add_argument("--no-vacuum", action="store_true", help="Skip the incremental vacuum")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="Switch the database to auto_vacuum=INCREMENTAL with a full VACUUM, then exit")
+    args = parser.parse_args()
+
+    if args.enable_incremental_vacuum:
+        conn = db.connect(args.db)
+        conn.isolation_level = None
+        start = time.perf_counter()
+        enable_incremental_vacuum(conn)
+        conn.close()
+        print(f"Enabled incremental vacuum in {time.perf_counter() - start:.2f}s")
+        return
+
+    start = time.perf_counter()
+    try:
+        stats = compact(args.db, args.browsing_days, args.purchase_days, args.period, args.archive,
+                        args.batch_size, vacuum=not args.no_vacuum)
+    except sqlite3.OperationalError as e:
+        raise SystemExit(f"Compaction stopped: {e}")
+    print(f"Compacted {stats['browsing_history']} browsing events and {stats['purchase_history']} purchases, "
+          f"vacuumed {stats['vacuumed_pages']} pages in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
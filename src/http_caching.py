@@ -0,0 +1,70 @@
+import json
+
+from fastapi.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # optional; the standard library encoder is the fallback
+    orjson = None
+
+
+def _default(value):
+    # NumPy scalars from the ranking code
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value):
+    """Compact JSON as UTF-8 bytes, encoded by orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with dumps(); the app's default response class"""
+
+    def render(self, content):
+        return dumps(content)
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches an ETag
+
+    Uses the weak comparison RFC 9110 asks for with If-None-Match, so a W/
+    prefix on either side is ignored.
+    """
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == opaque:
+            return True
+    return False
+
+
+def cache_headers(etag=None, cache_control=None):
+    headers = {}
+    if etag:
+        headers["ETag"] = etag
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    return headers
+
+
+def not_modified(etag, cache_control=None):
+    """Empty 304 carrying the same validators a 200 would have"""
+    return Response(status_code=304, headers=cache_headers(etag, cache_control))
+
+
+def json_response(body, etag=None, cache_control=None):
+    """Serialize body, or send it as-is if it is already rendered JSON bytes"""
+    if not isinstance(body, bytes):
+        body = dumps(body)
+    return Response(body, media_type="application/json", headers=cache_headers(etag, cache_control))
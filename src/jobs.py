@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+
+import history_compaction
+import segments
+from artifacts import ArtifactRegistry, ArtifactStore, build_popularity, popularity_table
+from recommendation_system import RecommendationSystem
+from scheduler import Scheduler
+
+# Default periods in seconds; each can be overridden with JOB_<NAME>_SECONDS, 0 for on demand only
+SEGMENT_REBUILD_SECONDS = 3600
+PRECOMPUTE_SECONDS = 300
+POPULARITY_REFRESH_SECONDS = 3600
+RETENTION_SECONDS = 900
+# Compaction rewrites a lot of history; it runs when an operator asks unless given a period
+COMPACTION_SECONDS = 0
+
+# Customers active this recently get their sets generated ahead of their next request
+PRECOMPUTE_ACTIVE_DAYS = int(os.environ.get("PRECOMPUTE_ACTIVE_DAYS", "7"))
+# Sets expiring within this long are regenerated early
+PRECOMPUTE_LEAD = timedelta(hours=float(os.environ.get("PRECOMPUTE_LEAD_HOURS", "2")))
+# Customers precomputed per run, so a run stays shorter than its interval
+PRECOMPUTE_BATCH = int(os.environ.get("PRECOMPUTE_BATCH", "200"))
+
+
+def precompute_recommendations(recommendation_system, stop, limit=PRECOMPUTE_BATCH):
+    """Generate and store sets for recently active customers before they expire; the number generated"""
+    generated = 0
+    for customer_id in recommendation_system.precompute_candidates(PRECOMPUTE_ACTIVE_DAYS, PRECOMPUTE_LEAD, limit):
+        if stop.is_set():
+            break
+        recommendation_system.generate_recommendations_once(customer_id)
+        generated += 1
+    return generated
+
+
+def refresh_popularity(db_path, artifacts):
+    """Publish a new popularity artifact when the segment table has changed, and swap it in here
+
+    Other workers pick the new version up on their next watcher poll.
+    """
+    table = popularity_table(db_path)
+    if table == artifacts.get("popularity"):
+        return "unchanged"
+    version = artifacts.store.publish_built("popularity", lambda out: build_popularity(db_path, out))
+    artifacts.refresh("popularity")
+    return version
+
+
+def build_scheduler(db_path, recommendation_system, artifacts):
+    """The scheduler with every maintenance and precompute job registered, not yet started"""
+    scheduler = Scheduler(db_path)
+    scheduler.register("segment_rebuild",
+                       lambda stop: segments.rebuild_segments(db_path, stop=stop),
+                       SEGMENT_REBUILD_SECONDS)
+    scheduler.register("recommendation_precompute",
+                       lambda stop: precompute_recommendations(recommendation_system, stop),
+                       PRECOMPUTE_SECONDS)
+    scheduler.register("popularity_refresh",
+                       lambda stop: refresh_popularity(db_path, artifacts),
+                       POPULARITY_REFRESH_SECONDS)
+    scheduler.register("recommendation_retention",
+                       lambda stop: recommendation_system.prune_recommendations(stop=stop),
+                       RETENTION_SECONDS)
+    scheduler.register("compaction",
+                       lambda stop: history_compaction.compact(db_path, stop=stop),
+                       COMPACTION_SECONDS)
+    return scheduler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List or run the service's background jobs once")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    parser.add_argument("--artifact-dir", default=os.environ.get("ARTIFACT_DIR", "artifacts"), help="Artifact directory")
+    parser.add_argument("job", nargs="?", help="Job to run; lists the jobs when omitted")
+    args = parser.parse_args()
+
+    artifacts = ArtifactRegistry(ArtifactStore(args.artifact_dir))
+    artifacts.refresh_all()
+    recommendation_system = RecommendationSystem(args.db, artifacts=artifacts, init_schema=False)
+    scheduler = build_scheduler(args.db, recommendation_system, artifacts)
+    if not args.job:
+        for job in scheduler.jobs.values():
+            print(f"{job.name}: {f'every {job.interval:g}s' if job.interval else 'on demand'}")
+        return
+    if args.job not in scheduler.jobs:
+        raise SystemExit(f"Unknown job {args.job}; choose from {', '.join(scheduler.jobs)}")
+    start = time.perf_counter()
+    result = scheduler.jobs[args.job].fn(threading.Event())
+    print(f"{args.job} finished in {time.perf_counter() - start:.2f}s: {json.dumps(result)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,70 @@
 
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi.responses import Response
 from pydantic import BaseModel
 from typing import List, Optional
-import sqlite3
-from datetime import datetime
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 
 # Import the recommendation router
-from recommendation_api import recommendation_router, initialize_recommendation_database
+from recommendation_api import (recommendation_router, initialize_recommendation_database, artifacts, preload_modules,
+                                recommendation_system)
+from catalog_api import catalog_router
+import customer_summary
+import db
+import history_compaction
+import jobs
+import product_links
+import http_caching
+import metrics
+import segments
+from metrics import stage_timer
+from profiling import ProfilingMiddleware
 
-app = FastAPI()
+# Skip schema setup at startup; the database must have been prepared with `python main.py --init-db`
+FAST_START = os.environ.get("FAST_START", "0") == "1"
+
+@asynccontextmanager
+async def lifespan(app):
+    if not FAST_START:
+        init_schema()
+    preload_modules()
+    # Load published artifacts in the background and keep watching for new versions
+    artifacts.start()
+    scheduler.start()
+    # Shed requests fall back to the popularity artifact; publish one now rather than at the first hourly run.
+    # Leased, so that of several workers starting together only one builds it
+    if artifacts.store.current("popularity") is None:
+        scheduler.run_now("popularity_refresh", leased=True)
+    yield
+    # Long jobs stop at their next batch boundary; waiting for them must not block the loop
+    await asyncio.to_thread(scheduler.stop)
+    artifacts.stop()
+
+# Responses that still need serializing are encoded with orjson when it is installed
+app = FastAPI(lifespan=lifespan, default_response_class=http_caching.FastJSONResponse)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 class CustomerAgent:
-    def __init__(self, db_path="customers.db"):
+    def __init__(self, db_path="customers.db", init_schema=True):
         self.db_path = db_path
-        self.init_db()
+        if init_schema:
+            self.init_db()
     
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        return db.connect(self.db_path)
     
     def init_db(self):
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # Lets the compaction job hand freed pages back with incremental_vacuum; only takes
+        # effect on a new database (existing ones: history_compaction.py --enable-incremental-vacuum)
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        
         # Customer Profiles Table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS customer_profiles (
@@ -76,10 +119,23 @@ class CustomerAgent:
                 product_category TEXT,
                 price FLOAT,
                 order_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+                product_id INTEGER,  -- product_catalog ID, resolved from product_name at ingestion
                 FOREIGN KEY (customer_id) REFERENCES customer_profiles(customer_id) ON DELETE CASCADE
             )
         ''')
         
+        # Per-customer browsing lookups (summary rebuilds, recent browsing)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_browsing_history_customer
+            ON browsing_history (customer_id, timestamp)
+        ''')
+        
+        # Per-customer purchase lookups (similar-shopper suggestions, recent purchases)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_purchase_history_customer
+            ON purchase_history (customer_id, order_date)
+        ''')
+        
         # Customer Segments Table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS customer_segments (
@@ -91,11 +147,26 @@ class CustomerAgent:
             )
         ''')
         
+        # Profile read model, maintained by the write endpoints below
+        customer_summary.init_db(cursor)
+        
+        # Rolled-up history older than the serving windows (history_compaction.py)
+        history_compaction.init_db(cursor)
+        
         conn.commit()
         conn.close()
 
-# Initialize CustomerAgent
-customer_agent = CustomerAgent()
+# Initialize CustomerAgent; tables are created at startup (or by --init-db), not on import
+customer_agent = CustomerAgent(init_schema=False)
+
+# Segment rebuilds, recommendation precompute and retention, popularity refresh and compaction,
+# run off the request path; started and stopped with the app
+scheduler = jobs.build_scheduler(customer_agent.db_path, recommendation_system, artifacts)
+metrics.REGISTRY.register(metrics.Gauge(
+    "background_jobs_running",
+    "Background jobs queued or running in this worker",
+    scheduler.running,
+))
 
 # Pydantic models for request validation
 class Customer(BaseModel):
@@ -122,6 +193,7 @@ class Purchase(BaseModel):
     product_category: str
     price: float
     order_date: datetime
+    product_id: Optional[int] = None  # looked up by product_name when not given
 
 class BehaviorUpdate(BaseModel):
     customer_id: str
@@ -140,6 +212,7 @@ async def create_customer(customer: Customer):
             customer.customer_id, customer.full_name, customer.email, customer.username,
             customer.phone_number, customer.age, customer.gender, customer.location
         ))
+        customer_summary.set_profile(cursor, customer.dict())
         conn.commit()
         return {"message": "Customer created successfully", "customer_id": customer.customer_id}
     except Exception as e:
@@ -158,6 +231,9 @@ async def add_address(addresses:List[Address]):
                 INSERT INTO customer_addresses (customer_id, address_type, address) 
                 VALUES (?, ?, ?)
             ''', (address.customer_id, address.address_type, address.address))
+            customer_summary.add_address(
+                cursor, address.customer_id, cursor.lastrowid, address.address_type, address.address
+            )
        conn.commit()
        return {"message": f"{len(addresses)} address(es) added successfully"}
     except Exception as e:
@@ -166,107 +242,41 @@ async def add_address(addresses:List[Address]):
         conn.close()
 
 
+# Profiles hold personal data: browsers may keep them but must revalidate, shared caches may not store them
+PROFILE_CACHE_CONTROL = "private, no-cache"
+
 @app.get("/customer/get-profile/{customer_id}")
-async def get_customer_profile(customer_id: str):
+async def get_customer_profile(customer_id: str, request: Request):
+    """Profile, segment, addresses and recent activity, read from the customer_summary read model
+    
+    Responses carry a strong ETag of the summary's version. A matching
+    If-None-Match gets a 304 after reading only that version.
+    """
     conn = customer_agent.get_connection()
     cursor = conn.cursor()
     
     try:
-        # Get customer profile
-        cursor.execute('''
-            SELECT * FROM customer_profiles 
-            WHERE customer_id = ?
-        ''', (customer_id,))
-        profile = cursor.fetchone()
-        
-        if not profile:
-            raise HTTPException(status_code=404, detail="Customer not found")
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            with stage_timer("summary_version"):
+                version = customer_summary.version(cursor, customer_id)
+            if version is not None and http_caching.etag_matches(if_none_match, customer_summary.etag(version)):
+                return http_caching.not_modified(customer_summary.etag(version), PROFILE_CACHE_CONTROL)
         
-        # Get addresses
-        cursor.execute('''
-            SELECT address_id, address_type, address FROM customer_addresses 
-            WHERE customer_id = ?
-        ''', (customer_id,))
-        addresses = cursor.fetchall()
+        with stage_timer("summary_lookup"):
+            profile, version = customer_summary.get(cursor, customer_id, versioned=True)
         
-        # Get browsing history
-        cursor.execute('''
-            SELECT category, timestamp FROM browsing_history 
-            WHERE customer_id = ?
-            ORDER BY timestamp DESC
-            LIMIT 10
-        ''', (customer_id,))
-        browsing_history = cursor.fetchall()
+        if profile is None:
+            # Customer created before the read model existed, or not at all
+            with stage_timer("summary_rebuild"):
+                if customer_summary.rebuild(cursor, customer_id):
+                    conn.commit()
+                    profile, version = customer_summary.get(cursor, customer_id, versioned=True)
         
-        # Get purchase history
-        cursor.execute('''
-            SELECT product_name, product_category, price, order_date 
-            FROM purchase_history 
-            WHERE customer_id = ?
-            ORDER BY order_date DESC
-            LIMIT 10
-        ''', (customer_id,))
-        purchase_history = cursor.fetchall()
-
-        # Get detailed customer segment information
-        cursor.execute('''
-            SELECT 
-                customer_segment,
-                avg_order_value,
-                last_active_season,
-                (SELECT COUNT(*) FROM purchase_history WHERE customer_id = ?) as total_orders,
-                (SELECT SUM(price) FROM purchase_history WHERE customer_id = ?) as total_spent,
-                (SELECT MAX(order_date) FROM purchase_history WHERE customer_id = ?) as last_purchase_date
-            FROM customer_segments 
-            WHERE customer_id = ?
-        ''', (customer_id, customer_id, customer_id, customer_id))
+        if profile is None:
+            raise HTTPException(status_code=404, detail="Customer not found")
         
-        segment = cursor.fetchone()
-
-        # Format segment data
-        segment_data = {
-            "segment": segment[0] if segment else "Standard",
-            "avg_order_value": float(segment[1]) if segment else 0.0,
-            "last_active_season": segment[2] if segment else "Unknown",
-            "total_orders": segment[3] if segment else 0,
-            "total_spent": float(segment[4]) if segment else 0.0,
-            "last_purchase_date": segment[5] if segment else None
-        } if segment else None
-
-        return {
-            "profile": {
-                "customer_id": profile[0],
-                "full_name": profile[1],
-                "email": profile[2],
-                "username": profile[3],
-                "phone_number": profile[4],
-                "age": profile[5],
-                "gender": profile[6],
-                "location": profile[7]
-            },
-            "segment": segment_data,
-            "addresses": [
-                {
-                    "address_id": addr[0],
-                    "address_type": addr[1],
-                    "address": addr[2]
-                } for addr in addresses
-            ],
-            "browsing_history": [
-                {
-                    "category": history[0],
-                    "timestamp": history[1]
-                } for history in browsing_history
-            ],
-            "purchase_history": [
-                {
-                    "product_name": purchase[0],
-                    "product_category": purchase[1],
-                    "price": float(purchase[2]),
-                    "order_date": purchase[3]
-                } for purchase in purchase_history
-            ]
-        }
+        return http_caching.json_response(profile, customer_summary.etag(version), PROFILE_CACHE_CONTROL)
     
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -275,7 +285,7 @@ async def get_customer_profile(customer_id: str):
         conn.close()
 
 @app.post("/customer/update-behavior")
-async def update_behavior(behavior: BehaviorUpdate):
+async def update_behavior(behavior: BehaviorUpdate, background_tasks: BackgroundTasks):
     print("Received Request:", behavior.dict())  # ✅ Log incoming request
     conn = customer_agent.get_connection()
     cursor = conn.cursor()
@@ -289,19 +299,23 @@ async def update_behavior(behavior: BehaviorUpdate):
 
         # Store browsing history
         if behavior.browsing_category:
+            # Same text as SQLite's datetime('now'), so the summary and history rows match
+            timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
             cursor.execute('''
                 INSERT INTO browsing_history (customer_id, category, timestamp) 
-                VALUES (?, ?, datetime('now'))
-            ''', (behavior.customer_id, behavior.browsing_category))
+                VALUES (?, ?, ?)
+            ''', (behavior.customer_id, behavior.browsing_category, timestamp))
+            customer_summary.record_browsing(cursor, behavior.customer_id, behavior.browsing_category, timestamp)
             conn.commit()
             print(f"Browsing data inserted: {behavior.customer_id} - {behavior.browsing_category}")  # ✅ Log success
+            metrics.BEHAVIOR_EVENTS.labels("browsing").inc()
             
             # Update recommendations based on new browsing data
-            from recommendation_api import process_browsing
-            await process_browsing({
-                "customer_id": behavior.customer_id,
-                "category": behavior.browsing_category
-            })
+            from recommendation_api import process_browsing, BrowsingInteraction
+            await process_browsing(BrowsingInteraction(
+                customer_id=behavior.customer_id,
+                category=behavior.browsing_category
+            ))
 
             return {"message": "Browsing history updated successfully"}
     
@@ -309,36 +323,26 @@ async def update_behavior(behavior: BehaviorUpdate):
         if behavior.purchases:
             for purchase in behavior.purchases:
                 print("Inserting purchase:", purchase.dict())  # ✅ Log each purchase
-                cursor.execute('''
-                    INSERT INTO purchase_history (customer_id, product_name, product_category, price, order_date) 
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (behavior.customer_id, purchase.product_name, purchase.product_category, purchase.price, purchase.order_date))
+                cursor.execute(f'''
+                    INSERT INTO purchase_history (customer_id, product_name, product_category, price, order_date, product_id) 
+                    VALUES (?, ?, ?, ?, ?, COALESCE(?, {product_links.PRODUCT_ID_BY_NAME}))
+                ''', (behavior.customer_id, purchase.product_name, purchase.product_category, purchase.price, purchase.order_date,
+                      purchase.product_id, purchase.product_name))
+            customer_summary.record_purchases(
+                cursor, behavior.customer_id, [purchase.dict() for purchase in behavior.purchases]
+            )
             conn.commit() # ✅ Commit after inserting purchases
             print(f"Purchase history updated for {behavior.customer_id}")
+            metrics.BEHAVIOR_EVENTS.labels("purchase").inc(len(behavior.purchases))
 
-        # Update customer segments based on purchase history
-        cursor.execute('''
-            REPLACE INTO customer_segments (customer_id, avg_order_value, last_active_season, customer_segment)
-            SELECT 
-                ph.customer_id,
-                COALESCE(AVG(ph.price), 0),
-                CASE
-                    WHEN MAX(ph.order_date) >= DATE('now', '-3 months') THEN 'Recent'
-                    WHEN MAX(ph.order_date) >= DATE('now', '-6 months') THEN 'Semi-Recent'
-                    ELSE 'Inactive'
-                END,
-                CASE
-                    WHEN AVG(ph.price) > 100 THEN 'Premium'
-                    WHEN AVG(ph.price) BETWEEN 50 AND 100 THEN 'Regular'
-                    ELSE 'Budget'
-                END
-            FROM purchase_history ph
-            WHERE ph.customer_id = ?
-            GROUP BY ph.customer_id
-        ''', (behavior.customer_id,))
+            # Refresh the similar-shopper signature and invalidate stored recommendations
+            from recommendation_api import recommendation_system
+            recommendation_system.process_new_interaction(
+                behavior.customer_id, "purchase", {"items": [purchase.dict() for purchase in behavior.purchases]}
+            )
 
-        conn.commit()
-        print(f"Customer segment updated for {behavior.customer_id}")
+            # Segments only depend on purchases; recomputed once the response is sent
+            background_tasks.add_task(segments.refresh_customer, customer_agent.db_path, behavior.customer_id)
 
         return {"message": "Behavior updated successfully"}
     
@@ -349,13 +353,72 @@ async def update_behavior(behavior: BehaviorUpdate):
     finally:
         conn.close()
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint; values are per worker process"""
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/debug/sql")
+async def sql_stats(limit: int = 20, order_by: str = "total_seconds"):
+    """Top traced statements and recent slow queries for this worker
+
+    Statements are only aggregated when SQL_TRACE_SAMPLE_RATE is above zero.
+    """
+    if order_by not in ("total_seconds", "count", "max_seconds", "rows"):
+        raise HTTPException(status_code=400, detail=f"Cannot order by {order_by}")
+    return {
+        "sample_rate": db.SAMPLE_RATE,
+        "slow_query_ms": db.SLOW_QUERY_MS,
+        "top": db.STATS.top(limit, order_by),
+        "slow_queries": list(db.STATS.slow_queries),
+    }
+
+@app.get("/artifacts")
+async def artifact_status():
+    """Loaded, active and available version of each hot-swappable artifact in this worker"""
+    return artifacts.status()
+
+@app.post("/artifacts/{name}/rollback")
+async def rollback_artifact(name: str):
+    """Re-activate the previous version of an artifact and swap it in
+
+    Other workers pick the change up on their next watcher poll.
+    """
+    if name not in artifacts.names:
+        raise HTTPException(status_code=404, detail=f"Unknown artifact {name}")
+    try:
+        version = artifacts.rollback(name)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"name": name, "active_version": version, "loaded_version": artifacts.version(name)}
+
+@app.get("/jobs")
+async def job_status():
+    """Schedule and last run of each background job in this worker"""
+    return scheduler.status()
+
+@app.post("/jobs/{name}/run", status_code=202)
+async def run_job(name: str):
+    """Queue a run of a background job in this worker, outside its schedule"""
+    if name not in scheduler.jobs:
+        raise HTTPException(status_code=404, detail=f"Unknown job {name}")
+    if not scheduler.run_now(name):
+        raise HTTPException(status_code=409, detail=f"Job {name} is already queued or running")
+    return {"name": name, "queued": True}
+
+@app.get("/health")
+async def health():
+    """Readiness probe used by the evaluators before they send traffic"""
+    return {"status": "ok"}
+
 # Add the recommendation router to the app
 app.include_router(recommendation_router)
+app.include_router(catalog_router)
 
 # Initialize databases
-@app.on_event("startup")
-async def startup_event():
-    # Initialize recommendation database
+def init_schema():
+    """Create every table and index the service uses and seed the sample catalog; idempotent"""
+    customer_agent.init_db()
     initialize_recommendation_database()
 
 # CORS middleware
@@ -369,5 +432,21 @@ app.add_middleware(
 )
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    parser = argparse.ArgumentParser(description="Run the customer and recommendation API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes; published artifacts are memory-mapped and shared between them")
+    parser.add_argument("--init-db", action="store_true",
+                        help="Create the database schema and sample catalog, then exit (run once before FAST_START=1)")
+    args = parser.parse_args()
+    if args.init_db:
+        init_schema()
+        print("Database schema ready")
+        raise SystemExit(0)
+    if args.workers > 1:
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
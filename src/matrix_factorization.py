@@ -0,0 +1,324 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import history_compaction
+
+FORMAT_VERSION = 1
+
+DEFAULT_PARAMS = {
+    "factors": 64,
+    "iterations": 10,
+    "regularization": 0.1,
+    # Confidence c = 1 + alpha * r for an interaction of strength r
+    "alpha": 20.0,
+    "purchase_weight": 1.0,
+    "browse_weight": 0.3,
+    # Conjugate-gradient steps per user/item solve, warm-started from the last iteration
+    "cg_steps": 3,
+    "threads": os.cpu_count() or 1,
+    # Nonzeros per solve block; bounds the gathered (nnz x factors) working set per thread
+    "block_nnz": 500000,
+    "seed": 42,
+}
+
+
+def _stream(cursor, chunk_size):
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def load_interactions(db_path, purchase_weight=1.0, browse_weight=0.3, chunk_size=100000):
+    """Read purchases and browsing in chunks into a users x items interaction matrix
+
+    Purchases map to catalog products by name; browsing maps to one pseudo-item
+    per category, which informs the user factors but is never recommended.
+    History the compaction job rolled up counts as well, weighted by its
+    counts: linked purchases by product ID, browsing by category.
+    Returns (matrix, user_ids, item_keys, product_ids) where product_ids holds
+    the catalog ID of each item column or -1 for category pseudo-items.
+    """
+    from scipy.sparse import coo_matrix
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT product_id, product_name FROM product_catalog")
+    product_by_name = {}
+    for product_id, name in cursor.fetchall():
+        product_by_name.setdefault((name or "").lower(), product_id)
+
+    users, items = {}, {}
+    item_keys, product_ids = [], []
+    rows, cols, weights = [], [], []
+
+    def item_index(key, product_id):
+        index = items.get(key)
+        if index is None:
+            index = items[key] = len(item_keys)
+            item_keys.append(key)
+            product_ids.append(product_id)
+        return index
+
+    def add_chunk(user_list, item_list, weight, counts=None):
+        rows.append(np.fromiter(user_list, dtype=np.int32, count=len(user_list)))
+        cols.append(np.fromiter(item_list, dtype=np.int32, count=len(item_list)))
+        if counts is None:
+            weights.append(np.full(len(user_list), weight, dtype=np.float32))
+        else:
+            weights.append(weight * np.fromiter(counts, dtype=np.float32, count=len(counts)))
+
+    skipped = 0
+    cursor.execute("SELECT customer_id, product_name FROM purchase_history")
+    for chunk in _stream(cursor, chunk_size):
+        user_list, item_list = [], []
+        for customer_id, name in chunk:
+            product_id = product_by_name.get((name or "").lower())
+            if product_id is None:
+                skipped += 1
+                continue
+            user_list.append(users.setdefault(customer_id, len(users)))
+            item_list.append(item_index(f"product:{product_id}", product_id))
+        add_chunk(user_list, item_list, purchase_weight)
+
+    cursor.execute("SELECT customer_id, category FROM browsing_history")
+    for chunk in _stream(cursor, chunk_size):
+        user_list, item_list = [], []
+        for customer_id, category in chunk:
+            if not category:
+                continue
+            user_list.append(users.setdefault(customer_id, len(users)))
+            item_list.append(item_index(f"category:{category.lower()}", -1))
+        add_chunk(user_list, item_list, browse_weight)
+
+    rollups = history_compaction.existing_rollups(cursor)
+    if "purchase_product_rollup" in rollups:
+        catalog_ids = set(product_by_name.values())
+        cursor.execute("SELECT customer_id, product_id, orders FROM purchase_product_rollup")
+        for chunk in _stream(cursor, chunk_size):
+            user_list, item_list, counts = [], [], []
+            for customer_id, product_id, orders in chunk:
+                if product_id not in catalog_ids:
+                    skipped += orders
+                    continue
+                user_list.append(users.setdefault(customer_id, len(users)))
+                item_list.append(item_index(f"product:{product_id}", product_id))
+                counts.append(orders)
+            add_chunk(user_list, item_list, purchase_weight, counts)
+    if "browsing_rollup" in rollups:
+        cursor.execute("SELECT customer_id, category, views FROM browsing_rollup")
+        for chunk in _stream(cursor, chunk_size):
+            user_list, item_list, counts = [], [], []
+            for customer_id, category, views in chunk:
+                if not category:
+                    continue
+                user_list.append(users.setdefault(customer_id, len(users)))
+                item_list.append(item_index(f"category:{category.lower()}", -1))
+                counts.append(views)
+            add_chunk(user_list, item_list, browse_weight, counts)
+    conn.close()
+
+    if skipped:
+        print(f"Skipped {skipped} purchases of products not in the catalog")
+    matrix = coo_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(users), len(item_keys)), dtype=np.float32,
+    ).tocsr()
+    matrix.sum_duplicates()
+    return matrix, list(users), item_keys, np.array(product_ids, dtype=np.int64)
+
+
+def _blocks(indptr, block_nnz):
+    """Row ranges holding roughly block_nnz nonzeros each"""
+    total = int(indptr[-1])
+    cuts = np.searchsorted(indptr, np.arange(block_nnz, total, block_nnz))
+    bounds = np.unique(np.concatenate([[0], cuts, [len(indptr) - 1]]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _solve_block(confidence, start, end, X, Y, YtY, regularization, cg_steps):
+    """Conjugate-gradient update of rows start:end of X against fixed factors Y
+
+    Solves (YtY + Yt (C_u - I) Y + reg I) x_u = Yt C_u p_u for every row u at
+    once, with p_u = 1 on observed items, using only sparse-dense products.
+    """
+    block = confidence[start:end]
+    block_rows = np.repeat(np.arange(end - start), np.diff(block.indptr))
+    cols = block.indices
+    Y_cols = Y[cols]
+    minus_one = block.copy()
+    minus_one.data = block.data - 1
+
+    def apply(V):
+        # (C_u - I) weighted dot products for every observed (u, i) pair
+        dots = np.einsum("ij,ij->i", Y_cols, V[block_rows])
+        weighted = minus_one.copy()
+        weighted.data = minus_one.data * dots
+        return V @ YtY + weighted @ Y + regularization * V
+
+    x = X[start:end]
+    r = block @ Y - apply(x)
+    p = r.copy()
+    rs = np.einsum("ij,ij->i", r, r)
+    for _ in range(cg_steps):
+        Ap = apply(p)
+        denominator = np.einsum("ij,ij->i", p, Ap)
+        alpha = np.divide(rs, denominator, out=np.zeros_like(rs), where=denominator > 0)
+        x = x + alpha[:, None] * p
+        r = r - alpha[:, None] * Ap
+        rs_new = np.einsum("ij,ij->i", r, r)
+        beta = np.divide(rs_new, rs, out=np.zeros_like(rs), where=rs > 0)
+        p = r + beta[:, None] * p
+        rs = rs_new
+    X[start:end] = x
+
+
+def _half_step(confidence, X, Y, params, executor):
+    YtY = Y.T @ Y
+    blocks = _blocks(confidence.indptr, params["block_nnz"])
+    list(executor.map(
+        lambda bounds: _solve_block(confidence, bounds[0], bounds[1], X, Y, YtY,
+                                    params["regularization"], params["cg_steps"]),
+        blocks
+    ))
+
+
+def train_als(interactions, progress=None, **overrides):
+    """Implicit-feedback ALS (Hu, Koren & Volinsky) on a users x items strength matrix
+
+    Returns float32 (user_factors, item_factors, timings). Blocks of users or
+    items are solved on a thread pool; the sparse and dense products release the
+    GIL, so blocks run in parallel on multiple cores.
+    """
+    params = dict(DEFAULT_PARAMS, **overrides)
+    rng = np.random.default_rng(params["seed"])
+    n_users, n_items = interactions.shape
+    factors = params["factors"]
+
+    confidence = interactions.astype(np.float32).tocsr()
+    confidence.data = 1 + params["alpha"] * confidence.data
+    confidence_t = confidence.T.tocsr()
+
+    X = (rng.standard_normal((n_users, factors)) * 0.01).astype(np.float32)
+    Y = (rng.standard_normal((n_items, factors)) * 0.01).astype(np.float32)
+
+    timings = []
+    with ThreadPoolExecutor(max_workers=params["threads"]) as executor:
+        for iteration in range(params["iterations"]):
+            start = time.perf_counter()
+            _half_step(confidence, X, Y, params, executor)
+            _half_step(confidence_t, Y, X, params, executor)
+            timings.append(time.perf_counter() - start)
+            if progress:
+                progress(iteration + 1, timings[-1])
+    return X, Y, timings
+
+
+def save_model(path, user_ids, user_factors, product_ids, item_factors, params):
+    """Write serving artifacts: factors and IDs as .npy plus meta.json, replacing any existing model
+
+    Users are stored sorted by ID so serving can look them up with a binary
+    search over the memory-mapped ID array. Only real products are kept.
+    """
+    order = np.argsort(np.array(user_ids, dtype=str), kind="stable")
+    sorted_ids = np.array(user_ids, dtype=str)[order]
+    products = product_ids >= 0
+
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "user_ids.npy"), sorted_ids)
+    np.save(os.path.join(tmp_path, "user_factors.npy"), np.ascontiguousarray(user_factors[order]))
+    np.save(os.path.join(tmp_path, "product_ids.npy"), product_ids[products])
+    np.save(os.path.join(tmp_path, "item_factors.npy"), np.ascontiguousarray(item_factors[products]))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "format_version": FORMAT_VERSION,
+            "users": len(sorted_ids),
+            "products": int(products.sum()),
+            "params": params,
+        }, f)
+
+    old_path = f"{path}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+class FactorModel:
+    """Memory-mapped user and item factors for serving"""
+
+    def __init__(self, user_ids, user_factors, product_ids, item_factors):
+        self.user_ids = user_ids
+        self.user_factors = user_factors
+        self.product_ids = product_ids
+        self.item_factors = item_factors
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported model format {meta['format_version']} in {path}")
+        return cls(*(
+            np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ("user_ids", "user_factors", "product_ids", "item_factors")
+        ))
+
+    def user_vector(self, customer_id):
+        """Factor vector of a customer seen in training, or None"""
+        position = int(np.searchsorted(self.user_ids, customer_id))
+        if position < len(self.user_ids) and self.user_ids[position] == customer_id:
+            return self.user_factors[position]
+        return None
+
+    def recommend(self, customer_id, top_n=10, exclude=()):
+        """(product_id, score) pairs, best first, from one vector-matrix product; [] for unknown customers"""
+        vector = self.user_vector(customer_id)
+        if vector is None or top_n <= 0:
+            return []
+        scores = self.item_factors @ vector
+        if exclude:
+            scores[np.isin(self.product_ids, list(exclude))] = -np.inf
+        count = min(top_n, len(scores))
+        top = np.argpartition(-scores, count - 1)[:count] if count < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(self.product_ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the implicit-feedback ALS model from interaction history")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    parser.add_argument("--out", default="mf_model", help="Model directory to write")
+    for name, default in DEFAULT_PARAMS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+    params = {name: getattr(args, name) for name in DEFAULT_PARAMS}
+
+    start = time.perf_counter()
+    matrix, user_ids, _, product_ids = load_interactions(
+        args.db, params["purchase_weight"], params["browse_weight"]
+    )
+    load_seconds = time.perf_counter() - start
+    print(f"Loaded {matrix.nnz} interactions for {matrix.shape[0]} users and {matrix.shape[1]} items "
+          f"in {load_seconds:.2f}s")
+
+    user_factors, item_factors, timings = train_als(
+        matrix, progress=lambda i, seconds: print(f"  iteration {i}: {seconds:.2f}s"), **params
+    )
+    save_model(args.out, user_ids, user_factors, product_ids, item_factors, params)
+    print(f"Trained in {sum(timings):.2f}s; model written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
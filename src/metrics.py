@@ -0,0 +1,357 @@
+import threading
+import time
+from bisect import bisect_left
+
+from profiling import current_profile
+
+# Default latency buckets in seconds, from sub-millisecond SQLite lookups to slow generations
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Background job durations, from quick incremental passes to full rebuilds and compactions
+JOB_BUCKETS = (0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+
+
+class _ShardedValues:
+    """Per-thread value arrays that are only summed when metrics are scraped
+
+    Each thread increments its own list, so the hot path takes no lock; the lock is
+    only taken the first time a thread touches the metric.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = [0] * self._size
+            with self._lock:
+                self._shards.append(values)
+            self._local.values = values
+            return values
+
+    def totals(self):
+        with self._lock:
+            shards = list(self._shards)
+        totals = [0] * self._size
+        for values in shards:
+            for i, value in enumerate(values):
+                totals[i] += value
+        return totals
+
+
+class _CounterChild:
+    def __init__(self):
+        self._values = _ShardedValues(1)
+
+    def inc(self, amount=1):
+        self._values.shard()[0] += amount
+
+    def value(self):
+        return self._values.totals()[0]
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # One slot per bucket, one for +Inf, then sum and count
+        self._values = _ShardedValues(len(buckets) + 3)
+
+    def observe(self, value):
+        values = self._values.shard()
+        values[bisect_left(self._buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        totals = self._values.totals()
+        cumulative, running = [], 0
+        for count in totals[:len(self._buckets) + 1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, totals[-2], totals[-1]
+
+
+class _Timer:
+    """Context manager observing elapsed wall time into a histogram"""
+
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values):
+        """Child metric for a set of label values; resolve once and keep it for hot paths"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_text(values)} {child.value()}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def _render_child(self, values, child):
+        cumulative, total, count = child.snapshot()
+        bounds = [repr(float(b)) for b in self.buckets] + ["+Inf"]
+        lines = [
+            f"{self.name}_bucket{self._label_text(values, [('le', bound)])} {bucket_count}"
+            for bound, bucket_count in zip(bounds, cumulative)
+        ]
+        lines.append(f"{self.name}_sum{self._label_text(values)} {total}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Gauge whose value is computed by a callback at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback):
+        self.callback = callback
+        super().__init__(name, documentation)
+
+    def _new_child(self):
+        return None
+
+    def _render_child(self, values, child):
+        return [f"{self.name} {self.callback()}"]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HTTP_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ["method", "endpoint", "status"],
+))
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "recommendation_stage_duration_seconds",
+    "Latency of each recommendation pipeline stage",
+    ["stage"],
+))
+SQLITE_QUERIES = REGISTRY.register(Counter(
+    "sqlite_queries_total",
+    "SQLite statements executed, by statement type",
+    ["operation"],
+))
+SQLITE_QUERY_DURATION = REGISTRY.register(Histogram(
+    "sqlite_query_duration_seconds",
+    "SQLite statement execution time, by statement type",
+    ["operation"],
+))
+STORED_LOOKUPS = REGISTRY.register(Counter(
+    "recommendation_store_lookups_total",
+    "Stored-recommendation lookups by outcome (hit, rerendered after a catalog change, stale within the "
+    "grace window, miss, expired)",
+    ["result"],
+))
+RECOMMENDATIONS_SERVED = REGISTRY.register(Counter(
+    "recommendations_served_total",
+    "Recommendation responses by source (store, revalidating for a stale set being refreshed, cold "
+    "generation, not_modified for a 304, or the degraded stale and popular fallbacks)",
+    ["source"],
+))
+RECOMMENDATIONS_SHED = REGISTRY.register(Counter(
+    "recommendation_generations_shed_total",
+    "Generations refused under load, by reason (queue_full, queue_timeout or budget)",
+    ["reason"],
+))
+BACKGROUND_REFRESHES = REGISTRY.register(Counter(
+    "recommendation_background_refreshes_total",
+    "Stale-while-revalidate refreshes by result (scheduled, duplicate, dropped, completed or failed)",
+    ["result"],
+))
+GENERATIONS_COALESCED = REGISTRY.register(Counter(
+    "recommendation_generations_coalesced_total",
+    "Requests that waited for another request's generation instead of running their own, "
+    "by scope (worker or cross_worker)",
+    ["scope"],
+))
+COLLABORATIVE_SOURCE = REGISTRY.register(Counter(
+    "recommendation_collaborative_source_total",
+    "Collaborative suggestion lookups by source (factors, similar-shopper neighbours or segment fallback)",
+    ["source"],
+))
+JOB_RUNS = REGISTRY.register(Counter(
+    "background_job_runs_total",
+    "Background job runs by result (completed, failed, skipped while the previous run was still going, "
+    "or leased when another worker ran it this interval)",
+    ["job", "result"],
+))
+JOB_DURATION = REGISTRY.register(Histogram(
+    "background_job_duration_seconds",
+    "Run time of each background job, completed or failed",
+    ["job"],
+    buckets=JOB_BUCKETS,
+))
+BEHAVIOR_EVENTS = REGISTRY.register(Counter(
+    "customer_behavior_events_total",
+    "Behavior updates ingested, by type",
+    ["type"],
+))
+
+
+def _store_hit_ratio():
+    # Rerendered and stale sets are still answered from the store without generating
+    hits = sum(STORED_LOOKUPS.labels(result).value() for result in ("hit", "rerendered", "stale"))
+    total = hits + STORED_LOOKUPS.labels("miss").value() + STORED_LOOKUPS.labels("expired").value()
+    return hits / total if total else 0.0
+
+
+REGISTRY.register(Gauge(
+    "recommendation_store_hit_ratio",
+    "Fraction of stored-recommendation lookups that were served from the store, rerendered and stale ones included",
+    _store_hit_ratio,
+))
+
+# Children resolved once so the pipeline only pays for a dict-free observe()
+_stage_children = {}
+
+
+class _StageTimer:
+    """Observes a stage into its histogram and, when a request is being profiled, into the profile"""
+
+    __slots__ = ("_histogram", "_stage", "_start")
+
+    def __init__(self, histogram, stage):
+        self._histogram = histogram
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._start
+        self._histogram.observe(elapsed)
+        profile = current_profile.get()
+        if profile is not None:
+            profile.record_stage(self._stage, elapsed)
+
+
+def stage_timer(stage):
+    """Time a recommendation pipeline stage: `with stage_timer("content_filtering"): ...`"""
+    child = _stage_children.get(stage)
+    if child is None:
+        child = _stage_children.setdefault(stage, STAGE_DURATION.labels(stage))
+    return _StageTimer(child, stage)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency per route template
+
+    Labels use the matched route's path (e.g. /recommendations/{customer_id})
+    rather than the raw URL to keep label cardinality bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUEST_DURATION.labels(scope["method"], endpoint, str(status["code"])).observe(
+                time.perf_counter() - start
+            )
@@ -0,0 +1,457 @@
+import argparse
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import history_compaction
+from recommendation_system import RecommendationSystem
+
+# Default evaluation settings; every run records the config it used
+DEFAULT_CONFIG = {
+    "ks": [5, 10],
+    "holdout_days": 30,
+    "split_date": None,
+    "relevance": "category",  # 'category' or 'product'
+    "min_train_events": 1,
+    "max_customers": None,
+    "seed": 42,
+    "workers": os.cpu_count() or 1,
+    "chunk_size": 1000,
+}
+
+# Serving windows used by RecommendationSystem._get_customer_data
+BROWSING_WINDOW_DAYS = 30
+PURCHASE_WINDOW_DAYS = 180
+
+FETCH_BATCH_SIZE = 10000
+
+
+def _time_key(value):
+    """Normalize a stored timestamp to the 'YYYY-MM-DD HH:MM:SS' form SQLite compares on"""
+    return str(value)[:19].replace("T", " ")
+
+
+def _shift(time_key, days):
+    """Shift a normalized timestamp by a number of days"""
+    shifted = datetime.fromisoformat(time_key) + timedelta(days=days)
+    return shifted.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _segment_for(purchases):
+    """Apply the same segment rules as update_behavior to a list of counted purchases"""
+    if not purchases:
+        return ("Standard", 0)
+    avg_price = sum(p["price"] * p["count"] for p in purchases) / sum(p["count"] for p in purchases)
+    if avg_price > 100:
+        segment = "Premium"
+    elif avg_price >= 50:
+        segment = "Regular"
+    else:
+        segment = "Budget"
+    return (segment, avg_price)
+
+
+def _stream_rows(cursor, query):
+    """Yield rows from a query in fixed-size batches"""
+    cursor.execute(query)
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+        if not rows:
+            break
+        yield from rows
+
+
+def _expand(events, start, end):
+    """Events timed within [start, end), repeating rolled-up rows by their count"""
+    for event in events:
+        if start <= event[0] < end:
+            for _ in range(event[-1]):
+                yield event
+
+
+def load_history(db_path):
+    """Load browsing and purchase events grouped by customer, oldest first
+
+    Every event ends with its count: 1 for raw rows, the number of views or
+    orders for a row the compaction job rolled up, dated at the start of its
+    period. Rolled-up purchases keep their category and average price but not
+    which product was bought.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    browsing = defaultdict(list)
+    for customer_id, category, timestamp in _stream_rows(cursor, """
+        SELECT customer_id, category, timestamp FROM browsing_history
+    """):
+        if category:
+            browsing[customer_id].append((_time_key(timestamp), category, 1))
+
+    purchases = defaultdict(list)
+    for customer_id, name, category, price, order_date, product_id in _stream_rows(cursor, """
+        SELECT customer_id, product_name, product_category, price, order_date, product_id
+        FROM purchase_history
+    """):
+        if category:
+            purchases[customer_id].append((_time_key(order_date), name, category, price or 0.0, product_id, 1))
+
+    rollups = history_compaction.existing_rollups(cursor)
+    if "browsing_rollup" in rollups:
+        for customer_id, period_start, category, views in _stream_rows(cursor, """
+            SELECT customer_id, period_start, category, views FROM browsing_rollup
+        """):
+            if category:
+                browsing[customer_id].append((f"{period_start} 00:00:00", category, views))
+    if "purchase_rollup" in rollups:
+        for customer_id, period_start, category, orders, spent in _stream_rows(cursor, """
+            SELECT customer_id, period_start, product_category, orders, spent FROM purchase_rollup
+        """):
+            if category:
+                purchases[customer_id].append((f"{period_start} 00:00:00", None, category, spent / orders, None, orders))
+
+    conn.close()
+
+    for events in browsing.values():
+        events.sort()
+    for events in purchases.values():
+        # By time only: names and product IDs of rolled-up purchases are None
+        events.sort(key=lambda event: event[0])
+
+    return browsing, purchases
+
+
+def build_replay(browsing, purchases, config, id_by_name=None):
+    """Split every customer's history at a common cutoff into training data and held-out events
+
+    Training data mirrors what _get_customer_data would have returned at the cutoff:
+    30 days of browsing and 180 days of purchases, most recent first, with
+    rolled-up rows repeated by their count only within those windows. Held-out
+    events are purchases at or after the cutoff. With product-level relevance,
+    held-out purchases whose name is not in the catalog (id_by_name) can never
+    be recommended and are dropped, as are customers left with none.
+    """
+    split_date = config["split_date"]
+    if split_date is None:
+        latest = max(
+            [events[-1][0] for events in browsing.values() if events] +
+            [events[-1][0] for events in purchases.values() if events] or [None],
+            key=lambda value: value or ""
+        )
+        if latest is None:
+            return None, []
+        split_date = _shift(latest, -config["holdout_days"])
+    else:
+        split_date = _time_key(split_date)
+
+    browse_start = _shift(split_date, -BROWSING_WINDOW_DAYS)
+    purchase_start = _shift(split_date, -PURCHASE_WINDOW_DAYS)
+
+    customers = []
+    for customer_id in sorted(set(browsing) | set(purchases)):
+        customer_browsing = browsing.get(customer_id, [])
+        customer_purchases = purchases.get(customer_id, [])
+
+        train_purchases = [
+            {"category": category, "price": price, "count": count}
+            for ts, name, category, price, _, count in customer_purchases if ts < split_date
+        ]
+        # Relevance is a set of categories or products, so a rolled-up row counts once
+        held_out = [
+            {"product_name": name, "category": category}
+            for ts, name, category, price, _, count in customer_purchases if ts >= split_date
+        ]
+        if config["relevance"] == "product":
+            held_out = [event for event in held_out if (event["product_name"] or "").lower() in id_by_name]
+        train_events = sum(count for ts, category, count in customer_browsing if ts < split_date)
+        train_events += sum(p["count"] for p in train_purchases)
+
+        if not held_out or train_events < config["min_train_events"]:
+            continue
+
+        recent_browsing = [
+            category for ts, category, _ in _expand(reversed(customer_browsing), browse_start, split_date)
+        ]
+        # With their catalog IDs, so the exclude-purchased rule applies as it does when serving
+        recent_purchases = [
+            {"product_name": name, "category": category, "price": price, "product_id": product_id}
+            for ts, name, category, price, product_id, _ in _expand(
+                reversed(customer_purchases), purchase_start, split_date)
+        ]
+        segment = _segment_for(train_purchases)
+        own_categories = Counter()
+        for purchase in train_purchases:
+            own_categories[purchase["category"]] += purchase["count"]
+
+        customers.append({
+            "customer_data": {
+                "profile": {"customer_id": customer_id},
+                "segment": {"type": segment[0], "avg_order_value": segment[1]},
+                "browsing_history": recent_browsing,
+                "purchase_history": recent_purchases,
+            },
+            "has_segment": bool(train_purchases),
+            "own_categories": own_categories,
+            "held_out": held_out,
+        })
+
+    if config["max_customers"] and len(customers) > config["max_customers"]:
+        sampler = random.Random(config["seed"])
+        customers = sampler.sample(customers, config["max_customers"])
+
+    return split_date, customers
+
+
+def segment_category_counts(customers):
+    """Count training purchases per category within each segment"""
+    counts = defaultdict(Counter)
+    for customer in customers:
+        if customer["has_segment"]:
+            segment = customer["customer_data"]["segment"]["type"]
+            counts[segment].update(customer["own_categories"])
+    return counts
+
+
+# Per-process state populated by _init_worker
+_worker = {}
+_inprocess_lock = threading.Lock()
+
+
+def _init_worker(db_path, products, segment_counts, config):
+    """Create one RecommendationSystem and shared lookup tables per worker process"""
+    _worker["system"] = RecommendationSystem(db_path, init_schema=False)
+    _worker["products"] = products
+    _worker["segment_counts"] = segment_counts
+    _worker["config"] = config
+    _worker["id_by_name"] = {p["product_name"].lower(): p["product_id"] for p in products}
+    _worker["category_by_id"] = {p["product_id"]: p["category"].lower() for p in products}
+
+
+def _popular_categories(customer, top_n):
+    """Segment's most purchased categories, excluding the customer's own purchases"""
+    if not customer["has_segment"] or top_n <= 0:
+        return []
+    segment = customer["customer_data"]["segment"]["type"]
+    counts = Counter(_worker["segment_counts"].get(segment, {}))
+    counts.subtract(customer["own_categories"])
+    return [category for category, count in counts.most_common(top_n) if count > 0]
+
+
+def _score_chunk(chunk_index, customers):
+    """Rank products for a chunk of customers and mark which positions hit held-out events"""
+    system = _worker["system"]
+    config = _worker["config"]
+    limit = max(config["ks"])
+    by_category = config["relevance"] == "category"
+    random.seed(config["seed"] + chunk_index)
+
+    rec_ids = np.full((len(customers), limit), -1, dtype=np.int64)
+    hits = np.zeros((len(customers), limit), dtype=bool)
+    first_hits = np.zeros((len(customers), limit), dtype=bool)
+    n_relevant = np.zeros(len(customers), dtype=np.int64)
+
+    for row, customer in enumerate(customers):
+        if by_category:
+            relevant = {event["category"].lower() for event in customer["held_out"]}
+        else:
+            # build_replay only keeps held-out products that are in the catalog
+            relevant = {_worker["id_by_name"][event["product_name"].lower()] for event in customer["held_out"]}
+        n_relevant[row] = len(relevant)
+
+        ranked = system.rank_for_customer(
+            customer["customer_data"], limit,
+            products=_worker["products"],
+            popular_categories=_popular_categories(customer, RecommendationSystem.POPULAR_CATEGORY_CANDIDATES),
+        )
+
+        seen = set()
+        for position, rec in enumerate(ranked[:limit]):
+            rec_ids[row, position] = rec["product_id"]
+            key = _worker["category_by_id"].get(rec["product_id"]) if by_category else rec["product_id"]
+            if key in relevant:
+                hits[row, position] = True
+                if key not in seen:
+                    first_hits[row, position] = True
+                    seen.add(key)
+
+    return rec_ids, hits, first_hits, n_relevant
+
+
+def per_customer_metrics(hits, first_hits, n_relevant, k):
+    """Vectorized per-customer precision@k, recall@k, NDCG@k and hit indicator"""
+    hits_k = hits[:, :k]
+    first_k = first_hits[:, :k]
+    discounts = 1.0 / np.log2(np.arange(2, k + 2))
+
+    dcg = (first_k * discounts).sum(axis=1)
+    ideal = np.cumsum(discounts)[np.minimum(n_relevant, k) - 1]
+
+    return {
+        "precision": hits_k.sum(axis=1) / k,
+        "recall": first_k.sum(axis=1) / n_relevant,
+        "ndcg": dcg / ideal,
+        "hit_rate": hits_k.any(axis=1),
+    }
+
+
+def ranking_metrics(rec_ids, hits, first_hits, n_relevant, k, catalog_size):
+    """Vectorized precision@k, recall@k, NDCG@k, hit rate and catalog coverage"""
+    per_customer = per_customer_metrics(hits, first_hits, n_relevant, k)
+    recommended = rec_ids[:, :k]
+
+    metrics = {f"{name}@{k}": float(values.mean()) for name, values in per_customer.items()}
+    metrics[f"catalog_coverage@{k}"] = float(np.unique(recommended[recommended >= 0]).size / max(catalog_size, 1))
+    return metrics
+
+
+def _report_chunk(progress, customers, result, k, done, total, stream_customers):
+    """Send progress and per-customer results for a finished chunk to a progress callback"""
+    rec_ids, hits, first_hits, n_relevant = result
+    if done - len(customers) < stream_customers:
+        per_customer = per_customer_metrics(hits, first_hits, n_relevant, k)
+        remaining = stream_customers - (done - len(customers))
+        for row, customer in enumerate(customers[:remaining]):
+            progress({
+                "type": "customer",
+                "customer_id": customer["customer_data"]["profile"]["customer_id"],
+                "segment": customer["customer_data"]["segment"]["type"],
+                "recommendations": [int(pid) for pid in rec_ids[row, :k] if pid >= 0],
+                "relevant": int(n_relevant[row]),
+                **{f"{name}@{k}": float(values[row]) for name, values in per_customer.items()},
+            })
+    progress({"type": "progress", "done": done, "total": total})
+
+
+def resolve_config(**overrides):
+    """Merge overrides into the default evaluation config"""
+    unknown = set(overrides) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown evaluation options: {', '.join(sorted(unknown))}")
+    config = dict(DEFAULT_CONFIG, **overrides)
+    config["ks"] = sorted(set(config["ks"]))
+    return config
+
+
+def _score_chunks(chunks, init_args, workers):
+    """Score chunks in order, in a process pool when there is more than one chunk"""
+    if workers <= 1 or len(chunks) <= 1:
+        # Worker state is module-global, so concurrent in-process runs take turns
+        with _inprocess_lock:
+            _init_worker(*init_args)
+            for index, chunk in enumerate(chunks):
+                yield _score_chunk(index, chunk)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as pool:
+        yield from pool.map(_score_chunk, range(len(chunks)), chunks)
+
+
+def evaluate(db_path="customers.db", progress=None, stream_customers=100, **overrides):
+    """Run a time-split offline evaluation directly against RecommendationSystem
+    
+    If given, progress is called with a 'progress' event after every scored chunk
+    and a 'customer' event for each of the first stream_customers customers.
+    """
+    config = resolve_config(**overrides)
+    started = time.perf_counter()
+
+    products = RecommendationSystem(db_path, init_schema=False)._get_all_products()
+    id_by_name = {p["product_name"].lower(): p["product_id"] for p in products}
+    browsing, purchases = load_history(db_path)
+    split_date, customers = build_replay(browsing, purchases, config, id_by_name)
+    segment_counts = segment_category_counts(customers)
+    loaded = time.perf_counter()
+
+    chunk_size = config["chunk_size"]
+    chunks = [customers[i:i + chunk_size] for i in range(0, len(customers), chunk_size)]
+    init_args = (db_path, products, segment_counts, config)
+
+    if progress:
+        progress({"type": "progress", "done": 0, "total": len(customers)})
+
+    results = []
+    done = 0
+    for chunk, result in zip(chunks, _score_chunks(chunks, init_args, config["workers"])):
+        results.append(result)
+        done += len(chunk)
+        if progress:
+            _report_chunk(progress, chunk, result, max(config["ks"]), done, len(customers), stream_customers)
+    scored = time.perf_counter()
+
+    metrics = {}
+    if results:
+        rec_ids, hits, first_hits, n_relevant = (np.concatenate(parts) for parts in zip(*results))
+        for k in config["ks"]:
+            metrics.update(ranking_metrics(rec_ids, hits, first_hits, n_relevant, k, len(products)))
+    finished = time.perf_counter()
+
+    return {
+        "config": config,
+        "split_date": split_date,
+        "customers_evaluated": len(customers),
+        "catalog_size": len(products),
+        "metrics": metrics,
+        "timings": {
+            "load_seconds": round(loaded - started, 3),
+            "scoring_seconds": round(scored - loaded, 3),
+            "metrics_seconds": round(finished - scored, 3),
+            "total_seconds": round(finished - started, 3),
+            "scoring_ms_per_customer": round(1000 * (scored - loaded) / max(len(customers), 1), 4),
+        },
+    }
+
+
+def print_report(result):
+    """Print an offline evaluation result in the same layout as the HTTP evaluator"""
+    print("\n===== OFFLINE RECOMMENDATION EVALUATION =====")
+    print(f"\nSplit date: {result['split_date']}")
+    print(f"Customers evaluated: {result['customers_evaluated']}")
+    print(f"Catalog size: {result['catalog_size']}")
+    print(f"Relevance level: {result['config']['relevance']}")
+
+    print("\nRANKING METRICS:")
+    for name, value in result["metrics"].items():
+        print(f"  {name}: {value:.4f}")
+
+    print("\nTIMINGS:")
+    for name, value in result["timings"].items():
+        unit = "ms" if name.endswith("_ms_per_customer") else "s"
+        print(f"  {name}: {value:.3f}{unit}")
+
+    print("\n===== EVALUATION COMPLETE =====")
+
+
+def main():
+    """Command line entry point for offline evaluation"""
+    parser = argparse.ArgumentParser(description="Offline time-split evaluation of the recommender")
+    parser.add_argument("--db", default="customers.db", help="SQLite database to replay")
+    parser.add_argument("--k", type=int, nargs="+", default=DEFAULT_CONFIG["ks"], help="Cutoffs to report")
+    parser.add_argument("--holdout-days", type=int, default=DEFAULT_CONFIG["holdout_days"])
+    parser.add_argument("--split-date", default=None, help="Explicit cutoff timestamp (overrides --holdout-days)")
+    parser.add_argument("--relevance", choices=["category", "product"], default=DEFAULT_CONFIG["relevance"])
+    parser.add_argument("--max-customers", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=DEFAULT_CONFIG["workers"])
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CONFIG["chunk_size"])
+    args = parser.parse_args()
+
+    result = evaluate(
+        args.db,
+        ks=args.k,
+        holdout_days=args.holdout_days,
+        split_date=args.split_date,
+        relevance=args.relevance,
+        max_customers=args.max_customers,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+    )
+    print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import time
+
+import db
+
+# Catalog ID of a product name, matched case-insensitively like the ranking code's product_named():
+# the first product in catalog order wins. Binds the name once.
+PRODUCT_ID_BY_NAME = '''
+    (SELECT product_id FROM product_catalog WHERE product_name = ? COLLATE NOCASE ORDER BY product_id LIMIT 1)
+'''
+
+
+def init_db(cursor):
+    """Link purchase_history rows to product_catalog IDs
+
+    Adds the product_id column to purchase history tables created before it
+    existed, creates the name index ingestion resolves names through and the
+    index of rows still unlinked, and resolves every row still missing an ID.
+    Returns the number resolved.
+    """
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_product_catalog_name
+        ON product_catalog (product_name COLLATE NOCASE)
+    ''')
+    cursor.execute("PRAGMA table_info(purchase_history)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if not columns:
+        # No customer tables in this database
+        return 0
+    if "product_id" not in columns:
+        cursor.execute("ALTER TABLE purchase_history ADD COLUMN product_id INTEGER")
+    # Keeps backfill after every catalog load to the few purchases not linked yet
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_purchase_history_unlinked
+        ON purchase_history (product_name) WHERE product_id IS NULL
+    ''')
+    return backfill(cursor)
+
+
+def backfill(cursor):
+    """Resolve purchases without a product ID, e.g. ones bought before the product was loaded; returns the count"""
+    by_name = PRODUCT_ID_BY_NAME.replace("?", "purchase_history.product_name")
+    # Rows whose name is not in the catalog are left alone rather than rewritten with NULL
+    cursor.execute(f'''
+        UPDATE purchase_history SET product_id = {by_name}
+        WHERE product_id IS NULL AND {by_name} IS NOT NULL
+    ''')
+    return cursor.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Link purchase history rows to catalog product IDs")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    args = parser.parse_args()
+    conn = db.connect(args.db)
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    count = init_db(cursor)
+    conn.commit()
+    conn.close()
+    print(f"Linked {count} more purchases to catalog products in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
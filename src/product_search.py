@@ -0,0 +1,183 @@
+import argparse
+import re
+import time
+
+import db
+
+# Indexed catalog columns, in FTS5 column order, with their BM25 weights
+SEARCH_COLUMNS = ("product_name", "product_category", "description", "tags")
+BM25_WEIGHTS = (10.0, 4.0, 1.0, 5.0)
+# Columns a customer's preferred category terms are matched against
+CATEGORY_COLUMNS = ("product_category", "tags")
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def init_db(cursor):
+    """FTS5 index over the catalog, kept in sync with product_catalog by triggers
+
+    The index is an external-content table: it stores only the inverted index
+    and reads column values from product_catalog, so text is not stored twice.
+    A newly created index is filled from the existing catalog.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'product_search'")
+    exists = cursor.fetchone() is not None
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+            {", ".join(SEARCH_COLUMNS)},
+            content='product_catalog', content_rowid='product_id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    ''')
+
+    columns = ", ".join(SEARCH_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in SEARCH_COLUMNS)
+    old_values = ", ".join(f"old.{column}" for column in SEARCH_COLUMNS)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON product_catalog BEGIN
+            INSERT INTO product_search (rowid, {columns}) VALUES (new.product_id, {new_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON product_catalog BEGIN
+            INSERT INTO product_search (product_search, rowid, {columns})
+            VALUES ('delete', old.product_id, {old_values});
+        END
+    ''')
+    # Only text changes touch the index; price-only updates from bulk loads skip it
+    changed = " OR ".join(f"old.{column} IS NOT new.{column}" for column in SEARCH_COLUMNS)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS product_search_update AFTER UPDATE OF {columns} ON product_catalog
+        WHEN {changed} BEGIN
+            INSERT INTO product_search (product_search, rowid, {columns})
+            VALUES ('delete', old.product_id, {old_values});
+            INSERT INTO product_search (rowid, {columns}) VALUES (new.product_id, {new_values});
+        END
+    ''')
+    # Column weights for the built-in rank column, so ORDER BY rank takes FTS5's fast path
+    cursor.execute(
+        "INSERT INTO product_search (product_search, rank) VALUES ('rank', ?)",
+        (f"bm25({', '.join(str(weight) for weight in BM25_WEIGHTS)})",)
+    )
+    if not exists:
+        rebuild(cursor)
+
+
+def rebuild(cursor):
+    """Re-index every catalog row, e.g. after product_catalog was changed with the triggers absent"""
+    cursor.execute("INSERT INTO product_search (product_search) VALUES ('rebuild')")
+
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def match_expression(query, prefix=True):
+    """FTS5 query matching every word of free text, the last one as a prefix
+
+    Words are quoted, so user input cannot inject FTS5 operators. Returns None
+    when the text has no searchable words.
+    """
+    terms = TOKEN_PATTERN.findall(query or "")
+    if not terms:
+        return None
+    parts = [_quote(term) for term in terms]
+    if prefix:
+        parts[-1] += " *"
+    return " AND ".join(parts)
+
+
+def search(db_path, query, limit=20, offset=0, prefix=True):
+    """Products matching free text, best BM25 score first, as one page plus a has_more flag"""
+    expression = match_expression(query, prefix)
+    if expression is None:
+        return {"query": query, "results": [], "limit": limit, "offset": offset, "has_more": False}
+
+    conn = db.connect(db_path)
+    cursor = conn.cursor()
+    # The page is chosen inside the index before joining the catalog rows; one row
+    # past the page tells whether another page exists without counting every match
+    cursor.execute('''
+        SELECT p.product_id, p.product_name, p.product_category, p.price, p.description, p.tags, hits.rank
+        FROM (
+            SELECT rowid, rank FROM product_search
+            WHERE product_search MATCH ?
+            ORDER BY rank, rowid
+            LIMIT ? OFFSET ?
+        ) hits
+        JOIN product_catalog p ON p.product_id = hits.rowid
+        ORDER BY hits.rank, hits.rowid
+    ''', (expression, limit + 1, offset))
+    rows = cursor.fetchall()
+    conn.close()
+
+    return {
+        "query": query,
+        "results": [{
+            "product_id": row[0],
+            "product_name": row[1],
+            "category": row[2],
+            "price": row[3],
+            "description": row[4],
+            "tags": row[5],
+            # SQLite's bm25() is lower-is-better; negated so higher means more relevant
+            "score": -row[6],
+        } for row in rows[:limit]],
+        "limit": limit,
+        "offset": offset,
+        "has_more": len(rows) > limit,
+    }
+
+
+def category_candidates(cursor, category_weights, per_term, max_terms=5):
+    """Product IDs whose category or tags contain the customer's top category terms
+
+    One indexed query per term, each returning up to per_term products by BM25,
+    in place of a scan of the catalog. Categories that share no whole word with
+    a product (e.g. "phone" inside "smartphone") are not found, so the result
+    is a candidate set to score exactly, not a ranking.
+    """
+    terms = sorted(category_weights, key=lambda category: -category_weights[category])[:max_terms]
+    candidates = []
+    seen = set()
+    for term in terms:
+        words = TOKEN_PATTERN.findall(term)
+        if not words:
+            continue
+        cursor.execute('''
+            SELECT rowid FROM product_search
+            WHERE product_search MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        ''', ("{" + " ".join(CATEGORY_COLUMNS) + "} : " + _quote(" ".join(words)), per_term))
+        for (product_id,) in cursor.fetchall():
+            if product_id not in seen:
+                seen.add(product_id)
+                candidates.append(product_id)
+    return candidates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild or query the product full-text index")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    parser.add_argument("--rebuild", action="store_true", help="Re-index the whole catalog")
+    parser.add_argument("query", nargs="?", help="Search text")
+    args = parser.parse_args()
+
+    conn = db.connect(args.db)
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    init_db(cursor)
+    if args.rebuild:
+        rebuild(cursor)
+    conn.commit()
+    conn.close()
+    if args.rebuild:
+        print(f"Rebuilt the product index in {time.perf_counter() - start:.2f}s")
+    if args.query:
+        for product in search(args.db, args.query)["results"]:
+            print(f"{product['score']:8.3f}  {product['product_id']:>8}  {product['product_name']}")
+
+
+if __name__ == "__main__":
+    main()
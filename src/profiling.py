@@ -0,0 +1,255 @@
+import cProfile
+import contextvars
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from urllib.parse import parse_qs
+
+from starlette.concurrency import run_in_threadpool as _run_in_threadpool
+
+# Profile of the request being handled in this context, or None when profiling is off
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+# Capture modes write files only when a directory is configured, so clients cannot fill the disk
+CAPTURE_DIR = os.environ.get("PROFILE_CAPTURE_DIR")
+SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.001"))
+
+# Routes that honour ?profile= / X-Profile (method, path prefix)
+PROFILED_ROUTES = (
+    ("GET", "/recommendations/"),
+    ("GET", "/customer/get-profile/"),
+)
+
+MODES = {"1": "timing", "true": "timing", "timing": "timing", "cprofile": "cprofile", "sample": "sample"}
+
+# One capture at a time per worker: profilers hook whole threads, so overlapping captures would mix
+_capture_lock = threading.Lock()
+
+
+class RequestProfile:
+    """Stage timings and SQL counts collected for one request"""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.capture = None
+        self.output_path = None
+
+    def record_stage(self, stage, seconds):
+        total, count = self.stages.get(stage, (0.0, 0))
+        self.stages[stage] = (total + seconds, count + 1)
+
+    def record_query(self, seconds):
+        self.queries += 1
+        self.query_seconds += seconds
+
+    def server_timing(self):
+        """Server-Timing header value: one entry per stage, then SQL and total time"""
+        entries = []
+        for stage, (seconds, count) in self.stages.items():
+            desc = f';desc="{count} calls"' if count > 1 else ""
+            entries.append(f"{stage};dur={seconds * 1000:.3f}{desc}")
+        entries.append(f'db;dur={self.query_seconds * 1000:.3f};desc="{self.queries} queries"')
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.3f}")
+        return ", ".join(entries)
+
+
+class _SamplingProfiler:
+    """Samples the stacks of a changing set of threads at a fixed interval into collapsed-stack counts"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        # Thread ID -> root frame name, e.g. event-loop
+        self.threads = {}
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, root in list(self.threads.items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join([root, *reversed(stack)])] += 1
+
+    def write(self, path):
+        """Write samples in the collapsed format read by flamegraph.pl and speedscope"""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class _Capture:
+    """cProfile or stack-sample capture of one request
+
+    Covers the event-loop thread for the whole request and each thread-pool
+    thread while it runs work for the request (see run_in_threadpool).
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        # cProfile profilers of threads that have detached; a profiler can only be stopped on its own thread
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._sampler = _SamplingProfiler() if mode == "sample" else None
+
+    def start(self):
+        if self._sampler is not None:
+            self._sampler.start()
+        return self.attach("event-loop")
+
+    def attach(self, root):
+        """Start capturing the calling thread; returns the handle detach() takes"""
+        if self._sampler is not None:
+            thread_id = threading.get_ident()
+            self._sampler.threads[thread_id] = root
+            return thread_id
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def detach(self, handle):
+        if self._sampler is not None:
+            self._sampler.threads.pop(handle, None)
+            return
+        handle.disable()
+        with self._lock:
+            self._profiles.append(handle)
+
+    def finish(self, path):
+        """Write what has been captured to path, once the event-loop thread has detached
+
+        Pool threads still running work for the request (e.g. a generation
+        that outlived its latency budget) are left out.
+        """
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler.write(path)
+            return
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(profiles[0])
+        for profiler in profiles[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+
+
+async def run_in_threadpool(fn, *args, **kwargs):
+    """Starlette's run_in_threadpool, with the call included in the request's capture when there is one"""
+    profile = current_profile.get()
+    if profile is None or profile.capture is None:
+        return await _run_in_threadpool(fn, *args, **kwargs)
+    return await _run_in_threadpool(_captured, profile.capture, fn, *args, **kwargs)
+
+
+def _captured(capture, fn, *args, **kwargs):
+    handle = capture.attach("thread-pool")
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        capture.detach(handle)
+
+
+def _requested_mode(scope):
+    """Profiling mode asked for by the request, or None"""
+    method, path = scope["method"], scope["path"]
+    if not any(method == m and path.startswith(prefix) for m, prefix in PROFILED_ROUTES):
+        return None
+
+    value = None
+    for name, header_value in scope["headers"]:
+        if name == b"x-profile":
+            value = header_value.decode("latin-1")
+            break
+    if value is None and b"profile=" in scope.get("query_string", b""):
+        value = parse_qs(scope["query_string"].decode("latin-1")).get("profile", [None])[0]
+    return MODES.get((value or "").lower())
+
+
+def _capture_path(scope, extension):
+    os.makedirs(CAPTURE_DIR, exist_ok=True)
+    route = scope["path"].strip("/").replace("/", "_")
+    return os.path.join(CAPTURE_DIR, f"{route}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.{extension}")
+
+
+class ProfilingMiddleware:
+    """ASGI middleware for opt-in per-request profiling
+
+    Adds a Server-Timing header with pipeline stage timings and SQL query count
+    when a profiled route is called with ?profile=1 or an X-Profile header.
+    'cprofile' and 'sample' additionally capture the request to a file in
+    PROFILE_CAPTURE_DIR, reported in the X-Profile-Output header. Requests
+    without the flag go straight through.
+
+    A capture records the event-loop thread for the length of the request,
+    which includes any other request the loop interleaves meanwhile, so it is
+    only clean on an otherwise idle worker. Work the request hands to the
+    thread pool through run_in_threadpool is captured on its own thread and
+    is exact under any load. Only one capture runs at a time per worker; a
+    capture requested while another is running gets Server-Timing only.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        mode = _requested_mode(scope) if scope["type"] == "http" else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(mode)
+        token = current_profile.set(profile)
+        loop_handle = None
+        if mode != "timing" and CAPTURE_DIR and _capture_lock.acquire(blocking=False):
+            profile.capture = _Capture(mode)
+            loop_handle = profile.capture.start()
+
+        def finish_capture():
+            capture = profile.capture
+            if capture is None:
+                return
+            # Cleared first: pool threads still running for this request stop attaching
+            profile.capture = None
+            try:
+                capture.detach(loop_handle)
+                profile.output_path = _capture_path(scope, "prof" if mode == "cprofile" else "folded")
+                capture.finish(profile.output_path)
+            finally:
+                _capture_lock.release()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                finish_capture()
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", profile.server_timing().encode("latin-1")))
+                if profile.output_path:
+                    headers.append((b"x-profile-output", profile.output_path.encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish_capture()
+            current_profile.reset(token)
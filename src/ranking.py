@@ -0,0 +1,342 @@
+import heapq
+import os
+import sys
+from itertools import islice
+
+# Score contributions of one preferred category to a product, as in content-based filtering
+EXACT_MATCH = 2.0
+PARTIAL_MATCH = 0.5
+TAG_MATCH = 0.3
+PRICE_BAND_BOOST = 1.2
+
+# Sorted lists kept per (preferred category, segment); cleared wholesale beyond either limit
+MAX_CACHED_LISTS = 4096
+MAX_CACHED_ENTRIES = 2000000
+
+
+def _is_snapshot(products):
+    # A snapshot can only exist once its module was imported; avoids importing NumPy here
+    module = sys.modules.get("catalog_snapshot")
+    return module is not None and isinstance(products, module.CatalogSnapshot)
+
+
+class FilterRules:
+    """Business rules deciding which catalog products may be recommended at all
+
+    Price range and blocked categories hold for the whole catalog and become one
+    boolean mask per catalog (CatalogIndex.allowed_mask). Purchased products
+    differ per customer and are passed to ranking as a small set of positions.
+    """
+
+    __slots__ = ("min_price", "max_price", "blocked_categories", "exclude_purchased")
+
+    def __init__(self, min_price=None, max_price=None, blocked_categories=(), exclude_purchased=True):
+        self.min_price = min_price
+        self.max_price = max_price
+        self.blocked_categories = frozenset(category.lower() for category in blocked_categories)
+        self.exclude_purchased = exclude_purchased
+
+    @classmethod
+    def from_env(cls):
+        """Rules from RECOMMEND_MIN_PRICE, RECOMMEND_MAX_PRICE, BLOCKED_CATEGORIES and EXCLUDE_PURCHASED"""
+        min_price = os.environ.get("RECOMMEND_MIN_PRICE")
+        max_price = os.environ.get("RECOMMEND_MAX_PRICE")
+        blocked = os.environ.get("BLOCKED_CATEGORIES", "")
+        return cls(
+            min_price=float(min_price) if min_price else None,
+            max_price=float(max_price) if max_price else None,
+            blocked_categories=[category.strip() for category in blocked.split(",") if category.strip()],
+            exclude_purchased=os.environ.get("EXCLUDE_PURCHASED", "1") == "1",
+        )
+
+    @property
+    def key(self):
+        """The catalog-wide rules, for caching masks"""
+        return (self.min_price, self.max_price, self.blocked_categories)
+
+    @property
+    def catalog_wide(self):
+        return self.min_price is not None or self.max_price is not None or bool(self.blocked_categories)
+
+    def allows(self, product):
+        """Whether the catalog-wide rules allow one product dict (small lists such as fallbacks)"""
+        price = product["price"] or 0
+        if self.min_price is not None and price < self.min_price:
+            return False
+        if self.max_price is not None and price > self.max_price:
+            return False
+        return (product["category"] or "").lower() not in self.blocked_categories
+
+
+def _segment_band(segment_type):
+    segment_type = (segment_type or "").lower()
+    return segment_type if segment_type in ("premium", "budget") else None
+
+
+class CatalogIndex:
+    """Products grouped and pre-sorted for top-k content ranking
+
+    A product's content score is a weighted sum over the customer's preferred
+    categories, times a static price-band boost. For every preferred category the
+    index keeps the matching products sorted by that category's coefficient times
+    the boost, so top_k can run the threshold algorithm: walk the lists in
+    parallel, score each newly seen product exactly, and stop as soon as the
+    k-th best score beats the best score any unseen product could still reach.
+
+    Over a CatalogSnapshot the index reads the shared, memory-mapped columns
+    directly instead of copying them into per-process lists.
+    """
+
+    def __init__(self, products):
+        self.products = products
+        self.signature = self.signature_of(products)
+        self._sorted_lists = {}
+        self._cached_entries = 0
+        self._positions = None
+        self._by_name = None
+        self._masks = {}
+        if _is_snapshot(products):
+            self._snapshot = products
+            self._categories = products.columns["category_lower"]
+            self._tags = products.columns["tags_lower"]
+            self._prices = products.prices
+            return
+        self._snapshot = None
+        self._categories = [(p["category"] or "").lower() for p in products]
+        self._tags = [(p["tags"] or "").lower() for p in products]
+        self._prices = [p["price"] or 0 for p in products]
+        self._by_category = {}
+        for product, category in zip(products, self._categories):
+            self._by_category.setdefault(category, []).append(product)
+
+    @staticmethod
+    def signature_of(products):
+        """Cheap identity of a catalog's ranking-relevant fields"""
+        if _is_snapshot(products):
+            return products.signature
+        return hash(tuple((p["product_id"], p["category"], p["price"], p["tags"]) for p in products))
+
+    def products_in_category(self, category):
+        """Products whose category equals the given one, case-insensitively, in catalog order"""
+        if self._snapshot is not None:
+            return self._snapshot.products_in_category(category)
+        return self._by_category.get(category.lower(), [])
+
+    def product_named(self, name):
+        """First catalog product with the given name, case-insensitively, or None"""
+        if self._snapshot is not None:
+            position = self._snapshot.position_named(name)
+            return None if position is None else self._snapshot[position]
+        if self._by_name is None:
+            self._by_name = {}
+            for product in self.products:
+                self._by_name.setdefault((product["product_name"] or "").lower(), product)
+        return self._by_name.get((name or "").lower())
+
+    def positions_of(self, product_ids):
+        """Catalog positions of product IDs, skipping IDs no longer in the catalog"""
+        if self._snapshot is not None:
+            return self._snapshot.positions_of(product_ids)
+        if self._positions is None:
+            self._positions = {p["product_id"]: i for i, p in enumerate(self.products)}
+        positions = self._positions
+        return [positions[pid] for pid in product_ids if pid in positions]
+
+    def allowed_mask(self, rules):
+        """Boolean mask over catalog positions of the products rules allow; None if they allow all
+
+        Built once per set of catalog-wide rules with array operations over the
+        price and category columns, so requests only index into it.
+        """
+        if rules is None or not rules.catalog_wide:
+            return None
+        mask = self._masks.get(rules.key)
+        if mask is None:
+            if self._snapshot is not None:
+                mask = self._snapshot_mask(rules)
+            else:
+                mask = bytearray(
+                    rules.allows({"price": price, "category": category})
+                    for price, category in zip(self._prices, self._categories)
+                )
+            self._masks[rules.key] = mask
+        return mask
+
+    def _snapshot_mask(self, rules):
+        import numpy as np
+
+        prices = np.where(self._snapshot.price_nulls, 0.0, self._prices)
+        mask = np.ones(len(self._snapshot), dtype=bool)
+        if rules.min_price is not None:
+            mask &= prices >= rules.min_price
+        if rules.max_price is not None:
+            mask &= prices <= rules.max_price
+        for category in rules.blocked_categories:
+            mask[self._snapshot.category_positions(category)] = False
+        return mask
+
+    def _boost(self, i, band):
+        price = self._prices[i]
+        if (band == "premium" and price > 100) or (band == "budget" and price < 50):
+            return PRICE_BAND_BOOST
+        return 1.0
+
+    def _sorted_list(self, category, band):
+        """(coefficient * boost, position) of products matching a preferred category, best first"""
+        key = (category, band)
+        entries = self._sorted_lists.get(key)
+        if entries is None and self._snapshot is not None:
+            entries = self._snapshot_sorted_list(category, band)
+        elif entries is None:
+            entries = []
+            for i, (product_category, tags) in enumerate(zip(self._categories, self._tags)):
+                coefficient = 0.0
+                if product_category == category:
+                    coefficient += EXACT_MATCH
+                if category in product_category or product_category in category:
+                    coefficient += PARTIAL_MATCH
+                if category in tags:
+                    coefficient += TAG_MATCH
+                if coefficient:
+                    entries.append((coefficient * self._boost(i, band), i))
+            entries.sort(key=lambda entry: (-entry[0], entry[1]))
+        if key not in self._sorted_lists:
+            if (len(self._sorted_lists) >= MAX_CACHED_LISTS
+                    or self._cached_entries + len(entries) > MAX_CACHED_ENTRIES):
+                self._sorted_lists.clear()
+                self._cached_entries = 0
+            self._sorted_lists[key] = entries
+            self._cached_entries += len(entries)
+        return entries
+
+    def _snapshot_sorted_list(self, category, band):
+        """_sorted_list over a snapshot as a structured array
+
+        Category terms are computed once per distinct category and tag hits come
+        from one scan of the shared tags buffer, instead of a pass over every product.
+        """
+        import numpy as np
+
+        snapshot = self._snapshot
+        coefficients = np.zeros(len(snapshot))
+        for product_category in snapshot.categories:
+            coefficient = 0.0
+            if product_category == category:
+                coefficient += EXACT_MATCH
+            if category in product_category or product_category in category:
+                coefficient += PARTIAL_MATCH
+            if coefficient:
+                coefficients[snapshot.category_positions(product_category)] = coefficient
+        coefficients[self._tags.positions_containing(category)] += TAG_MATCH
+
+        positions = np.flatnonzero(coefficients)
+        bounds = coefficients[positions]
+        entries = np.empty(len(positions), dtype=[("bound", np.float64), ("position", np.int64)])
+        if not len(positions):
+            return entries
+        prices = self._prices[positions]
+        if band == "premium":
+            bounds = np.where(prices > 100, bounds * PRICE_BAND_BOOST, bounds)
+        elif band == "budget":
+            bounds = np.where(prices < 50, bounds * PRICE_BAND_BOOST, bounds)
+        order = np.lexsort((positions, -bounds))
+        entries["bound"] = bounds[order]
+        entries["position"] = positions[order]
+        return entries
+
+    def score(self, i, category_weights, band):
+        """Exact content score of the product at position i"""
+        product_category = self._categories[i]
+        tags = self._tags[i]
+        score = 0
+        if product_category in category_weights:
+            score += category_weights[product_category] * EXACT_MATCH
+        for category, weight in category_weights.items():
+            if category in product_category or product_category in category:
+                score += weight * PARTIAL_MATCH
+        for category, weight in category_weights.items():
+            if category in tags:
+                score += weight * TAG_MATCH
+        return score * self._boost(i, band)
+
+    def top_k(self, category_weights, segment_type, k, allowed=None, excluded=()):
+        """Positive-scoring products ranked by score, ties in catalog order, as (score, position)
+
+        Products outside the allowed mask or at excluded positions are skipped
+        without being scored; skipping never loosens the stopping bound.
+        """
+        if k <= 0 or not category_weights:
+            return []
+        band = _segment_band(segment_type)
+
+        if any(weight < 0 for weight in category_weights.values()):
+            # Negative weights break the threshold bound; score every product instead
+            scored = [(self.score(i, category_weights, band), i) for i in range(len(self.products))
+                      if (allowed is None or allowed[i]) and i not in excluded]
+            return sorted((entry for entry in scored if entry[0] > 0), key=lambda e: (-e[0], e[1]))[:k]
+
+        lists = [
+            (weight, self._sorted_list(category, band))
+            for category, weight in category_weights.items() if weight > 0
+        ]
+        lists = [(weight, entries) for weight, entries in lists if len(entries)]
+
+        # Min-heap of the best k as (score, -position) so the weakest is at the root
+        heap = []
+        seen = set()
+        depth = 0
+        while True:
+            threshold = 0.0
+            progressed = False
+            for weight, entries in lists:
+                if depth >= len(entries):
+                    continue
+                bound, i = entries[depth]
+                threshold += weight * bound
+                progressed = True
+                if i in seen:
+                    continue
+                seen.add(i)
+                if (allowed is not None and not allowed[i]) or i in excluded:
+                    continue
+                score = self.score(i, category_weights, band)
+                if score <= 0:
+                    continue
+                if len(heap) < k:
+                    heapq.heappush(heap, (score, -i))
+                elif (score, -i) > heap[0]:
+                    heapq.heapreplace(heap, (score, -i))
+            if not progressed:
+                break
+            # Strictly above the bound (with float slack) so tied unseen products cannot outrank
+            if len(heap) == k and heap[0][0] > threshold * (1 + 1e-9):
+                break
+            depth += 1
+
+        return sorted(((score, -neg_i) for score, neg_i in heap), key=lambda e: (-e[0], e[1]))
+
+    def top_k_among(self, positions, category_weights, segment_type, k, allowed=None, excluded=()):
+        """Exact top k restricted to candidate positions, e.g. those returned by an ANN index"""
+        band = _segment_band(segment_type)
+        candidates = set(positions).difference(excluded)
+        if allowed is not None:
+            candidates = [i for i in candidates if allowed[i]]
+        scored = ((self.score(i, category_weights, band), i) for i in candidates)
+        return heapq.nsmallest(k, (entry for entry in scored if entry[0] > 0), key=lambda e: (-e[0], e[1]))
+
+
+def merge_ranked(content, collaborative, limit):
+    """Merge two score-sorted recommendation lists into the top `limit`
+
+    Content recommendations win duplicates and, at equal scores, come before
+    collaborative ones.
+    """
+    content_ids = {rec["product_id"] for rec in content}
+    extra, extra_ids = [], set()
+    for rec in collaborative:
+        if rec["product_id"] not in content_ids and rec["product_id"] not in extra_ids:
+            extra.append(rec)
+            extra_ids.add(rec["product_id"])
+    extra.sort(key=lambda rec: rec["score"], reverse=True)
+    merged = heapq.merge(content, extra, key=lambda rec: -rec["score"])
+    return list(islice(merged, limit))
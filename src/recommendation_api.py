@@ -1,12 +1,19 @@
 
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
-import sqlite3
 from datetime import datetime
 import json
+import os
+import threading
 
+import http_caching
+from admission import AdmissionController, Overloaded
+from artifacts import ArtifactRegistry, ArtifactStore
 from recommendation_system import RecommendationSystem
+from profiling import run_in_threadpool
+from metrics import (REGISTRY, BACKGROUND_REFRESHES, GENERATIONS_COALESCED, RECOMMENDATIONS_SERVED,
+                     RECOMMENDATIONS_SHED, Gauge)
 
 # Pydantic models for API
 class InteractionBase(BaseModel):
@@ -29,30 +36,152 @@ class RecommendationRequest(BaseModel):
     customer_id: str
     limit: Optional[int] = 10
 
-# Initialize recommendation system
-recommendation_system = RecommendationSystem()
+# Versioned serving artifacts, loaded and swapped by a background watcher started with the app
+artifacts = ArtifactRegistry(ArtifactStore(os.environ.get("ARTIFACT_DIR", "artifacts")))
+
+# Initialize recommendation system; schema setup runs at startup or as an explicit step, not on import
+recommendation_system = RecommendationSystem(artifacts=artifacts, init_schema=False)
+
+# Caps cold generations per worker; shed requests get a stale or segment-popularity fallback
+generation_admission = AdmissionController()
+REGISTRY.register(Gauge(
+    "recommendation_generations_in_flight",
+    "Recommendation generations running in this worker",
+    lambda: generation_admission.active,
+))
+REGISTRY.register(Gauge(
+    "recommendation_generations_queued",
+    "Requests in this worker waiting for a generation slot",
+    lambda: generation_admission.waiting,
+))
+
+# Stale stored sets are regenerated after they have been served (stale-while-revalidate), as
+# low-priority background work of generation_admission
+REGISTRY.register(Gauge(
+    "recommendation_refreshes_pending",
+    "Stale recommendation sets queued or being regenerated in this worker",
+    lambda: generation_admission.background,
+))
 
 # Create FastAPI router that can be imported into main app
 from fastapi import APIRouter
 
-recommendation_router = APIRouter(prefix="/recommendations", tags=["recommendations"])
+recommendation_router = APIRouter(prefix="/recommendations", tags=["recommendations"],
+                                  default_response_class=http_caching.FastJSONResponse)
+
+def _recommendation_cache_control(version):
+    # Cacheable until the stored set would be regenerated by the 24-hour freshness rule
+    return f"max-age={version['max_age']}"
+
+def _stale_body(stored_body, version):
+    # Stale bodies are re-encoded with their age, so they never share an ETag with the stored bytes
+    body = json.loads(stored_body)
+    body.update({"stale": True, "age_seconds": version["age"]})
+    return body
+
+def _refresh(customer_id, limit):
+    """Regenerate a stale stored set in the background"""
+    try:
+        recommendation_system.generate_recommendations_once(customer_id, limit)
+        BACKGROUND_REFRESHES.labels("completed").inc()
+    except Exception as e:
+        BACKGROUND_REFRESHES.labels("failed").inc()
+        print(f"Background refresh of {customer_id} failed: {e}")
+
+def _schedule_refresh(customer_id, limit):
+    # Shares the customer's flight with request-path generations; dropped while the worker is busy,
+    # and the next stale read asks again
+    if generation_admission.in_flight(customer_id):
+        BACKGROUND_REFRESHES.labels("duplicate").inc()
+    elif generation_admission.submit(_refresh, customer_id, limit, key=customer_id):
+        BACKGROUND_REFRESHES.labels("scheduled").inc()
+    else:
+        BACKGROUND_REFRESHES.labels("dropped").inc()
+
+def _degraded_response(customer_id, limit, reason):
+    """Best answer available without generating: the last stored set however old, else segment favourites
+    
+    The body is flagged degraded with the fallback used and why generation was
+    skipped, and is marked no-store so caches do not keep it past the overload.
+    It reads the database, so callers run it on the thread pool.
+    """
+    stored_body, version = recommendation_system.get_stored_response(customer_id, allow_expired=True)
+    if stored_body is not None:
+        body = _stale_body(stored_body, version) if version["stale"] else json.loads(stored_body)
+        fallback = "stale"
+    else:
+        recommendations = recommendation_system.popular_recommendations(customer_id, limit)
+        if not recommendations:
+            raise HTTPException(status_code=503, detail="Recommendations are temporarily unavailable",
+                                headers={"Retry-After": "1"})
+        body = {
+            "customer_id": customer_id,
+            "recommendations": recommendations,
+            "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        fallback = "popular"
+    body.update({"degraded": True, "fallback": fallback, "degraded_reason": reason})
+    RECOMMENDATIONS_SERVED.labels(fallback).inc()
+    return http_caching.json_response(body, cache_control="no-store")
 
 @recommendation_router.get("/{customer_id}")
-async def get_recommendations(customer_id: str, limit: int = 10):
-    """Get personalized product recommendations for a customer"""
-    # First try to get stored recent recommendations
-    stored_recs = recommendation_system.get_stored_recommendations(customer_id)
+async def get_recommendations(customer_id: str, request: Request, limit: int = 10):
+    """Get personalized product recommendations for a customer
+    
+    Responses carry a strong ETag for the stored recommendation set. A request
+    whose If-None-Match matches it gets a 304 without the payload being read.
+    Otherwise the body rendered when the set was generated is sent as-is.
+    
+    A set past its 24 hours but within the stale grace window is sent at once,
+    flagged stale with its age, and regenerated in the background.
+    
+    Generation runs under admission control. When this worker is saturated,
+    or generation overruns its latency budget, the response is a degraded
+    fallback instead of a queue that grows without bound.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        version = await run_in_threadpool(recommendation_system.stored_recommendations_version, customer_id)
+        if version and http_caching.etag_matches(if_none_match, version["etag"]):
+            RECOMMENDATIONS_SERVED.labels("not_modified").inc()
+            return http_caching.not_modified(version["etag"], _recommendation_cache_control(version))
     
-    if stored_recs:
-        return stored_recs
+    # First try to get stored recent recommendations, already rendered as JSON.
+    # SQLite reads run on the thread pool so a busy database does not stall the event loop
+    stored_body, version = await run_in_threadpool(
+        recommendation_system.get_stored_response, customer_id, allow_stale=True
+    )
+    
+    if stored_body is not None and version["stale"]:
+        _schedule_refresh(customer_id, limit)
+        RECOMMENDATIONS_SERVED.labels("revalidating").inc()
+        return http_caching.json_response(_stale_body(stored_body, version), cache_control="no-store")
     
-    # If no stored recommendations, generate new ones
-    recommendations = recommendation_system.generate_recommendations(customer_id, limit)
+    if stored_body is not None:
+        RECOMMENDATIONS_SERVED.labels("store").inc()
+        return http_caching.json_response(stored_body, version["etag"], _recommendation_cache_control(version))
+    
+    # If no stored recommendations, generate new ones, unless the worker has no capacity left.
+    # Concurrent requests for the customer share one generation and one stored set
+    if generation_admission.in_flight(customer_id):
+        GENERATIONS_COALESCED.labels("worker").inc()
+    try:
+        recommendations = await generation_admission.run(
+            recommendation_system.generate_recommendations_once, customer_id, limit, key=customer_id
+        )
+    except Overloaded as e:
+        RECOMMENDATIONS_SHED.labels(e.reason).inc()
+        return await run_in_threadpool(_degraded_response, customer_id, limit, e.reason)
     
     if "error" in recommendations:
         raise HTTPException(status_code=404, detail=recommendations["error"])
     
-    return recommendations
+    RECOMMENDATIONS_SERVED.labels("cold").inc()
+    # Serve the set just stored, so this response and later ones for the same ETag are the same bytes
+    stored_body, version = await run_in_threadpool(recommendation_system.get_stored_response, customer_id)
+    if stored_body is None:
+        return http_caching.json_response(recommendations)
+    return http_caching.json_response(stored_body, version["etag"], _recommendation_cache_control(version))
 
 @recommendation_router.post("/process-browsing")
 async def process_browsing(interaction: BrowsingInteraction):
@@ -83,3 +212,10 @@ def initialize_recommendation_database():
     """Initialize the recommendation system database tables"""
     recommendation_system.init_db()
     return {"status": "success", "message": "Recommendation system initialized"}
+
+def preload_modules():
+    """Import the NumPy-backed modules on a background thread so early requests do not pay for it"""
+    def load():
+        import similar_shoppers  # noqa: F401
+        import catalog_snapshot  # noqa: F401
+    threading.Thread(target=load, name="preload-modules", daemon=True).start()
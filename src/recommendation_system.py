@@ -1,21 +1,82 @@
 
-import pandas as pd
-import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import json
+import os
 import random
+from itertools import islice
+import time
 from typing import List, Dict, Any
 
+import catalog_loader
+import catalog_pages
+import db
+import generation_locks
+import http_caching
+import product_links
+import product_search
+from metrics import COLLABORATIVE_SOURCE, GENERATIONS_COALESCED, STORED_LOOKUPS, stage_timer
+from ranking import CatalogIndex, FilterRules, merge_ranked
+
 class RecommendationSystem:
-    def __init__(self, db_path="customers.db"):
+    # Products fetched from the ANN index per requested recommendation, then scored exactly
+    ANN_CANDIDATE_FACTOR = 20
+    # Stored recommendations are served for this long after they were generated
+    FRESHNESS = timedelta(hours=24)
+    # Past FRESHNESS, a set may still be served for this long while it is regenerated in the background
+    STALE_GRACE = timedelta(hours=float(os.environ.get("RECOMMENDATION_STALE_GRACE_HOURS", "24")))
+    # How long the segment-popularity fallback served under overload is reused before it is rebuilt
+    POPULAR_FALLBACK_TTL = 600
+    # Segment categories tried in turn for collaborative suggestions, so categories whose products
+    # the filters rule out are passed over (popularity tables keep 20 per segment)
+    POPULAR_CATEGORY_CANDIDATES = 20
+    # Recommendation sets kept per customer by the retention job; reads only ever use the newest
+    KEEP_SETS = 5
+    
+    def __init__(self, db_path="customers.db", ann_index_path=None, ann_nprobe=None, mf_model_path=None,
+                 artifacts=None, init_schema=True, fts_candidates=None, cross_worker_locks=None,
+                 filter_rules=None):
         self.db_path = db_path
-        self.init_db()
+        # Hot-swapped versions of the ANN index, factor model and popularity table take
+        # precedence over the fixed paths below (see artifacts.py)
+        self.artifacts = artifacts
+        self._cached_catalog_index = None
+        # (catalog version, product list) read from SQLite when no snapshot is published
+        self._cached_products = None
+        # Approximate candidate generation for large catalogs; exact ranking when unset
+        self.ann_index_path = ann_index_path or os.environ.get("ANN_INDEX_PATH")
+        self.ann_nprobe = ann_nprobe
+        self._ann_index = None
+        # Indexed full-text candidates for a customer's category terms when no ANN index is loaded
+        if fts_candidates is None:
+            fts_candidates = os.environ.get("FTS_CANDIDATES", "0") == "1"
+        self.fts_candidates = fts_candidates
+        # Lease per customer in SQLite so only one worker generates at a time (generate_recommendations_once)
+        if cross_worker_locks is None:
+            cross_worker_locks = os.environ.get("GENERATION_LOCKS", "0") == "1"
+        self.cross_worker_locks = cross_worker_locks
+        # Price range, blocked categories and purchased-product exclusion applied before ranking
+        self.filter_rules = filter_rules if filter_rules is not None else FilterRules.from_env()
+        # Implicit ALS factors for collaborative suggestions; similar shoppers / segment when unset
+        self.mf_model_path = mf_model_path or os.environ.get("MF_MODEL_PATH")
+        self._mf_model = None
+        self._similar_shoppers = None
+        # Per-segment fallback lists, and the popularity table they come from when none is published
+        self._popular_fallback = {}
+        # The service skips this and runs the schema step once (main.py --init-db)
+        if init_schema:
+            self.init_db()
         
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        return db.connect(self.db_path)
+    
+    @property
+    def similar_shoppers(self):
+        """MinHash index of similar customers, imported on first use since it needs NumPy"""
+        if self._similar_shoppers is None:
+            from similar_shoppers import SimilarShopperIndex
+            self._similar_shoppers = SimilarShopperIndex(self.db_path, init_schema=False)
+        return self._similar_shoppers
     
     def init_db(self):
         """Initialize the recommendation tables in the database"""
@@ -39,18 +100,54 @@ class RecommendationSystem:
             CREATE TABLE IF NOT EXISTS customer_recommendations (
                 recommendation_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 customer_id TEXT,
-                recommendations TEXT,  # JSON string containing recommended product IDs and scores
-                recommendation_type TEXT,  # e.g., 'browsing_based', 'purchase_based', 'hybrid'
+                recommendations TEXT,  -- JSON string containing recommended product IDs and scores
+                recommendation_type TEXT,  -- e.g., 'browsing_based', 'purchase_based', 'hybrid'
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (customer_id) REFERENCES customer_profiles(customer_id) ON DELETE CASCADE
             )
         ''')
         
+        cursor.execute("PRAGMA table_info(customer_recommendations)")
+        columns = {row[1] for row in cursor.fetchall()}
+        # Response body rendered at generation time, and the catalog it was rendered against
+        for column, column_type in (("rendered", "BLOB"), ("rendered_catalog", "TEXT")):
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE customer_recommendations ADD COLUMN {column} {column_type}")
+        
+        # Latest stored set per customer (stored lookups, conditional requests)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_customer_recommendations_customer
+            ON customer_recommendations (customer_id, created_at)
+        ''')
+        
+        # Catalog version, bumped by bulk loads (see catalog_loader.py)
+        catalog_loader.init_db(cursor)
+        
+        # Full-text index over the catalog, maintained by triggers
+        product_search.init_db(cursor)
+        
+        # Category index for catalog listings
+        catalog_pages.init_db(cursor)
+        
+        # Cross-worker generation leases
+        generation_locks.init_db(cursor)
+        
         conn.commit()
         conn.close()
         
+        from similar_shoppers import SimilarShopperIndex
+        SimilarShopperIndex(self.db_path, init_schema=False).init_db()
+        
         # Generate sample product catalog if empty
         self._ensure_product_catalog()
+        
+        # Purchase rows linked to catalog IDs, for excluding purchased products
+        conn = self.get_connection()
+        linked = product_links.init_db(conn.cursor())
+        conn.commit()
+        conn.close()
+        if linked:
+            print(f"Linked {linked} purchases to catalog products")
     
     def _ensure_product_catalog(self):
         """Make sure we have a product catalog with sample data for recommendations"""
@@ -122,12 +219,12 @@ class RecommendationSystem:
             ]
             
             # Insert sample products
-            for product in sample_products:
-                cursor.execute('''
-                    INSERT INTO product_catalog (product_name, product_category, price, description, tags)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (product["name"], product["category"], product["price"], 
-                      product["description"], product["tags"]))
+            cursor.executemany('''
+                INSERT INTO product_catalog (product_name, product_category, price, description, tags)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(product["name"], product["category"], product["price"],
+                   product["description"], product["tags"]) for product in sample_products])
+            cursor.execute("UPDATE catalog_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1")
             
             conn.commit()
         
@@ -164,7 +261,7 @@ class RecommendationSystem:
         
         # Get purchase history (last 180 days)
         cursor.execute("""
-            SELECT product_name, product_category, price 
+            SELECT product_name, product_category, price, product_id 
             FROM purchase_history 
             WHERE customer_id = ?
             AND order_date >= datetime('now', '-180 days')
@@ -188,13 +285,32 @@ class RecommendationSystem:
             },
             "browsing_history": [category[0] for category in browsing_history],
             "purchase_history": [
-                {"product_name": p[0], "category": p[1], "price": p[2]} 
+                {"product_name": p[0], "category": p[1], "price": p[2], "product_id": p[3]} 
                 for p in purchase_history
             ]
         }
     
     def _get_all_products(self):
-        """Get all products from the catalog"""
+        """Get all products from the catalog
+        
+        A published catalog snapshot is shared read-only by every worker and needs no
+        query; without one the catalog is read from SQLite once per catalog version
+        and the same list is returned until a load (or the sample seed) bumps it.
+        Callers must not modify it.
+        """
+        with stage_timer("catalog"):
+            snapshot = self._artifact("catalog")
+            if snapshot is not None:
+                return snapshot
+            # Read before the rows, so a load committed in between is only ever picked up early
+            version = catalog_loader.catalog_version(self.db_path)
+            cached = self._cached_products
+            if cached is None or cached[0] != version:
+                cached = (version, self._load_products())
+                self._cached_products = cached
+            return cached[1]
+    
+    def _load_products(self):
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -248,57 +364,220 @@ class RecommendationSystem:
         
         return categories
     
-    def _content_based_filtering(self, customer_id, category_weights, top_n=10):
-        """Generate recommendations based on product content and user preferences"""
-        products = self._get_all_products()
+    def _catalog_index(self, products):
+        """Ranking index for a product list, rebuilt only when the catalog has changed
+        
+        Lists are compared by identity: _get_all_products returns the same list for
+        as long as the catalog version stands, and callers scoring many customers
+        pass one preloaded list. Snapshots are compared by their stored signature.
+        Nothing here is O(catalog) unless the index is actually rebuilt.
+        """
+        index = self._cached_catalog_index
+        if index is not None and (index.products is products
+                                  or index.signature == getattr(products, "signature", None)):
+            return index
+        index = CatalogIndex(products)
+        self._cached_catalog_index = index
+        return index
+    
+    def _artifact(self, name):
+        return self.artifacts.get(name) if self.artifacts is not None else None
+    
+    def _get_ann_index(self):
+        """Memory-mapped ANN index when one is configured and built, else None"""
+        published = self._artifact("ann_index")
+        if published is not None:
+            return published
+        if self._ann_index is None and self.ann_index_path and os.path.exists(self.ann_index_path):
+            from ann_index import IVFIndex
+            self._ann_index = IVFIndex.load(self.ann_index_path)
+        return self._ann_index
+    
+    def _get_mf_model(self):
+        """Memory-mapped factor model when one is configured and trained, else None"""
+        published = self._artifact("mf_model")
+        if published is not None:
+            return published
+        if self._mf_model is None and self.mf_model_path and os.path.exists(self.mf_model_path):
+            from matrix_factorization import FactorModel
+            self._mf_model = FactorModel.load(self.mf_model_path)
+        return self._mf_model
+    
+    def _content_based_filtering(self, customer_data, category_weights, top_n=10, products=None,
+                                 allowed=None, excluded=()):
+        """Generate recommendations based on product content and user preferences
+        
+        allowed and excluded come from _filters(); products they rule out are never scored.
+        """
+        if products is None:
+            products = self._get_all_products()
         
         if not products or not category_weights:
             return []
         
-        # Score products based on category weights
-        scored_products = []
-        for product in products:
-            score = 0
-            product_category = product["category"].lower()
-            
-            # Direct category match
-            if product_category in category_weights:
-                score += category_weights[product_category] * 2
-            
-            # Check for partial matches in category name
-            for category, weight in category_weights.items():
-                if category in product_category or product_category in category:
-                    score += weight * 0.5
-            
-            # Check if any category keyword is in product tags
-            for category, weight in category_weights.items():
-                if category in product["tags"].lower():
-                    score += weight * 0.3
-            
-            # Adjust score based on customer segment and product price
-            customer_data = self._get_customer_data(customer_id)
-            if customer_data:
-                segment_type = customer_data["segment"]["type"].lower()
-                if segment_type == "premium" and product["price"] > 100:
-                    score *= 1.2
-                elif segment_type == "budget" and product["price"] < 50:
-                    score *= 1.2
-            
-            if score > 0:
-                scored_products.append({
+        index = self._catalog_index(products)
+        segment_type = customer_data["segment"]["type"]
+        ann_index = self._get_ann_index()
+        if ann_index is not None:
+            # Nearest products to the customer's preference vector, re-scored exactly
+            candidate_ids, _ = ann_index.search(
+                ann_index.encoder.preference_vector(category_weights),
+                k=max(top_n, 1) * self.ANN_CANDIDATE_FACTOR, nprobe=self.ann_nprobe
+            )
+            positions = index.positions_of(candidate_ids.tolist())
+            top = index.top_k_among(positions, category_weights, segment_type, top_n, allowed, excluded)
+        elif self.fts_candidates:
+            # Products whose category or tags contain the customer's top category terms, re-scored exactly
+            conn = self.get_connection()
+            candidate_ids = product_search.category_candidates(
+                conn.cursor(), category_weights, per_term=max(top_n, 1) * self.ANN_CANDIDATE_FACTOR
+            )
+            conn.close()
+            positions = index.positions_of(candidate_ids)
+            top = index.top_k_among(positions, category_weights, segment_type, top_n, allowed, excluded)
+        else:
+            # Top N by threshold pruning over pre-sorted per-category lists, not a full sort
+            top = index.top_k(category_weights, segment_type, top_n, allowed, excluded)
+        
+        recommendations = []
+        for score, i in top:
+            product = index.products[i]
+            recommendations.append({
+                "product_id": product["product_id"],
+                "score": score,
+                "product_name": product["product_name"],
+                "category": product["category"],
+                "price": product["price"]
+            })
+        return recommendations
+    
+    def _collaborative_based_suggestions(self, customer_id, top_n=5, popular_categories=None, products=None,
+                                         allowed=None, excluded=()):
+        """Suggestions from similar shoppers' recent purchases, falling back to the customer's segment
+        
+        Callers passing popular_categories (offline evaluation) always get the segment-based path,
+        which takes one product from each category in turn until it has top_n.
+        Products the filters rule out (allowed, excluded as from _filters) are
+        skipped while candidates are picked, so they do not shorten the list.
+        """
+        if top_n <= 0:
+            return []
+        
+        if products is None:
+            products = self._get_all_products()
+        
+        if popular_categories is None:
+            suggestions = self._factor_suggestions(customer_id, top_n, products, allowed, excluded)
+            if suggestions:
+                COLLABORATIVE_SOURCE.labels("factors").inc()
+                return suggestions
+            suggestions = self._similar_shopper_suggestions(customer_id, top_n, products, allowed, excluded)
+            if suggestions:
+                COLLABORATIVE_SOURCE.labels("neighbours").inc()
+                return suggestions
+            COLLABORATIVE_SOURCE.labels("segment").inc()
+            popular_categories = self._segment_popular_categories(customer_id, self.POPULAR_CATEGORY_CANDIDATES)
+        
+        if not popular_categories:
+            return []
+        
+        # Get products from these categories
+        index = self._catalog_index(products)
+        collaborative_suggestions = []
+        for category in popular_categories:
+            category_products = index.products_in_category(category)
+            if category_products:
+                # Pick a random product from this category to add diversity: the first one
+                # the filters admit, scanning on from a random position
+                start = random.randrange(len(category_products))
+                for offset in range(len(category_products)):
+                    product = category_products[(start + offset) % len(category_products)]
+                    if self._admits(index, allowed, excluded, product["product_id"]):
+                        break
+                else:
+                    continue
+                collaborative_suggestions.append({
                     "product_id": product["product_id"],
-                    "score": score,
                     "product_name": product["product_name"],
                     "category": product["category"],
-                    "price": product["price"]
+                    "price": product["price"],
+                    "score": 0.5  # Default score for collaborative suggestions
                 })
+                if len(collaborative_suggestions) == top_n:
+                    break
         
-        # Sort by score and get top N
-        scored_products.sort(key=lambda x: x["score"], reverse=True)
-        return scored_products[:top_n]
+        return collaborative_suggestions
     
-    def _collaborative_based_suggestions(self, customer_id, top_n=5):
-        """Simple collaborative-like suggestions based on user segment"""
+    def _factor_suggestions(self, customer_id, top_n, products, allowed=None, excluded=()):
+        """Top products by user-item factor score, excluding ones already bought or ruled out by the filters"""
+        model = self._get_mf_model()
+        if model is None or model.user_vector(customer_id) is None:
+            return []
+        
+        index = self._catalog_index(products)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT product_name FROM purchase_history WHERE customer_id = ?", (customer_id,))
+        owned = [index.product_named(row[0]) for row in cursor.fetchall()]
+        conn.close()
+        
+        owned_ids = {p["product_id"] for p in owned if p}
+        # Ask the model for more candidates until enough of them pass the filters
+        fetch = top_n
+        while True:
+            scored = model.recommend(customer_id, fetch, exclude=owned_ids)
+            kept = [(product_id, score) for product_id, score in scored
+                    if self._admits(index, allowed, excluded, product_id)][:top_n]
+            if len(kept) == top_n or len(scored) < fetch:
+                break
+            fetch *= 4
+        positions = index.positions_of([product_id for product_id, _ in kept])
+        if not positions:
+            return []
+        best_score = max(kept[0][1], 1e-9)
+        score_by_id = dict(kept)
+        
+        suggestions = []
+        for i in positions:
+            product = index.products[i]
+            suggestions.append({
+                "product_id": product["product_id"],
+                "product_name": product["product_name"],
+                "category": product["category"],
+                "price": product["price"],
+                # Same ceiling as segment suggestions, scaled by the factor score
+                "score": 0.5 * max(score_by_id[product["product_id"]], 0) / best_score
+            })
+        return suggestions
+    
+    def _similar_shopper_suggestions(self, customer_id, top_n, products, allowed=None, excluded=()):
+        """Products recently bought by the customer's nearest MinHash neighbours, best supported first"""
+        purchases = self.similar_shoppers.neighbour_purchases(customer_id)
+        if not purchases:
+            return []
+        
+        index = self._catalog_index(products)
+        best_support = purchases[0][2]
+        suggestions = []
+        for product_name, _, support in purchases:
+            product = index.product_named(product_name)
+            if product is None or not self._admits(index, allowed, excluded, product["product_id"]):
+                continue
+            suggestions.append({
+                "product_id": product["product_id"],
+                "product_name": product["product_name"],
+                "category": product["category"],
+                "price": product["price"],
+                # Same ceiling as segment suggestions, scaled by neighbour support
+                "score": 0.5 * support / best_support
+            })
+            if len(suggestions) == top_n:
+                break
+        
+        return suggestions
+    
+    def _segment_popular_categories(self, customer_id, top_n=5):
+        """Most purchased categories among other customers in the same segment"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -315,6 +594,12 @@ class RecommendationSystem:
         
         segment = segment_result[0]
         
+        # Precomputed per-segment table when published; it also counts the customer's own purchases
+        popularity = self._artifact("popularity")
+        if popularity is not None and segment in popularity:
+            conn.close()
+            return popularity[segment][:top_n]
+        
         # Find similar users in the same segment
         cursor.execute("""
             SELECT DISTINCT ph.product_category 
@@ -329,71 +614,143 @@ class RecommendationSystem:
         popular_categories = cursor.fetchall()
         conn.close()
         
-        if not popular_categories:
-            return []
-        
-        # Get products from these categories
-        popular_categories = [cat[0] for cat in popular_categories]
-        products = self._get_all_products()
-        
-        collaborative_suggestions = []
-        for category in popular_categories:
-            category_products = [p for p in products if p["category"].lower() == category.lower()]
-            if category_products:
-                # Pick a random product from this category to add diversity
-                product = random.choice(category_products)
-                collaborative_suggestions.append({
-                    "product_id": product["product_id"],
-                    "product_name": product["product_name"],
-                    "category": product["category"],
-                    "price": product["price"],
-                    "score": 0.5  # Default score for collaborative suggestions
-                })
+        return [cat[0] for cat in popular_categories]
+    
+    def _filters(self, index, customer_data):
+        """(allowed mask, excluded positions) of the filter rules for one customer
         
-        return collaborative_suggestions
+        The mask covers the catalog-wide rules and is built once per catalog; the
+        customer's purchases, already linked to catalog IDs at ingestion, become
+        a set of positions with one ID lookup and no name matching.
+        """
+        allowed = index.allowed_mask(self.filter_rules)
+        excluded = ()
+        if self.filter_rules.exclude_purchased:
+            purchased = {p["product_id"] for p in customer_data["purchase_history"] if p.get("product_id") is not None}
+            if purchased:
+                excluded = frozenset(index.positions_of(purchased))
+        return allowed, excluded
     
-    def generate_recommendations(self, customer_id, limit=10):
-        """Generate personalized product recommendations for a customer"""
-        customer_data = self._get_customer_data(customer_id)
+    @staticmethod
+    def _admits(index, allowed, excluded, product_id):
+        """Whether the filters admit a product picked outside the index's ranking (collaborative)"""
+        if allowed is None and not excluded:
+            return True
+        positions = index.positions_of([product_id])
+        return bool(positions) and (allowed is None or allowed[positions[0]]) and positions[0] not in excluded
+    
+    def rank_for_customer(self, customer_data, limit=10, products=None, popular_categories=None):
+        """Rank products for already loaded customer data without touching stored recommendations
         
-        if not customer_data:
-            return {"error": "Customer not found"}
+        Callers that score many customers (e.g. offline evaluation) pass a preloaded
+        product list and the segment's popular categories to avoid per-customer queries.
+        """
+        customer_id = customer_data["profile"]["customer_id"]
+        if products is None:
+            products = self._get_all_products()
+        
+        # Business-rule filters, applied inside ranking rather than to its output
+        with stage_timer("filters"):
+            index = self._catalog_index(products)
+            allowed, excluded = self._filters(index, customer_data)
         
         # Calculate category weights based on browsing and purchase history
-        category_weights = self._calculate_category_weights(customer_data)
+        with stage_timer("category_weights"):
+            category_weights = self._calculate_category_weights(customer_data)
         
         # Generate content-based recommendations
-        content_recommendations = self._content_based_filtering(
-            customer_id, category_weights, top_n=int(limit * 0.7)
-        )
+        with stage_timer("content_filtering"):
+            content_recommendations = self._content_based_filtering(
+                customer_data, category_weights, top_n=int(limit * 0.7), products=products,
+                allowed=allowed, excluded=excluded
+            )
         
         # Get collaborative-based suggestions to add diversity
-        collaborative_recommendations = self._collaborative_based_suggestions(
-            customer_id, top_n=int(limit * 0.3)
-        )
+        with stage_timer("collaborative"):
+            collaborative_recommendations = self._collaborative_based_suggestions(
+                customer_id, top_n=int(limit * 0.3),
+                popular_categories=popular_categories, products=products,
+                allowed=allowed, excluded=excluded
+            )
         
-        # Combine recommendations, ensuring no duplicates
-        all_recommendations = content_recommendations.copy()
-        existing_ids = {rec["product_id"] for rec in all_recommendations}
+        # Both lists are already score-sorted, so merge them instead of re-sorting
+        return merge_ranked(content_recommendations, collaborative_recommendations, limit)
+    
+    def generate_recommendations(self, customer_id, limit=10):
+        """Generate personalized product recommendations for a customer"""
+        with stage_timer("customer_data"):
+            customer_data = self._get_customer_data(customer_id)
         
-        for rec in collaborative_recommendations:
-            if rec["product_id"] not in existing_ids and len(all_recommendations) < limit:
-                all_recommendations.append(rec)
-                existing_ids.add(rec["product_id"])
+        if not customer_data:
+            return {"error": "Customer not found"}
         
-        # Sort final recommendations by score
-        all_recommendations.sort(key=lambda x: x["score"], reverse=True)
+        # Read before ranking, so a catalog load during ranking leaves the render marked stale
+        catalog_tag = self._current_catalog_tag()
+        all_recommendations = self.rank_for_customer(customer_data, limit)
         
         # Store recommendations in the database
-        self._store_recommendations(customer_id, all_recommendations)
+        with stage_timer("store"):
+            self._store_recommendations(customer_id, all_recommendations, catalog_tag)
         
         return {
             "customer_id": customer_id,
-            "recommendations": all_recommendations[:limit]
+            "recommendations": all_recommendations
         }
     
-    def _store_recommendations(self, customer_id, recommendations):
-        """Store generated recommendations in the database"""
+    def generate_recommendations_once(self, customer_id, limit=10):
+        """generate_recommendations, run by only one worker at a time for a customer
+        
+        With cross-worker locks enabled, the worker that takes the customer's
+        lease generates and stores; workers that find it taken wait for the
+        lease to go and return the stored set instead of generating their own.
+        A worker that died holding a lease delays the others by at most the
+        lease TTL. Without cross-worker locks this is generate_recommendations.
+        """
+        if not self.cross_worker_locks:
+            return self.generate_recommendations(customer_id, limit)
+        
+        key = f"recommendations:{customer_id}"
+        owner = generation_locks.new_owner()
+        conn = self.get_connection()
+        try:
+            if generation_locks.acquire(conn, key, owner):
+                try:
+                    return self.generate_recommendations(customer_id, limit)
+                finally:
+                    generation_locks.release(conn, key, owner)
+            
+            GENERATIONS_COALESCED.labels("cross_worker").inc()
+            while generation_locks.is_held(conn, key):
+                time.sleep(generation_locks.POLL_SECONDS)
+        finally:
+            conn.close()
+        
+        stored = self.get_stored_recommendations(customer_id)
+        if stored is not None:
+            return {"customer_id": customer_id, "recommendations": stored["recommendations"]}
+        # The other worker stored nothing (e.g. it failed); generate here
+        return self.generate_recommendations(customer_id, limit)
+    
+    def _render_stored(self, customer_id, recommendations, timestamp):
+        """The stored-recommendations response body as JSON bytes"""
+        return http_caching.dumps({
+            "customer_id": customer_id,
+            "recommendations": [{
+                "product_id": rec["product_id"],
+                "product_name": rec["product_name"],
+                "category": rec["category"],
+                "price": rec["price"],
+                "score": rec["score"]
+            } for rec in recommendations],
+            "timestamp": timestamp
+        })
+    
+    def _store_recommendations(self, customer_id, recommendations, catalog_tag=None):
+        """Store generated recommendations in the database
+        
+        The response body for the stored path is rendered once here and kept
+        with the catalog it was rendered against, so reads can send it as-is.
+        """
         if not recommendations:
             return
         
@@ -403,6 +760,9 @@ class RecommendationSystem:
             "score": rec["score"],
             "timestamp": datetime.now().isoformat()
         } for rec in recommendations])
+        # Same text as SQLite's datetime('now'); it is also the body's timestamp
+        created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        rendered = self._render_stored(customer_id, recommendations, created_at) if catalog_tag else None
         
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -410,36 +770,184 @@ class RecommendationSystem:
         # Store new recommendations
         cursor.execute("""
             INSERT INTO customer_recommendations 
-            (customer_id, recommendations, recommendation_type, created_at)
-            VALUES (?, ?, ?, datetime('now'))
-        """, (customer_id, rec_json, "hybrid"))
+            (customer_id, recommendations, recommendation_type, created_at, rendered, rendered_catalog)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (customer_id, rec_json, "hybrid", created_at, rendered, catalog_tag))
+        # Older sets are removed by the recommendation_retention job (see prune_recommendations)
+        
+        conn.commit()
+        conn.close()
+    
+    def prune_recommendations(self, keep=KEEP_SETS, batch_size=1000, stop=None):
+        """Delete all but each customer's keep newest recommendation sets; returns the number deleted
         
-        # Keep only the most recent 5 recommendation sets per customer
+        Runs as a background job, so storing a new set does not also pay for the
+        cleanup. Customers are walked once, in key order along the customer
+        index, and each transaction deletes the surplus of customers adding up
+        to about batch_size sets. Stops between batches once stop (a
+        threading.Event) is set.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        deleted = 0
+        after = None
+        try:
+            while stop is None or not stop.is_set():
+                # The next customers holding more than keep sets, resuming after the last batch
+                cursor.execute(f"""
+                    SELECT customer_id, COUNT(*) - :keep FROM customer_recommendations
+                    WHERE {"customer_id > :after" if after is not None else "customer_id IS NOT NULL"}
+                    GROUP BY customer_id
+                    HAVING COUNT(*) > :keep
+                    ORDER BY customer_id
+                    LIMIT :limit
+                """, {"keep": keep, "after": after, "limit": batch_size})
+                customers, surplus = [], 0
+                for customer_id, extra in cursor.fetchall():
+                    customers.append(customer_id)
+                    surplus += extra
+                    if surplus >= batch_size:
+                        break
+                if not customers:
+                    break
+                # Each customer's sets past the keep newest, read newest first from the same index
+                cursor.executemany("""
+                    DELETE FROM customer_recommendations
+                    WHERE recommendation_id IN (
+                        SELECT recommendation_id FROM customer_recommendations
+                        WHERE customer_id = ?
+                        ORDER BY created_at DESC, recommendation_id DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                """, [(customer_id, keep) for customer_id in customers])
+                conn.commit()
+                deleted += cursor.rowcount
+                after = customers[-1]
+        finally:
+            conn.close()
+        return deleted
+    
+    def precompute_candidates(self, active_days=7, lead=timedelta(hours=2), limit=200):
+        """Recently active customers whose newest set is missing or expires within lead
+        
+        Customers seen most recently come first, so a bounded precompute run
+        covers the ones most likely to ask next.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
         cursor.execute("""
-            DELETE FROM customer_recommendations
-            WHERE recommendation_id NOT IN (
-                SELECT recommendation_id
-                FROM customer_recommendations
-                WHERE customer_id = ?
-                ORDER BY created_at DESC
-                LIMIT 5
+            SELECT customer_id FROM (
+                SELECT customer_id, MAX(timestamp) AS seen FROM browsing_history
+                WHERE timestamp >= datetime('now', ?)
+                GROUP BY customer_id
+                UNION ALL
+                SELECT customer_id, MAX(order_date) FROM purchase_history
+                WHERE order_date >= datetime('now', ?)
+                GROUP BY customer_id
+            ) active
+            WHERE customer_id IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM customer_recommendations r
+                WHERE r.customer_id = active.customer_id AND r.created_at >= datetime('now', ?)
             )
-            AND customer_id = ?
-        """, (customer_id, customer_id))
+            GROUP BY customer_id
+            ORDER BY MAX(seen) DESC
+            LIMIT ?
+        """, (f"-{active_days} days", f"-{active_days} days",
+              f"-{int((self.FRESHNESS - lead).total_seconds())} seconds", limit))
+        customer_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return customer_ids
+    
+    def _freshness_left(self, created_at):
+        """Time until a stored set generated at created_at expires; zero or negative once it has"""
+        rec_time = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+        return self.FRESHNESS - (datetime.now() - rec_time)
+    
+    def _catalog_tag(self, catalog_version):
+        """Identity of the catalog that product details are read from: snapshot signature or catalog version"""
+        snapshot = self._artifact("catalog")
+        return snapshot.signature[:16] if snapshot is not None else f"v{catalog_version or 0}"
+    
+    def _current_catalog_tag(self):
+        if self._artifact("catalog") is not None:
+            return self._catalog_tag(None)
+        return self._catalog_tag(catalog_loader.catalog_version(self.db_path))
+    
+    def _stored_version(self, recommendation_id, created_at, catalog_tag):
+        """Validators for a stored set: a strong ETag, the seconds of freshness it has left and its age
         
-        conn.commit()
+        The stored set's row ID changes whenever the customer's recommendations are
+        regenerated, and product details are joined from the catalog, so the ETag
+        covers both the set and the catalog it was rendered against. stale is
+        set once the set is past FRESHNESS.
+        """
+        freshness_left = self._freshness_left(created_at)
+        return {
+            "etag": f'"{recommendation_id}-{catalog_tag}"',
+            "max_age": max(int(freshness_left.total_seconds()), 0),
+            "age": max(int((self.FRESHNESS - freshness_left).total_seconds()), 0),
+            "stale": freshness_left <= timedelta(0),
+        }
+    
+    def stored_recommendations_version(self, customer_id):
+        """Validators of the customer's current stored recommendations, or None if there are none
+        
+        Reads one index entry and the catalog version, neither the stored payload
+        nor the catalog, so a matching conditional request costs a single query.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT recommendation_id, created_at, (SELECT version FROM catalog_state WHERE id = 1)
+            FROM customer_recommendations
+            WHERE customer_id = ?
+            ORDER BY created_at DESC, recommendation_id DESC
+            LIMIT 1
+        """, (customer_id,))
+        result = cursor.fetchone()
         conn.close()
+        
+        if not result or self._freshness_left(result[1]) <= timedelta(0):
+            return None
+        recommendation_id, created_at, catalog_version = result
+        return self._stored_version(recommendation_id, created_at, self._catalog_tag(catalog_version))
+    
+    def get_stored_recommendations(self, customer_id, versioned=False):
+        """Retrieve the most recent stored recommendations for a customer
+        
+        With versioned=True, returns (recommendations, validators) so the caller
+        can send an ETag that matches the body; (None, None) when nothing is stored.
+        """
+        body, version = self.get_stored_response(customer_id)
+        stored = json.loads(body) if body is not None else None
+        return (stored, version) if versioned else stored
     
-    def get_stored_recommendations(self, customer_id):
-        """Retrieve the most recent stored recommendations for a customer"""
+    def get_stored_response(self, customer_id, use_rendered=True, allow_expired=False, allow_stale=False):
+        """(JSON bytes, validators) of the customer's stored recommendations, or (None, None)
+        
+        The body is the one rendered when the set was generated, unless the
+        catalog has changed since; then it is rebuilt from the catalog and the
+        new rendering is saved. use_rendered=False always rebuilds (benchmarks).
+        allow_stale=True also returns a set past FRESHNESS but within
+        STALE_GRACE, and allow_expired=True one of any age, for serving
+        something while the set is regenerated or when there is no capacity to.
+        Such sets have validators with stale set.
+        """
+        with stage_timer("stored_lookup"):
+            return self._lookup_stored_recommendations(customer_id, use_rendered, allow_expired, allow_stale)
+    
+    def _lookup_stored_recommendations(self, customer_id, use_rendered=True, allow_expired=False,
+                                       allow_stale=False):
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("""
-            SELECT recommendations, created_at 
+            SELECT recommendations, created_at, recommendation_id, rendered, rendered_catalog,
+                   (SELECT version FROM catalog_state WHERE id = 1)
             FROM customer_recommendations
             WHERE customer_id = ?
-            ORDER BY created_at DESC
+            ORDER BY created_at DESC, recommendation_id DESC
             LIMIT 1
         """, (customer_id,))
         
@@ -447,28 +955,36 @@ class RecommendationSystem:
         conn.close()
         
         if not result:
-            return None
+            STORED_LOOKUPS.labels("miss").inc()
+            return None, None
         
-        rec_json, timestamp = result
-        rec_data = json.loads(rec_json)
+        rec_json, timestamp, recommendation_id, rendered, rendered_catalog, catalog_version = result
         
-        # Check if recommendations are recent (within last 24 hours)
-        rec_time = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-        is_recent = (datetime.now() - rec_time) < timedelta(hours=24)
+        # Check if recommendations are recent (within last 24 hours), or recent enough for the caller
+        freshness_left = self._freshness_left(timestamp)
+        if freshness_left <= timedelta(0):
+            if not (allow_expired or (allow_stale and -freshness_left < self.STALE_GRACE)):
+                # If recommendations are old, generate new ones
+                STORED_LOOKUPS.labels("expired").inc()
+                return None, None
         
-        if not is_recent:
-            # If recommendations are old, generate new ones
-            return None
+        catalog_tag = self._catalog_tag(catalog_version)
+        version = self._stored_version(recommendation_id, timestamp, catalog_tag)
+        if use_rendered and rendered is not None and rendered_catalog == catalog_tag:
+            STORED_LOOKUPS.labels("stale" if version["stale"] else "hit").inc()
+            return bytes(rendered), version
+        
+        rec_data = json.loads(rec_json)
         
         # Get product details for the recommended products
-        products = self._get_all_products()
-        product_map = {p["product_id"]: p for p in products}
+        index = self._catalog_index(self._get_all_products())
         
         recommendations = []
         for rec in rec_data:
             product_id = rec["product_id"]
-            if product_id in product_map:
-                product = product_map[product_id]
+            positions = index.positions_of([product_id])
+            if positions:
+                product = index.products[positions[0]]
                 recommendations.append({
                     "product_id": product_id,
                     "product_name": product["product_name"],
@@ -477,11 +993,89 @@ class RecommendationSystem:
                     "score": rec["score"]
                 })
         
-        return {
-            "customer_id": customer_id,
-            "recommendations": recommendations,
-            "timestamp": timestamp
-        }
+        body = self._render_stored(customer_id, recommendations, timestamp)
+        if use_rendered:
+            self._save_rendered(recommendation_id, body, catalog_tag)
+        STORED_LOOKUPS.labels("stale" if version["stale"] else "rerendered").inc()
+        return body, version
+    
+    def _save_rendered(self, recommendation_id, body, catalog_tag):
+        """Keep a re-rendered body for later reads; skipped if the database is busy with other writes"""
+        conn = self.get_connection()
+        try:
+            conn.execute("""
+                UPDATE customer_recommendations SET rendered = ?, rendered_catalog = ?
+                WHERE recommendation_id = ?
+            """, (body, catalog_tag, recommendation_id))
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            print(f"Could not save rendered recommendations {recommendation_id}: {e}")
+        finally:
+            conn.close()
+    
+    def _fallback_popularity(self):
+        """Segment popularity table from the published artifact, empty until the popularity job has published one
+        
+        Never computed here: the fallback serves requests shed because the
+        worker is overloaded, which is no time for a scan of the segment table.
+        """
+        return self._artifact("popularity") or {}
+    
+    def popular_recommendations(self, customer_id, limit=10):
+        """Popular products of the customer's segment, for when personalised ones cannot be generated
+        
+        Needs one primary-key lookup for the segment; the list itself is built
+        from the published popularity table and category index reads, and reused
+        per segment for POPULAR_FALLBACK_TTL seconds. Customers without a segment
+        get the categories popular across all segments. Empty if nothing is known.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT customer_segment FROM customer_segments WHERE customer_id = ?", (customer_id,))
+        row = cursor.fetchone()
+        conn.close()
+        segment = row[0] if row else None
+        
+        cached = self._popular_fallback.get(segment)
+        if cached is not None and time.monotonic() - cached[0] < self.POPULAR_FALLBACK_TTL and len(cached[1]) >= limit:
+            return cached[1][:limit]
+        
+        table = self._fallback_popularity()
+        categories = table.get(segment) if segment is not None else None
+        if not categories:
+            # Interleave every segment's list, so each contributes its most popular categories first
+            categories = []
+            for rank in range(max((len(c) for c in table.values()), default=0)):
+                for segment_categories in table.values():
+                    if rank < len(segment_categories) and segment_categories[rank] not in categories:
+                        categories.append(segment_categories[rank])
+        
+        # Spread the list over the top categories, a few products from each
+        categories = categories[:limit]
+        per_category = -(-limit // len(categories)) if categories else 0
+        snapshot = self._artifact("catalog")
+        recommendations = []
+        for rank, category in enumerate(categories):
+            if snapshot is not None:
+                products = islice(snapshot.products_in_category(category), per_category)
+            else:
+                products = catalog_pages.fetch_page(self.db_path, category, limit=per_category)["products"]
+            for product in products:
+                if not self.filter_rules.allows(product):
+                    continue
+                recommendations.append({
+                    "product_id": product["product_id"],
+                    "product_name": product["product_name"],
+                    "category": product["category"],
+                    "price": product["price"],
+                    # Same ceiling as segment suggestions, lower for less popular categories
+                    "score": 0.5 / (rank + 1)
+                })
+        # Ordered by category popularity, then catalog order within a category
+        recommendations.sort(key=lambda rec: -rec["score"])
+        
+        self._popular_fallback[segment] = (time.monotonic(), recommendations)
+        return recommendations[:limit]
     
     def process_new_interaction(self, customer_id, interaction_type, data):
         """Process a new user interaction to update recommendations"""
@@ -490,6 +1084,17 @@ class RecommendationSystem:
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # Keep the customer's similar-shopper signature current
+        if interaction_type == "browsing":
+            self.similar_shoppers.add_interaction(customer_id, categories=[data.get("category")])
+        elif interaction_type == "purchase":
+            items = data.get("items", [])
+            self.similar_shoppers.add_interaction(
+                customer_id,
+                categories=[item.get("product_category") for item in items],
+                product_names=[item.get("product_name") for item in items]
+            )
+        
         # Mark existing recommendations as outdated by setting a flag or deleting them
         # Here we'll use a simple approach of just deleting them
         cursor.execute("""
@@ -0,0 +1,449 @@
+import argparse
+import json
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import islice
+
+import numpy as np
+
+import db
+
+
+def _sample_customers(db_path, count):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT customer_id FROM customer_profiles ORDER BY random() LIMIT ?", (count,))
+    customer_ids = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return customer_ids
+
+
+def benchmark_sql(db_path="customers.db", customers=200, slow_query_ms=None, top=15):
+    """Generate recommendations for a sample of customers with every statement traced"""
+    from recommendation_system import RecommendationSystem
+
+    system = RecommendationSystem(db_path)
+    customer_ids = _sample_customers(db_path, customers)
+
+    with db.sql_tracing(sample_rate=1.0, slow_query_ms=slow_query_ms) as stats:
+        start = time.perf_counter()
+        for customer_id in customer_ids:
+            system.generate_recommendations(customer_id)
+        elapsed = time.perf_counter() - start
+
+    print(f"Generated recommendations for {len(customer_ids)} customers in {elapsed:.2f}s "
+          f"({1000 * elapsed / max(len(customer_ids), 1):.2f} ms/customer)")
+    print("\nTop statements by total time:")
+    print(stats.report(top))
+    if stats.slow_queries:
+        print(f"\nSlow queries (>= {db.SLOW_QUERY_MS} ms):")
+        for entry in stats.slow_queries:
+            print(f"  {entry['ms']:.1f} ms  {entry['call_site']}: {entry['sql'][:120]}")
+            for step in entry["plan"]:
+                print(f"      {step}")
+
+
+def _synthetic_catalog(count, categories=500, vocabulary=5000, seed=42):
+    """Products with skewed category popularity and random tags, for scale tests"""
+    rng = random.Random(seed)
+    category_names = [f"category{i}" for i in range(categories)]
+    category_weights = [1 / (i + 1) for i in range(categories)]
+    words = [f"term{i}" for i in range(vocabulary)]
+    products = []
+    for product_id in range(1, count + 1):
+        category = rng.choices(category_names, category_weights)[0]
+        products.append({
+            "product_id": product_id,
+            "product_name": f"{category} {rng.choice(words)}",
+            "category": category,
+            "price": round(rng.uniform(5, 1500), 2),
+            "description": " ".join(rng.sample(words, 6)),
+            "tags": " ".join([category] + rng.sample(words, 3)),
+        })
+    return products
+
+
+def benchmark_ann(db_path=None, synthetic=100000, queries=200, k=10, nprobes=(1, 2, 4, 8, 16, 32), nlist=None, dim=256):
+    """Recall@k and latency of the IVF index against exact search, per nprobe"""
+    from ann_index import IVFIndex, load_catalog
+
+    products = load_catalog(db_path) if db_path else _synthetic_catalog(synthetic)
+    start = time.perf_counter()
+    built = IVFIndex.build(products, nlist=nlist, dim=dim)
+    build_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index")
+        built.save(path)
+        start = time.perf_counter()
+        index = IVFIndex.load(path)
+        load_ms = 1000 * (time.perf_counter() - start)
+        print(f"{len(index)} products, {index.nlist} clusters, dim {index.encoder.dim}: "
+              f"built in {build_seconds:.2f}s, loaded (mmap) in {load_ms:.2f} ms")
+
+        # Preference vectors shaped like real ones: a few weighted categories
+        rng = random.Random(7)
+        categories = sorted({p["category"].lower() for p in products})
+        query_vectors = []
+        for _ in range(queries):
+            chosen = rng.sample(categories, min(len(categories), rng.randint(1, 4)))
+            query_vectors.append(index.encoder.preference_vector({c: rng.random() for c in chosen}))
+
+        vectors = np.asarray(index.vectors)
+        truth, exact_seconds = [], 0.0
+        for query in query_vectors:
+            start = time.perf_counter()
+            scores = vectors @ query
+            top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+            exact_seconds += time.perf_counter() - start
+            truth.append(set(index.ids[top].tolist()))
+        print(f"exact search: {1000 * exact_seconds / queries:.3f} ms/query")
+
+        print(f"{'nprobe':>7} {'recall@' + str(k):>10} {'mean ms':>9} {'p95 ms':>8} {'speedup':>8}")
+        for nprobe in nprobes:
+            if nprobe > index.nlist:
+                break
+            latencies, recall = [], 0.0
+            for query, expected in zip(query_vectors, truth):
+                start = time.perf_counter()
+                ids, _ = index.search(query, k, nprobe=nprobe)
+                latencies.append(time.perf_counter() - start)
+                recall += len(expected & set(ids.tolist())) / max(len(expected), 1)
+            mean = 1000 * float(np.mean(latencies))
+            print(f"{nprobe:>7} {recall / queries:>10.3f} {mean:>9.3f} "
+                  f"{1000 * float(np.percentile(latencies, 95)):>8.3f} "
+                  f"{1000 * exact_seconds / queries / mean:>7.1f}x")
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_als(users=1000000, items=100000, per_user=20, factors=64, iterations=3, threads=None, queries=1000):
+    """Training time and peak memory of implicit ALS on a synthetic power-law interaction matrix"""
+    from scipy.sparse import coo_matrix
+    from matrix_factorization import DEFAULT_PARAMS, FactorModel, save_model, train_als
+
+    rng = np.random.default_rng(42)
+    start = time.perf_counter()
+    nnz = users * per_user
+    popularity = 1.0 / np.arange(1, items + 1) ** 0.8
+    rows = np.repeat(np.arange(users, dtype=np.int32), per_user)
+    cols = rng.choice(items, size=nnz, p=popularity / popularity.sum()).astype(np.int32)
+    strengths = rng.choice(np.array([0.3, 1.0], dtype=np.float32), size=nnz, p=[0.8, 0.2])
+    matrix = coo_matrix((strengths, (rows, cols)), shape=(users, items)).tocsr()
+    matrix.sum_duplicates()
+    del rows, cols, strengths
+    print(f"{users} users x {items} items, {matrix.nnz} nonzeros: matrix built in "
+          f"{time.perf_counter() - start:.1f}s, peak RSS {_peak_rss_mb():.0f} MB")
+
+    threads = threads or DEFAULT_PARAMS["threads"]
+    user_factors, item_factors, timings = train_als(
+        matrix, factors=factors, iterations=iterations, threads=threads,
+        progress=lambda i, seconds: print(f"  iteration {i}: {seconds:.1f}s (peak RSS {_peak_rss_mb():.0f} MB)")
+    )
+    print(f"ALS ({factors} factors, {threads} threads): {np.mean(timings):.1f}s per iteration, "
+          f"peak RSS {_peak_rss_mb():.0f} MB")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "model")
+        user_ids = [f"customer{i:07d}" for i in range(users)]
+        start = time.perf_counter()
+        save_model(path, user_ids, user_factors, np.arange(items, dtype=np.int64), item_factors, {})
+        save_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        model = FactorModel.load(path)
+        load_ms = 1000 * (time.perf_counter() - start)
+
+        sample = [user_ids[i] for i in rng.integers(0, users, queries)]
+        start = time.perf_counter()
+        for customer_id in sample:
+            model.recommend(customer_id, 10)
+        print(f"Model saved in {save_seconds:.1f}s, loaded (mmap) in {load_ms:.2f} ms, "
+              f"{1000 * (time.perf_counter() - start) / queries:.3f} ms per customer scored")
+
+
+def _memory_mb():
+    """(private, shared) resident MB of this process, from /proc/self/smaps_rollup"""
+    fields = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    private = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    shared = fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)
+    return private / 1024, shared / 1024
+
+
+def _serving_worker(db_path, snapshot_path, queries, results):
+    from ranking import CatalogIndex
+    from catalog_snapshot import CatalogSnapshot
+    from recommendation_system import RecommendationSystem
+
+    system = RecommendationSystem(db_path)
+    baseline, _ = _memory_mb()
+    start = time.perf_counter()
+    products = CatalogSnapshot.load(snapshot_path) if snapshot_path else system._load_products()
+    index = CatalogIndex(products)
+    attach_ms = 1000 * (time.perf_counter() - start)
+
+    rng = random.Random(os.getpid())
+    categories = sorted({p["category"].lower() for p in islice(products, 2000)})
+    for _ in range(queries):
+        chosen = rng.sample(categories, min(len(categories), 3))
+        index.top_k({category: rng.random() for category in chosen}, rng.choice(["Premium", "Budget"]), 10)
+    private, shared = _memory_mb()
+    results.put((private - baseline, shared, attach_ms))
+
+
+def benchmark_workers(products=200000, workers=4, queries=200):
+    """Per-worker memory and attach time with the catalog in per-process lists vs a shared snapshot"""
+    import multiprocessing
+    from catalog_snapshot import build_snapshot
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        conn = sqlite3.connect(db_path)
+        conn.execute("""
+            CREATE TABLE product_catalog (
+                product_id INTEGER PRIMARY KEY AUTOINCREMENT, product_name TEXT, product_category TEXT,
+                price FLOAT, description TEXT, tags TEXT
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO product_catalog VALUES (?, ?, ?, ?, ?, ?)",
+            [(p["product_id"], p["product_name"], p["category"], p["price"], p["description"], p["tags"])
+             for p in _synthetic_catalog(products)]
+        )
+        conn.commit()
+        conn.close()
+
+        snapshot_path = os.path.join(tmp, "snapshot")
+        start = time.perf_counter()
+        build_snapshot(db_path, snapshot_path)
+        print(f"{products} products; snapshot built in {time.perf_counter() - start:.2f}s")
+
+        # Spawned like uvicorn workers, so nothing is inherited from this process
+        context = multiprocessing.get_context("spawn")
+        for label, path in (("per-process lists", None), ("shared snapshot", snapshot_path)):
+            results = context.Queue()
+            processes = [
+                context.Process(target=_serving_worker, args=(db_path, path, queries, results))
+                for _ in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            measured = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            private = [m[0] for m in measured]
+            print(f"{label:>18}: {np.mean(private):7.1f} MB private per worker "
+                  f"({sum(private):.1f} MB for {workers}), {np.mean([m[1] for m in measured]):6.1f} MB shared, "
+                  f"attach {np.mean([m[2] for m in measured]):8.1f} ms")
+
+
+def _import_profile(module):
+    """(cumulative microseconds, module) of the slowest imports of a fresh interpreter, via -X importtime"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    entries = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            entries.append((int(parts[1]), parts[2].strip()))
+    return sorted(entries, reverse=True)
+
+
+def benchmark_startup(runs=5, budget_ms=1000.0, port=8765):
+    """Cold-start time of the service: import of main:app and launch until /health answers
+
+    The service runs with FAST_START=1 from the current directory, which should
+    hold a database prepared with `python main.py --init-db`. Returns False when
+    the median time to serving exceeds the budget.
+    """
+    import urllib.request
+
+    src = os.path.dirname(os.path.abspath(__file__))
+    import_ms, serving_ms = [], []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", "import time; start = time.perf_counter(); import main; "
+                                   "print(1000 * (time.perf_counter() - start))"],
+            capture_output=True, text=True, cwd=src, check=True,
+        )
+        import_ms.append(float(result.stdout.strip().splitlines()[-1]))
+
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(src, "main.py"), "--port", str(port)],
+            env=dict(os.environ, FAST_START="1"), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                try:
+                    urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1).read()
+                    break
+                except OSError:
+                    if process.poll() is not None:
+                        raise RuntimeError("Service exited before answering /health")
+                    time.sleep(0.01)
+            serving_ms.append(1000 * (time.perf_counter() - start))
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(f"import main: median {np.median(import_ms):.0f} ms, max {max(import_ms):.0f} ms")
+    print(f"launch to first /health: median {np.median(serving_ms):.0f} ms, max {max(serving_ms):.0f} ms "
+          f"(budget {budget_ms:.0f} ms)")
+    profile = _import_profile("main")
+    print("Slowest imports (cumulative):")
+    for micros, module in profile[:10]:
+        print(f"  {micros / 1000:8.1f} ms  {module}")
+    imported = {module for _, module in profile}
+    heavy = [name for name in ("numpy", "pandas", "sklearn", "scipy") if name in imported]
+    if heavy:
+        print(f"Heavy modules imported at startup: {', '.join(heavy)}")
+    within = np.median(serving_ms) <= budget_ms and not heavy
+    print("within budget" if within else "OVER BUDGET")
+    return within
+
+
+def _cpu_us_per_call(fn, items, repeat):
+    """Mean CPU time of fn(item), in microseconds, best of repeat passes over items"""
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for item in items:
+            fn(item)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return 1e6 * best / max(len(items), 1)
+
+
+def benchmark_stored(db_path="customers.db", customers=500, repeat=5):
+    """Per-request CPU time of serving stored recommendations, before and after pre-rendering
+
+    "join + default encoder" is the previous path: parse the stored set, join it
+    against the catalog and let FastAPI encode the dicts. "rendered bytes" sends
+    the body rendered at generation time. Customers without a fresh stored set
+    get one generated first (not timed).
+    """
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    import http_caching
+    from recommendation_system import RecommendationSystem
+
+    system = RecommendationSystem(db_path)
+    customer_ids = []
+    for customer_id in _sample_customers(db_path, customers):
+        if system.get_stored_response(customer_id)[0] is None:
+            system.generate_recommendations(customer_id)
+        if system.get_stored_response(customer_id)[0] is not None:
+            customer_ids.append(customer_id)
+    if not customer_ids:
+        print("No customers with recommendations to serve")
+        return
+
+    def legacy(customer_id):
+        body = json.loads(system.get_stored_response(customer_id, use_rendered=False)[0])
+        return JSONResponse(jsonable_encoder(body)).body
+
+    def join_fast_encoder(customer_id):
+        body = json.loads(system.get_stored_response(customer_id, use_rendered=False)[0])
+        return http_caching.json_response(body).body
+
+    def rendered(customer_id):
+        body, version = system.get_stored_response(customer_id)
+        return http_caching.json_response(body, version["etag"]).body
+
+    mismatched = sum(json.loads(legacy(c)) != json.loads(rendered(c)) for c in customer_ids)
+    catalog = system._get_all_products()
+    print(f"{len(customer_ids)} customers, catalog of {len(catalog)} products, "
+          f"encoder {'orjson' if http_caching.orjson is not None else 'json'}; "
+          f"{mismatched} bodies differ from the previous path")
+    baseline = None
+    for label, fn in (("join + default encoder", legacy), ("join + fast encoder", join_fast_encoder),
+                      ("rendered bytes", rendered)):
+        micros = _cpu_us_per_call(fn, customer_ids, repeat)
+        baseline = baseline or micros
+        print(f"  {label:24s} {micros:9.1f} us CPU/request  ({baseline / micros:5.1f}x)")
+
+    sample = json.loads(rendered(customer_ids[0]))
+    encoders = [("json", lambda body: json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode())]
+    if http_caching.orjson is not None:
+        encoders.append(("orjson", http_caching.dumps))
+    for label, encode in encoders:
+        micros = _cpu_us_per_call(encode, [sample] * 1000, repeat)
+        print(f"  encode one body with {label:7s} {micros:6.2f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Performance benchmarks for the recommendation service")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sql = subparsers.add_parser("sql", help="Per-statement SQL cost of recommendation generation")
+    sql.add_argument("--db", default="customers.db", help="Customer database to benchmark against")
+    sql.add_argument("--customers", type=int, default=200, help="Number of customers to generate for")
+    sql.add_argument("--slow-query-ms", type=float, help="Slow query threshold (default SQL_SLOW_QUERY_MS)")
+    sql.add_argument("--top", type=int, default=15, help="Statements to show in the report")
+
+    ann = subparsers.add_parser("ann", help="Recall/latency of the approximate product index vs exact search")
+    ann.add_argument("--db", help="Index this database's catalog instead of a synthetic one")
+    ann.add_argument("--synthetic", type=int, default=100000, help="Synthetic catalog size")
+    ann.add_argument("--queries", type=int, default=200, help="Number of preference-vector queries")
+    ann.add_argument("--k", type=int, default=10, help="Neighbours per query")
+    ann.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="nprobe values to sweep")
+    ann.add_argument("--nlist", type=int, help="Number of clusters (default sqrt of catalog size)")
+    ann.add_argument("--dim", type=int, default=256, help="Maximum vector dimensionality")
+
+    als = subparsers.add_parser("als", help="Implicit ALS training time and memory at scale")
+    als.add_argument("--users", type=int, default=1000000)
+    als.add_argument("--items", type=int, default=100000)
+    als.add_argument("--per-user", type=int, default=20, help="Interactions per user")
+    als.add_argument("--factors", type=int, default=64)
+    als.add_argument("--iterations", type=int, default=3)
+    als.add_argument("--threads", type=int, help="Solver threads (default CPU count)")
+
+    workers = subparsers.add_parser("workers", help="Per-worker memory with a shared catalog snapshot")
+    workers.add_argument("--products", type=int, default=200000, help="Synthetic catalog size")
+    workers.add_argument("--workers", type=int, default=4)
+    workers.add_argument("--queries", type=int, default=200, help="Rankings per worker before measuring")
+
+    startup = subparsers.add_parser("startup", help="Cold-start time of main:app against a budget; exit 1 when over")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--budget-ms", type=float, default=1000.0, help="Allowed median launch-to-serving time")
+    startup.add_argument("--port", type=int, default=8765)
+
+    stored = subparsers.add_parser("stored", help="CPU time per stored-recommendation response, before and after pre-rendering")
+    stored.add_argument("--db", default="customers.db", help="Customer database to benchmark against")
+    stored.add_argument("--customers", type=int, default=500)
+    stored.add_argument("--repeat", type=int, default=5, help="Timed passes; the fastest is reported")
+
+    args = parser.parse_args()
+    if args.benchmark == "sql":
+        benchmark_sql(args.db, args.customers, args.slow_query_ms, args.top)
+    elif args.benchmark == "ann":
+        benchmark_ann(args.db, args.synthetic, args.queries, args.k, args.nprobe, args.nlist, args.dim)
+    elif args.benchmark == "als":
+        benchmark_als(args.users, args.items, args.per_user, args.factors, args.iterations, args.threads)
+    elif args.benchmark == "workers":
+        benchmark_workers(args.products, args.workers, args.queries)
+    elif args.benchmark == "startup":
+        if not benchmark_startup(args.runs, args.budget_ms, args.port):
+            sys.exit(1)
+    elif args.benchmark == "stored":
+        benchmark_stored(args.db, args.customers, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
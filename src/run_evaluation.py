@@ -1,31 +1,52 @@
 
+import argparse
 import subprocess
 import time
 import sys
 import os
-import json
+import urllib.error
+import urllib.request
 
-def run_server():
-    """Start the FastAPI server as a subprocess"""
+def wait_for_server(base_url, process=None, timeout=30.0, interval=0.1):
+    """Poll the server's /health endpoint until it answers or the timeout expires"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Recommendation server exited with code {process.returncode} during startup")
+        try:
+            with urllib.request.urlopen(f"{base_url}/health", timeout=interval * 10) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(interval)
+    raise RuntimeError(f"Recommendation server at {base_url} was not ready after {timeout:.0f}s")
+
+def run_server(port=8000, timeout=30.0):
+    """Start the FastAPI server as a subprocess and wait until it is ready"""
     print("Starting the recommendation server...")
     server_process = subprocess.Popen(
-        [sys.executable, "src/main.py"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
+        [sys.executable, "src/main.py", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
     )
     
-    # Give the server a moment to start
-    time.sleep(2)
+    try:
+        wait_for_server(f"http://127.0.0.1:{port}", server_process, timeout)
+    except RuntimeError:
+        server_process.terminate()
+        server_process.wait()
+        raise
     return server_process
 
-def run_evaluation():
+def run_evaluation(base_url="http://127.0.0.1:8000"):
     """Run the evaluation script and capture output"""
     print("\nRunning recommendation system evaluation...")
     result = subprocess.run(
         [sys.executable, "src/evaluate_recommendations.py"],
         capture_output=True,
-        text=True
+        text=True,
+        env=dict(os.environ, RECOMMENDATION_API_URL=base_url)
     )
     
     return result.stdout
@@ -36,8 +57,42 @@ def save_results_to_file(output):
         f.write(output)
     print(f"\nResults saved to recommendation_results.txt")
 
+def run_offline_evaluation(db_path, max_customers=None, force=False):
+    """Run the in-process time-split evaluation and capture its report"""
+    import io
+    import contextlib
+    
+    from evaluation_store import cached_offline_evaluation
+    from offline_evaluation import print_report
+    
+    print("\nRunning offline recommendation evaluation...")
+    result = cached_offline_evaluation(db_path, force=force, max_customers=max_customers)
+    if result["cached"]:
+        print(f"Dataset and config unchanged; reusing stored run {result['run_id']} (use --force to rerun)")
+    else:
+        print(f"Stored as run {result['run_id']} in evaluations.db")
+    
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        print_report(result)
+    return buffer.getvalue()
+
 def main():
     """Main function to run the server and evaluation"""
+    parser = argparse.ArgumentParser(description="Evaluate the recommendation system")
+    parser.add_argument("--http", action="store_true",
+                        help="Run the legacy end-to-end evaluation against a live server")
+    parser.add_argument("--db", default="customers.db", help="Database used by the offline evaluation")
+    parser.add_argument("--max-customers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="Ignore cached results for an unchanged dataset")
+    args = parser.parse_args()
+    
+    if not args.http:
+        evaluation_output = run_offline_evaluation(args.db, args.max_customers, args.force)
+        print(evaluation_output)
+        save_results_to_file(evaluation_output)
+        return
+    
     # Check if we're in the right directory
     if not os.path.exists("src/main.py"):
         print("Error: Cannot find src/main.py. Make sure you're running this from the project root directory.")
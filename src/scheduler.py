@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import db
+import generation_locks
+from metrics import JOB_DURATION, JOB_RUNS
+
+# Background jobs allowed to run at once in one worker; further due jobs wait for a thread
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", "2"))
+# How often the ticker checks for due jobs
+TICK_SECONDS = 1.0
+# How long shutdown waits for running jobs to reach a stopping point
+STOP_TIMEOUT_SECONDS = 10.0
+
+
+def job_interval(name, default):
+    """Seconds between runs of a job, overridable with JOB_<NAME>_SECONDS; 0 runs it on demand only"""
+    return float(os.environ.get(f"JOB_{name.upper()}_SECONDS", default))
+
+
+class Job:
+    """A named piece of maintenance work and its run state in this worker"""
+
+    def __init__(self, name, fn, interval):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.running = False
+        self.next_run = None
+        self.runs = 0
+        self.last_started = None
+        self.last_seconds = None
+        self.last_result = None
+        self.last_error = None
+
+
+class Scheduler:
+    """Runs registered jobs on a thread pool, periodically and on demand, off the event loop
+
+    A job is fn(stop), where stop is a threading.Event set at shutdown; long
+    jobs check it between batches and return early. A job never overlaps
+    itself: a run that comes due while the previous one is still queued or
+    running is skipped. With a database, periodic runs also take a lease in
+    generation_locks for the interval, so with several workers each run
+    happens in only one of them.
+    """
+
+    def __init__(self, db_path=None, workers=SCHEDULER_WORKERS, tick_seconds=TICK_SECONDS):
+        self.db_path = db_path
+        self.workers = workers
+        self.tick_seconds = tick_seconds
+        self.owner = generation_locks.new_owner()
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._executor = None
+        self._thread = None
+        # Queued or running run -> its job
+        self._futures = {}
+
+    def register(self, name, fn, interval=0):
+        """Add a job; interval is the default period in seconds, 0 for on-demand only
+
+        A job added while the scheduler is running first runs one interval later.
+        """
+        job = Job(name, fn, job_interval(name, interval))
+        if self._thread is not None and self._thread.is_alive():
+            job.next_run = time.monotonic() + job.interval
+        self.jobs[name] = job
+        return job
+
+    def running(self):
+        return sum(job.running for job in self.jobs.values())
+
+    def _take_lease(self, job):
+        # Not released: the lease marks the interval as done for every worker until it expires
+        conn = db.connect(self.db_path)
+        try:
+            ttl = max(job.interval - self.tick_seconds, self.tick_seconds)
+            return generation_locks.acquire(conn, f"job:{job.name}", self.owner, ttl)
+        finally:
+            conn.close()
+
+    def _run(self, job, leased):
+        try:
+            if leased and self.db_path and not self._take_lease(job):
+                JOB_RUNS.labels(job.name, "leased").inc()
+                return
+            job.last_started = time.time()
+            start = time.perf_counter()
+            try:
+                job.last_result = job.fn(self._stop)
+                job.last_error = None
+                result = "completed"
+            except Exception as e:
+                job.last_error = str(e)
+                result = "failed"
+                print(f"Background job {job.name} failed: {e}")
+            job.last_seconds = time.perf_counter() - start
+            job.runs += 1
+            JOB_DURATION.labels(job.name).observe(job.last_seconds)
+            JOB_RUNS.labels(job.name, result).inc()
+            print(f"Background job {job.name} {result} in {job.last_seconds:.2f}s: {job.last_result}")
+        finally:
+            with self._lock:
+                job.running = False
+
+    def _dispatch(self, job, leased=False):
+        with self._lock:
+            if job.running:
+                JOB_RUNS.labels(job.name, "skipped").inc()
+                return False
+            if self._executor is None or self._stop.is_set():
+                return False
+            job.running = True
+            future = self._executor.submit(self._run, job, leased)
+            self._futures[future] = job
+        future.add_done_callback(self._finished)
+        return True
+
+    def _finished(self, future):
+        with self._lock:
+            job = self._futures.pop(future, None)
+            if job is not None and future.cancelled():
+                # Dropped before it started, so _run never cleared the flag
+                job.running = False
+
+    def run_now(self, name, leased=False):
+        """Queue a run of the named job outside its schedule; False if it is already queued or running
+
+        With leased, the run takes the job's lease like a periodic run, so only
+        one of several workers asking at the same time actually runs it.
+        """
+        return self._dispatch(self.jobs[name], leased=leased)
+
+    def _tick(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            # Copied, since jobs may be registered while the ticker runs
+            for job in list(self.jobs.values()):
+                if job.interval > 0 and now >= job.next_run:
+                    job.next_run = now + job.interval
+                    self._dispatch(job, leased=True)
+            self._stop.wait(self.tick_seconds)
+
+    def start(self):
+        """Start the ticker; each periodic job first runs one interval after start"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        now = time.monotonic()
+        for job in self.jobs.values():
+            job.next_run = now + job.interval
+        self._thread = threading.Thread(target=self._tick, name="job-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=STOP_TIMEOUT_SECONDS):
+        """Stop scheduling, drop queued runs and wait up to timeout for running jobs to return
+
+        Returns True when every job finished in time.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.tick_seconds + 1)
+            self._thread = None
+        if self._executor is None:
+            return True
+        with self._lock:
+            executor, self._executor = self._executor, None
+            futures = list(self._futures)
+        executor.shutdown(wait=False, cancel_futures=True)
+        _, not_done = wait(futures, timeout)
+        if not_done:
+            print(f"{len(not_done)} background jobs still running at shutdown")
+        return not not_done
+
+    def status(self):
+        """Schedule and last run of each job in this worker"""
+        now = time.monotonic()
+        return {
+            "running": self._thread is not None,
+            "workers": self.workers,
+            "jobs": {job.name: {
+                "interval_seconds": job.interval or None,
+                "running": job.running,
+                "next_run_in_seconds": round(job.next_run - now, 1) if job.interval > 0 and job.next_run else None,
+                "runs": job.runs,
+                "last_started": job.last_started,
+                "last_seconds": job.last_seconds,
+                "last_result": job.last_result,
+                "last_error": job.last_error,
+            } for job in self.jobs.values()},
+        }
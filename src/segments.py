@@ -0,0 +1,93 @@
+import db
+import history_compaction
+import customer_summary
+
+# Customers whose segment is recomputed per write transaction in a full rebuild
+BATCH_SIZE = 500
+
+
+def update_segment(cursor, customer_id):
+    """Recompute one customer's customer_segments row from raw and rolled-up purchases
+
+    Customers without purchases keep whatever row they have, and a row that
+    comes out the same is not rewritten. Returns whether the row changed; the
+    caller then refreshes the customer summary.
+    """
+    orders, spent, last_order_date = history_compaction.purchase_totals(cursor, customer_id)
+    if not orders:
+        return False
+    cursor.execute('''
+        SELECT
+            :avg,
+            CASE
+                WHEN :last_order_date >= DATE('now', '-3 months') THEN 'Recent'
+                WHEN :last_order_date >= DATE('now', '-6 months') THEN 'Semi-Recent'
+                ELSE 'Inactive'
+            END,
+            CASE
+                WHEN :avg > 100 THEN 'Premium'
+                WHEN :avg BETWEEN 50 AND 100 THEN 'Regular'
+                ELSE 'Budget'
+            END
+    ''', {"avg": spent / orders, "last_order_date": last_order_date})
+    computed = cursor.fetchone()
+    cursor.execute('''
+        SELECT avg_order_value, last_active_season, customer_segment FROM customer_segments
+        WHERE customer_id = ?
+    ''', (customer_id,))
+    if cursor.fetchone() == computed:
+        return False
+    cursor.execute('''
+        REPLACE INTO customer_segments (customer_id, avg_order_value, last_active_season, customer_segment)
+        VALUES (?, ?, ?, ?)
+    ''', (customer_id, *computed))
+    return True
+
+
+def refresh_customer(db_path, customer_id):
+    """Recompute one customer's segment after new purchases, in its own transaction; whether it changed
+
+    Runs after the purchase request has been answered (a background task of
+    update-behavior), so ingestion does not wait for the aggregate.
+    """
+    conn = db.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        changed = update_segment(cursor, customer_id)
+        if changed:
+            customer_summary.refresh_segment(cursor, customer_id)
+        conn.commit()
+    finally:
+        conn.close()
+    return changed
+
+
+def rebuild_segments(db_path, batch_size=BATCH_SIZE, stop=None):
+    """Recompute every purchasing customer's segment, e.g. so 'Recent' customers age into 'Inactive'
+
+    Commits every batch_size customers and stops early once stop (a
+    threading.Event) is set. Only segments that changed are written, so
+    unchanged customers keep their summary version and profile ETag. Returns
+    the number of segments written.
+    """
+    conn = db.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT customer_id FROM purchase_history
+        UNION
+        SELECT customer_id FROM purchase_rollup
+    ''')
+    customer_ids = [row[0] for row in cursor.fetchall()]
+    written = 0
+    try:
+        for start in range(0, len(customer_ids), batch_size):
+            if stop is not None and stop.is_set():
+                break
+            for customer_id in customer_ids[start:start + batch_size]:
+                if update_segment(cursor, customer_id):
+                    customer_summary.refresh_segment(cursor, customer_id)
+                    written += 1
+            conn.commit()
+    finally:
+        conn.close()
+    return written
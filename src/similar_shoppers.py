@@ -0,0 +1,300 @@
+import argparse
+import hashlib
+import time
+import zlib
+from itertools import groupby
+
+import numpy as np
+
+import db
+import history_compaction
+
+# 64 MinHash permutations in 16 bands of 4 rows: customers with Jaccard similarity
+# around 0.5 share at least one band about half of the time, 0.8 almost always
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+
+# Universal hashing (a * x + b) mod p with a, x < 2^32 so products fit in uint64
+_PRIME = np.uint64(4294967311)
+_rng = np.random.default_rng(20240601)
+_A = _rng.integers(1, 2 ** 32, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 2 ** 32, NUM_PERM, dtype=np.uint64)
+_LOW_32 = np.uint64(0xFFFFFFFF)
+
+
+def customer_tokens(categories=(), product_names=()):
+    """Set of shingles describing a shopper: categories they touched and products they bought"""
+    tokens = {f"c:{category.strip().lower()}" for category in categories if category}
+    tokens.update(f"p:{name.strip().lower()}" for name in product_names if name)
+    return tokens
+
+
+def minhash(tokens):
+    """64 x uint32 MinHash signature of a token set"""
+    hashes = np.fromiter((zlib.crc32(token.encode()) for token in tokens), dtype=np.uint64, count=len(tokens))
+    values = (_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME
+    return (values.min(axis=1) & _LOW_32).astype(np.uint32)
+
+
+def band_buckets(signature):
+    """One 64-bit bucket key per band"""
+    data = signature.tobytes()
+    width = ROWS_PER_BAND * 4
+    return [
+        int.from_bytes(hashlib.blake2b(data[band * width:(band + 1) * width], digest_size=8).digest(),
+                       "big", signed=True)
+        for band in range(BANDS)
+    ]
+
+
+def estimated_similarity(signature, others):
+    """Estimated Jaccard similarity of one signature to each row of others"""
+    return (others == signature).mean(axis=1)
+
+
+class SimilarShopperIndex:
+    """MinHash signatures per customer plus an LSH banding table in SQLite
+
+    Signatures are mergeable, so new interactions only need the element-wise
+    minimum with the stored signature; no history is re-read on ingestion.
+    Candidates are customers sharing at least one band bucket, re-ranked by the
+    similarity estimated from their full signatures.
+    """
+
+    def __init__(self, db_path="customers.db", init_schema=True):
+        self.db_path = db_path
+        if init_schema:
+            self.init_db()
+
+    def get_connection(self):
+        return db.connect(self.db_path)
+
+    def init_db(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        # One signature per customer, NUM_PERM little-endian uint32 values
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS customer_minhash (
+                customer_id TEXT PRIMARY KEY,
+                signature BLOB,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # LSH band buckets; lookups by (band, bucket) stay on the primary key
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS customer_lsh_buckets (
+                band INTEGER,
+                bucket INTEGER,
+                customer_id TEXT,
+                PRIMARY KEY (band, bucket, customer_id)
+            ) WITHOUT ROWID
+        ''')
+
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def _signature_of(blob):
+        return np.frombuffer(blob, dtype=np.uint32)
+
+    def _write(self, cursor, customer_id, signature, previous=None):
+        """Store a signature and move the customer to its new band buckets"""
+        buckets = band_buckets(signature)
+        if previous is not None:
+            old_buckets = band_buckets(previous)
+            cursor.executemany(
+                "DELETE FROM customer_lsh_buckets WHERE band = ? AND bucket = ? AND customer_id = ?",
+                [(band, old, customer_id) for band, (old, new) in enumerate(zip(old_buckets, buckets)) if old != new]
+            )
+        cursor.execute('''
+            INSERT OR REPLACE INTO customer_minhash (customer_id, signature, updated_at)
+            VALUES (?, ?, datetime('now'))
+        ''', (customer_id, signature.tobytes()))
+        cursor.executemany(
+            "INSERT OR IGNORE INTO customer_lsh_buckets (band, bucket, customer_id) VALUES (?, ?, ?)",
+            [(band, bucket, customer_id) for band, bucket in enumerate(buckets)]
+        )
+
+    def add_interaction(self, customer_id, categories=(), product_names=()):
+        """Fold newly ingested categories and purchased products into a customer's signature"""
+        tokens = customer_tokens(categories, product_names)
+        if not tokens:
+            return
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT signature FROM customer_minhash WHERE customer_id = ?", (customer_id,))
+        row = cursor.fetchone()
+
+        signature = minhash(tokens)
+        previous = None
+        if row:
+            previous = self._signature_of(row[0])
+            signature = np.minimum(previous, signature)
+            if np.array_equal(signature, previous):
+                conn.close()
+                return
+
+        self._write(cursor, customer_id, signature, previous)
+        conn.commit()
+        conn.close()
+
+    def rebuild(self, batch_size=5000):
+        """Recompute every signature from browsing and purchase history; returns customers indexed
+
+        History the compaction job rolled up still counts: its categories, and
+        the products of rolled-up purchases that were linked to the catalog.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        rollups = history_compaction.existing_rollups(cursor)
+        rolled_up = {
+            "browsing_rollup": "SELECT customer_id, 'c', category FROM browsing_rollup",
+            "purchase_rollup": "SELECT customer_id, 'c', product_category FROM purchase_rollup",
+            "purchase_product_rollup": '''
+                SELECT r.customer_id, 'p', p.product_name
+                FROM purchase_product_rollup r JOIN product_catalog p ON p.product_id = r.product_id
+            ''',
+        }
+        cursor.execute(" UNION ALL ".join([
+            "SELECT customer_id, 'c', category FROM browsing_history",
+            "SELECT customer_id, 'c', product_category FROM purchase_history",
+            "SELECT customer_id, 'p', product_name FROM purchase_history",
+            *(query for rollup, query in rolled_up.items() if rollup in rollups),
+        ]) + " ORDER BY 1")
+
+        writer = conn.cursor()
+        writer.execute("DELETE FROM customer_lsh_buckets")
+        writer.execute("DELETE FROM customer_minhash")
+
+        signatures, buckets, indexed = [], [], 0
+
+        def flush():
+            writer.executemany(
+                "INSERT INTO customer_minhash (customer_id, signature, updated_at) VALUES (?, ?, datetime('now'))",
+                signatures
+            )
+            writer.executemany("INSERT INTO customer_lsh_buckets (band, bucket, customer_id) VALUES (?, ?, ?)", buckets)
+            signatures.clear()
+            buckets.clear()
+
+        def history_rows():
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    return
+                yield from rows
+
+        for customer_id, rows in groupby(history_rows(), key=lambda row: row[0]):
+            categories, product_names = [], []
+            for _, kind, value in rows:
+                (categories if kind == "c" else product_names).append(value)
+            tokens = customer_tokens(categories, product_names)
+            if not tokens:
+                continue
+            signature = minhash(tokens)
+            signatures.append((customer_id, signature.tobytes()))
+            buckets.extend((band, bucket, customer_id) for band, bucket in enumerate(band_buckets(signature)))
+            indexed += 1
+            if len(signatures) >= batch_size:
+                flush()
+
+        flush()
+        conn.commit()
+        conn.close()
+        return indexed
+
+    def _neighbour_candidates(self, cursor, signature, customer_id, bucket_limit):
+        """Customers sharing a band bucket with the signature, with the number of shared bands"""
+        shared = {}
+        for band, bucket in enumerate(band_buckets(signature)):
+            # Capped per bucket so a crowded bucket (identical shoppers) stays cheap
+            cursor.execute('''
+                SELECT customer_id FROM customer_lsh_buckets
+                WHERE band = ? AND bucket = ?
+                LIMIT ?
+            ''', (band, bucket, bucket_limit + 1))
+            for (other_id,) in cursor.fetchall():
+                if other_id != customer_id:
+                    shared[other_id] = shared.get(other_id, 0) + 1
+        return shared
+
+    def similar_customers(self, customer_id, top_n=20, bucket_limit=100, max_candidates=200):
+        """Most similar customers as (customer_id, estimated Jaccard similarity), best first"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT signature FROM customer_minhash WHERE customer_id = ?", (customer_id,))
+        row = cursor.fetchone()
+        if not row:
+            conn.close()
+            return []
+
+        signature = self._signature_of(row[0])
+        shared = self._neighbour_candidates(cursor, signature, customer_id, bucket_limit)
+        candidates = sorted(shared, key=lambda other: (-shared[other], other))[:max_candidates]
+        if not candidates:
+            conn.close()
+            return []
+
+        cursor.execute(f'''
+            SELECT customer_id, signature FROM customer_minhash
+            WHERE customer_id IN ({",".join("?" * len(candidates))})
+        ''', candidates)
+        rows = cursor.fetchall()
+        conn.close()
+
+        ids = [r[0] for r in rows]
+        similarities = estimated_similarity(signature, np.vstack([self._signature_of(r[1]) for r in rows]))
+        order = sorted(range(len(ids)), key=lambda i: (-similarities[i], ids[i]))[:top_n]
+        return [(ids[i], float(similarities[i])) for i in order]
+
+    def neighbour_purchases(self, customer_id, neighbours=20, recent_days=180):
+        """Products recently bought by similar customers but not by this one
+
+        Returns (product_name, product_category, support) sorted by support, the
+        summed similarity of the neighbours who bought the product.
+        """
+        similar = self.similar_customers(customer_id, top_n=neighbours)
+        if not similar:
+            return []
+        similarity = dict(similar)
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT customer_id, product_name, product_category FROM purchase_history
+            WHERE customer_id IN ({",".join("?" * len(similarity))})
+            AND order_date >= datetime('now', ?)
+        ''', [*similarity, f"-{int(recent_days)} days"])
+        purchases = cursor.fetchall()
+        cursor.execute("SELECT DISTINCT product_name FROM purchase_history WHERE customer_id = ?", (customer_id,))
+        owned = {(row[0] or "").lower() for row in cursor.fetchall()}
+        conn.close()
+
+        support, categories, counted = {}, {}, set()
+        for other_id, product_name, category in purchases:
+            key = (product_name or "").lower()
+            if not key or key in owned or (other_id, key) in counted:
+                continue
+            counted.add((other_id, key))
+            support[key] = support.get(key, 0.0) + similarity[other_id]
+            categories.setdefault(key, (product_name, category))
+        ranked = sorted(support, key=lambda key: (-support[key], key))
+        return [(categories[key][0], categories[key][1], support[key]) for key in ranked]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild MinHash signatures and LSH buckets from customer history")
+    parser.add_argument("--db", default="customers.db", help="Customer database")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    indexed = SimilarShopperIndex(args.db).rebuild()
+    print(f"Indexed {indexed} customers in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,16 @@
 import requests
 import json
 from datetime import datetime, timedelta
+import argparse
+import asyncio
+import os
 import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Base URL for API
 BASE_URL = "http://127.0.0.1:8000"
@@ -114,8 +123,234 @@ def process_new_browsing_interaction():
     
     return response.json()
 
+# In-process checks run by --checks; they need no running server
+CHECKS = []
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def check(fn):
+    """Register fn as a check for --checks"""
+    CHECKS.append(fn)
+    return fn
+
+@check
+def check_startup_budget():
+    """main imports no heavy library and a FAST_START launch answers /health within the startup budget"""
+    import run_benchmarks
+
+    with tempfile.TemporaryDirectory() as workdir:
+        subprocess.run([sys.executable, os.path.join(SRC_DIR, "main.py"), "--init-db"],
+                       cwd=workdir, check=True, capture_output=True)
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            assert run_benchmarks.benchmark_startup(runs=3), "startup over budget"
+        finally:
+            os.chdir(cwd)
+
+def _sample_database(workdir):
+    """A database in workdir with the schema, the sample catalog and two customers who browsed laptops"""
+    subprocess.run([sys.executable, os.path.join(SRC_DIR, "main.py"), "--init-db"],
+                   cwd=workdir, check=True, capture_output=True)
+    db_path = os.path.join(workdir, "customers.db")
+    conn = sqlite3.connect(db_path)
+    for customer_id in ("c1", "c2"):
+        conn.execute("INSERT INTO customer_profiles (customer_id, full_name) VALUES (?, ?)", (customer_id, customer_id))
+        conn.execute("INSERT INTO browsing_history (customer_id, category) VALUES (?, 'Laptop')", (customer_id,))
+    conn.commit()
+    conn.close()
+    return db_path
+
+def _stored_sets(db_path, customer_id):
+    conn = sqlite3.connect(db_path)
+    count = conn.execute("SELECT COUNT(*) FROM customer_recommendations WHERE customer_id = ?",
+                         (customer_id,)).fetchone()[0]
+    conn.close()
+    return count
+
+@check
+def check_single_flight_generation():
+    """Concurrent requests for one customer run one generation and store one set, in one worker and across workers"""
+    sys.path.insert(0, SRC_DIR)
+    from admission import AdmissionController
+    from recommendation_system import RecommendationSystem
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = _sample_database(workdir)
+        recommendation_system = RecommendationSystem(db_path, init_schema=False, cross_worker_locks=True)
+        generated = []
+        generate = recommendation_system.generate_recommendations
+        def slow_generate(customer_id, limit=10):
+            # Long enough that every caller arrives while the first is still generating
+            generated.append(customer_id)
+            time.sleep(0.2)
+            return generate(customer_id, limit)
+        recommendation_system.generate_recommendations = slow_generate
+
+        # Requests in one worker join the admission controller's flight for the customer
+        async def requests():
+            admission = AdmissionController(4, 16, 5.0)
+            return await asyncio.gather(*(
+                admission.run(recommendation_system.generate_recommendations_once, "c1", key="c1")
+                for _ in range(8)
+            ))
+        results = asyncio.run(requests())
+        assert generated.count("c1") == 1, f"{generated.count('c1')} generations for c1"
+        assert all(result == results[0] for result in results)
+        assert _stored_sets(db_path, "c1") == 1, f"{_stored_sets(db_path, 'c1')} stored sets for c1"
+
+        # Calls from separate workers, modelled as threads, wait on the customer's lease instead
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda _: recommendation_system.generate_recommendations_once("c2"), range(8)))
+        assert generated.count("c2") == 1, f"{generated.count('c2')} generations for c2"
+        assert all(result["recommendations"] for result in results)
+        assert _stored_sets(db_path, "c2") == 1, f"{_stored_sets(db_path, 'c2')} stored sets for c2"
+
+@check
+def check_shedding_reasons():
+    """The admission controller sheds with queue_full, queue_timeout and budget, and drops abandoned queued work"""
+    sys.path.insert(0, SRC_DIR)
+    from admission import AdmissionController, Overloaded
+
+    ran = []
+    def work(item):
+        time.sleep(0.3)
+        ran.append(item)
+        return item
+
+    async def submit(admission, items):
+        results = await asyncio.gather(*(admission.run(work, item, key=item) for item in items),
+                                       return_exceptions=True)
+        return [result.reason if isinstance(result, Overloaded) else result for result in results]
+
+    async def scenarios():
+        # One slot and one queue place: the third request is turned away at once
+        admission = AdmissionController(1, 1, 2.0)
+        assert await submit(admission, [0, 1, 2]) == [0, 1, "queue_full"]
+
+        # A budget shorter than the work: the running request overruns, the queued ones time out
+        ran.clear()
+        admission = AdmissionController(1, 5, 0.1)
+        assert await submit(admission, [0, 1, 2]) == ["budget", "queue_timeout", "queue_timeout"]
+        await asyncio.sleep(0.5)
+        # The started generation finished; the queued ones were cancelled with nobody waiting
+        assert ran == [0], f"ran {ran}"
+        assert admission.active == 0 and admission.waiting == 0 and not admission.in_flight(1)
+
+    asyncio.run(scenarios())
+
+@check
+def check_background_refresh():
+    """Background refreshes only use idle slots, share the key's flight and outlive a shed joiner"""
+    sys.path.insert(0, SRC_DIR)
+    from admission import AdmissionController, Overloaded
+
+    ran = []
+    def work(item):
+        time.sleep(0.3)
+        ran.append(item)
+        return item
+
+    async def scenario():
+        admission = AdmissionController(1, 5, 0.1)
+        assert admission.submit(work, "a", key="a")
+        # Already in flight, and the only slot is taken
+        assert not admission.submit(work, "a", key="a")
+        assert not admission.submit(work, "b", key="b")
+        # A request for the refreshed key joins it; shedding that request leaves the refresh running
+        try:
+            await admission.run(work, "a", key="a")
+            raise AssertionError("expected the joiner to be shed")
+        except Overloaded as e:
+            assert e.reason == "budget", e.reason
+        await asyncio.sleep(0.4)
+        assert ran == ["a"], f"ran {ran}"
+        assert admission.background == 0 and not admission.in_flight("a")
+
+    asyncio.run(scenario())
+
+@check
+def check_filtered_top_k():
+    """Filtered top_k matches brute-force scoring of every allowed, non-excluded product on random catalogs"""
+    sys.path.insert(0, SRC_DIR)
+    from ranking import CatalogIndex, FilterRules
+
+    # Overlapping names, so partial and tag matches are exercised as well as exact ones
+    categories = ["phone", "smartphone", "laptop", "laptop bag", "yoga", "yoga mat", "shoes", "books"]
+    rng = random.Random(7)
+    for trial in range(200):
+        products = [{
+            "product_id": product_id,
+            "product_name": f"Product {product_id}",
+            "category": rng.choice(categories),
+            "price": rng.choice([None, round(rng.uniform(1, 300), 2), 49.99, 100.0]),
+            "tags": " ".join(rng.sample(categories, rng.randint(0, 2))),
+        } for product_id in range(rng.randint(1, 300))]
+        index = CatalogIndex(products)
+        rules = FilterRules(
+            min_price=rng.choice([None, 20.0]),
+            max_price=rng.choice([None, 150.0]),
+            blocked_categories=rng.sample(categories, rng.randint(0, 2)),
+        )
+        allowed = index.allowed_mask(rules)
+        excluded = frozenset(rng.sample(range(len(products)), min(len(products), rng.randint(0, 20))))
+        weights = {category: rng.choice([0.1, 0.25, 0.5, 1.0]) for category in rng.sample(categories, rng.randint(1, 4))}
+        segment = rng.choice(["Premium", "Budget", "Regular", None])
+        k = rng.randint(1, 15)
+
+        band = segment.lower() if segment in ("Premium", "Budget") else None
+        expected = sorted(
+            ((index.score(i, weights, band), i) for i in range(len(products))
+             if (allowed is None or allowed[i]) and i not in excluded),
+            key=lambda entry: (-entry[0], entry[1]),
+        )
+        expected = [entry for entry in expected if entry[0] > 0][:k]
+        actual = index.top_k(weights, segment, k, allowed=allowed, excluded=excluded)
+        assert actual == expected, f"trial {trial}: {actual} != {expected}"
+
+@check
+def check_lease_expiry():
+    """A generation lease excludes other owners until it lapses, and a lapsed owner cannot release its successor's"""
+    sys.path.insert(0, SRC_DIR)
+    import generation_locks
+
+    conn = sqlite3.connect(":memory:")
+    generation_locks.init_db(conn.cursor())
+    assert generation_locks.acquire(conn, "key", "first", ttl=0.1)
+    assert not generation_locks.acquire(conn, "key", "second", ttl=0.1)
+    assert generation_locks.is_held(conn, "key")
+    time.sleep(0.15)
+    assert not generation_locks.is_held(conn, "key")
+    assert generation_locks.acquire(conn, "key", "second", ttl=5)
+    generation_locks.release(conn, "key", "first")
+    assert generation_locks.is_held(conn, "key")
+    generation_locks.release(conn, "key", "second")
+    assert not generation_locks.is_held(conn, "key")
+
+def run_checks(names):
+    """Run the registered checks (or only those named); the number that failed"""
+    failed = 0
+    for fn in CHECKS:
+        if names and fn.__name__ not in names:
+            continue
+        print(f"===== {fn.__name__} =====")
+        try:
+            fn()
+            print("PASS")
+        except Exception as e:
+            failed += 1
+            print(f"FAIL: {type(e).__name__}: {e}")
+    return failed
+
 def main():
     """Run the test script"""
+    parser = argparse.ArgumentParser(description="Exercise the API against a running server, or run the in-process checks")
+    parser.add_argument("--checks", nargs="*", metavar="NAME",
+                        help="Run the in-process checks instead (all when no names are given); exit 1 on failure")
+    args = parser.parse_args()
+    if args.checks is not None:
+        sys.exit(1 if run_checks(args.checks) else 0)
+
     print("===== SETTING UP TEST DATA =====")
     create_customer()
     add_address()
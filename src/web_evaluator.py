@@ -1,19 +1,25 @@
 
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import subprocess
-import time
+from pydantic import BaseModel
+from typing import Any, Dict
 import sys
 import os
 import json
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 from pathlib import Path
 
+from evaluation_jobs import EvaluationJobManager, format_sse
+
 app = FastAPI()
 
+# Evaluations run as background jobs; two at a time, the rest wait in the queue
+job_manager = EvaluationJobManager(max_concurrent=2)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -131,15 +137,34 @@ with open(template_path, "w") as f:
         <div class="card">
             <h2>Run Evaluation</h2>
             <p>Click the button below to run the recommendation system evaluation:</p>
+            <select id="mode">
+                <option value="offline">Offline replay (in-process)</option>
+                <option value="http">End-to-end (live server)</option>
+            </select>
             <button id="runButton" onclick="runEvaluation()">Run Evaluation</button>
             <div class="loader" id="loader"></div>
             <div class="status" id="status"></div>
+            <progress id="progress" value="0" max="1" style="width: 100%; display: none;"></progress>
+        </div>
+        
+        <div class="card" id="liveCard" style="display: none;">
+            <h2>Live Results</h2>
+            <div id="customers"></div>
+            <pre id="log" style="display: none;"></pre>
         </div>
         
         <div class="card" id="resultsCard" style="display: none;">
             <h2>Evaluation Results</h2>
             <div id="results"></div>
         </div>
+        
+        <div class="card">
+            <h2>Run History</h2>
+            <p>Pick a base (A) and a comparison (B) run to diff their metrics and timings.</p>
+            <div id="runs"></div>
+            <button onclick="diffSelectedRuns()">Compare A &rarr; B</button>
+            <div id="diff"></div>
+        </div>
     </div>
 
     <script>
@@ -284,24 +309,126 @@ with open(template_path, "w") as f:
             return html || `<pre>${results}</pre>`;
         }
         
+        function scoreClassFor(value) {
+            if (value >= 0.8) return 'excellent';
+            if (value >= 0.5) return 'good';
+            if (value >= 0.3) return 'fair';
+            return 'poor';
+        }
+        
+        function formatMetrics(result) {
+            let html = `<p>Split date: ${result.split_date} &middot; Customers evaluated: ${result.customers_evaluated}
+                &middot; Catalog size: ${result.catalog_size}</p>`;
+            for (const [name, value] of Object.entries(result.metrics)) {
+                html += `<p>${name}: <span class="${scoreClassFor(value)}">${value.toFixed(4)}</span></p>`;
+            }
+            html += `<p>Total time: ${result.timings.total_seconds}s</p>`;
+            return html;
+        }
+        
+        function appendCustomer(data) {
+            const metrics = Object.entries(data)
+                .filter(([name]) => name.includes('@'))
+                .map(([name, value]) => `${name}: <span class="${scoreClassFor(value)}">${Number(value).toFixed(2)}</span>`)
+                .join(' &middot; ');
+            document.getElementById('customers').insertAdjacentHTML('beforeend',
+                `<div class="recommendation">${data.customer_id} (${data.segment}) - ${metrics}</div>`);
+        }
+        
         function runEvaluation() {
             showLoader();
+            document.getElementById('liveCard').style.display = 'block';
+            document.getElementById('customers').innerHTML = '';
+            document.getElementById('log').textContent = '';
+            const mode = document.getElementById('mode').value;
+            document.getElementById('log').style.display = mode === 'http' ? 'block' : 'none';
             
-            fetch('/run-evaluation')
-                .then(response => response.text())
-                .then(data => {
-                    hideLoader();
-                    document.getElementById('status').textContent = 'Evaluation completed';
-                    document.getElementById('resultsCard').style.display = 'block';
-                    document.getElementById('results').innerHTML = formatResults(data);
-                })
-                .catch(error => {
+            fetch('/evaluations', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({kind: mode})
+            })
+                .then(response => response.json())
+                .then(job => watchJob(job.job_id))
+                .catch(error => showError(error.message));
+        }
+        
+        function watchJob(jobId) {
+            const progress = document.getElementById('progress');
+            const source = new EventSource(`/evaluations/${jobId}/events`);
+            
+            source.addEventListener('status', event => {
+                const data = JSON.parse(event.data);
+                document.getElementById('status').textContent = `Job ${jobId}: ${data.status}`;
+                if (data.status === 'completed' || data.status === 'failed') {
+                    source.close();
+                    loadRuns();
                     hideLoader();
-                    document.getElementById('status').textContent = 'Error running evaluation';
-                    document.getElementById('resultsCard').style.display = 'block';
-                    document.getElementById('results').innerHTML = `<pre class="error">Error: ${error.message}</pre>`;
+                    progress.style.display = 'none';
+                    if (data.error) showError(data.error);
+                }
+            });
+            source.addEventListener('progress', event => {
+                const data = JSON.parse(event.data);
+                progress.style.display = 'block';
+                progress.max = Math.max(data.total, 1);
+                progress.value = data.done;
+                document.getElementById('status').textContent = `Scored ${data.done} / ${data.total} customers`;
+            });
+            source.addEventListener('customer', event => appendCustomer(JSON.parse(event.data)));
+            source.addEventListener('log', event => {
+                document.getElementById('log').textContent += JSON.parse(event.data).line + '\n';
+            });
+            source.addEventListener('result', event => {
+                const data = JSON.parse(event.data);
+                document.getElementById('resultsCard').style.display = 'block';
+                document.getElementById('results').innerHTML =
+                    data.output !== undefined ? formatResults(data.output) : formatMetrics(data);
+            });
+        }
+        
+        function loadRuns() {
+            fetch('/runs')
+                .then(response => response.json())
+                .then(runs => {
+                    let html = '<table><tr><th>A</th><th>B</th><th>Run</th><th>Kind</th><th>Created</th><th>Code</th><th>Dataset</th></tr>';
+                    for (const run of runs) {
+                        html += `<tr><td><input type="radio" name="runA" value="${run.run_id}"></td>
+                            <td><input type="radio" name="runB" value="${run.run_id}"></td>
+                            <td>${run.run_id}</td><td>${run.kind}</td><td>${run.created_at}</td>
+                            <td>${run.code_version}</td><td>${run.dataset_fingerprint}</td></tr>`;
+                    }
+                    document.getElementById('runs').innerHTML = html + '</table>';
+                });
+        }
+        
+        function diffSelectedRuns() {
+            const a = document.querySelector('input[name="runA"]:checked');
+            const b = document.querySelector('input[name="runB"]:checked');
+            if (!a || !b) return;
+            fetch(`/runs/${a.value}/diff/${b.value}`)
+                .then(response => response.json())
+                .then(diff => {
+                    let html = `<p>Same dataset: ${diff.same_dataset} &middot; Same code: ${diff.same_code}</p>`;
+                    html += '<table><tr><th>Metric</th><th>A</th><th>B</th><th>Delta</th></tr>';
+                    for (const section of ['metrics', 'timings']) {
+                        for (const [name, entry] of Object.entries(diff[section])) {
+                            const delta = entry.delta === null ? '' : entry.delta.toFixed(4);
+                            html += `<tr><td>${name}</td><td>${entry.base ?? ''}</td><td>${entry.other ?? ''}</td><td>${delta}</td></tr>`;
+                        }
+                    }
+                    document.getElementById('diff').innerHTML = html + '</table>';
                 });
         }
+        
+        loadRuns();
+        
+        function showError(message) {
+            hideLoader();
+            document.getElementById('status').textContent = 'Error running evaluation';
+            document.getElementById('resultsCard').style.display = 'block';
+            document.getElementById('results').innerHTML = `<pre class="error">Error: ${message}</pre>`;
+        }
     </script>
 </body>
 </html>
@@ -313,53 +440,86 @@ templates = Jinja2Templates(directory="templates")
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
-def run_server_subprocess():
-    """Start the FastAPI server as a subprocess"""
-    print("Starting the recommendation server...")
-    server_process = subprocess.Popen(
-        [sys.executable, "src/main.py"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    )
+class EvaluationRequest(BaseModel):
+    kind: str = "offline"
+    options: Dict[str, Any] = {}
+
+@app.post("/evaluations")
+async def start_evaluation(request: EvaluationRequest):
+    """Queue an evaluation job and return its ID; progress is available on /evaluations/{job_id}/events"""
+    if request.kind == "http" and not os.path.exists("src/main.py"):
+        raise HTTPException(status_code=400, detail="Cannot find src/main.py. Run the evaluator from the project root directory.")
+    try:
+        job = job_manager.submit(request.kind, request.options)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return job.to_dict()
+
+@app.get("/evaluations")
+async def list_evaluations():
+    """List recent evaluation jobs, newest first"""
+    return [job.to_dict() for job in reversed(job_manager.jobs.values())]
+
+@app.get("/evaluations/{job_id}")
+async def get_evaluation(job_id: str):
+    """Get the status and, once finished, the result of an evaluation job"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Evaluation job not found")
+    return {**job.to_dict(), "result": job.result}
+
+@app.get("/evaluations/{job_id}/events")
+async def stream_evaluation(job_id: str, request: Request):
+    """Stream a job's status, progress, per-customer results and final result as Server-Sent Events"""
+    job = job_manager.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Evaluation job not found")
     
-    # Give the server a moment to start
-    time.sleep(2)
-    return server_process
+    # Resume after the last event the browser saw if it reconnects
+    last_event_id = request.headers.get("last-event-id")
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else 0
+    
+    async def event_stream():
+        async for index, event in job_manager.stream(job, start):
+            if await request.is_disconnected():
+                break
+            yield format_sse(index, event)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/runs")
+async def list_runs(limit: int = 50):
+    """Recorded evaluation runs, newest first"""
+    return await run_in_threadpool(job_manager.store.list_runs, limit)
+
+@app.get("/runs/{run_id}")
+async def get_run(run_id: str):
+    """Full record of one evaluation run"""
+    run = await run_in_threadpool(job_manager.store.get_run, run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Evaluation run not found")
+    return run
+
+@app.get("/runs/{base_run_id}/diff/{other_run_id}")
+async def diff_runs(base_run_id: str, other_run_id: str):
+    """Compare two runs' quality metrics and timings"""
+    diff = await run_in_threadpool(job_manager.store.diff_runs, base_run_id, other_run_id)
+    if not diff:
+        raise HTTPException(status_code=404, detail="Evaluation run not found")
+    return diff
 
 @app.get("/run-evaluation")
 async def run_evaluation():
-    """Run the evaluation script and return the results"""
+    """Run the end-to-end evaluation and return its text output once it finishes"""
     # Check if we're in the right directory
     if not os.path.exists("src/main.py"):
         return "Error: Cannot find src/main.py. Make sure you're running this from the project root directory."
     
-    # Start server
-    server = run_server_subprocess()
-    
-    try:
-        # Run evaluation
-        print("\nRunning recommendation system evaluation...")
-        result = subprocess.run(
-            [sys.executable, "src/evaluate_recommendations.py"],
-            capture_output=True,
-            text=True
-        )
-        
-        evaluation_output = result.stdout
-        
-        # Save results to file for easier access
-        with open("recommendation_results.txt", "w") as f:
-            f.write(evaluation_output)
-        
-        return evaluation_output
-    
-    finally:
-        # Clean up: terminate the server
-        print("\nShutting down server...")
-        server.terminate()
-        server.wait()
-        print("Server shutdown complete.")
+    job = await job_manager.wait(job_manager.submit("http"))
+    if job.status == "failed":
+        return f"Error: {job.error}"
+    return job.result["output"]
 
 if __name__ == "__main__":
     print("Starting web interface for recommendation evaluation...")